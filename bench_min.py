@@ -0,0 +1,717 @@
+# -*- coding: utf-8 -*-
+# Офлайн-бенчмарк горячих путей bot_min.py — без Telegram-токена, без ключа OpenAI и без сети.
+# • oa_client подменяется FakeOpenAI: настраиваемая задержка, ответы нужной длины, поток кусками.
+# • Меряем: synthesize_story (оба конвейера, локальный генератор, пул потоков), clamp_to_band_locally,
+#   _local_story по всем длинам и стилям (попадание в диапазон, полнота сюжета, воспроизводимость по seed),
+#   render_story_pdf (в файл и через пул процессов), save_json / store_user_story (json и sqlite),
+#   диалог /story → on_text → PDF целиком через Application.process_update с подменённым HTTP-запросом,
+#   нагрузочный прогон тысяч синтетических апдейтов через очередь PTB (последовательно и параллельно).
+# • Холодный старт: профиль python -X importtime для import bot_min (и нет ли среди загруженного openai/fpdf/telegram)
+#   и время от запуска процесса до вебхука, принявшего первый апдейт (Bot API — заглушка на localhost, TG_API_URL).
+# • Итог — JSON с p50/p95/p99 и пропускной способностью; --compare сравнивает с прошлым прогоном.
+#
+#   python bench_min.py --out bench.json
+#   python bench_min.py --out new.json --compare bench.json --latency 0.05
+
+import os, sys, re, json, time, math, random, shutil, tempfile, argparse, asyncio, platform, subprocess, threading
+from pathlib import Path
+from types import SimpleNamespace
+from typing import Dict, Any, List, Callable, Optional, Tuple
+from collections import Counter
+
+ROOT = Path(__file__).resolve().parent
+
+# ──────────────────────────────────────────────────────────────────────────────
+# ПОДДЕЛЬНЫЙ OpenAI
+# ──────────────────────────────────────────────────────────────────────────────
+_OPEN = "{hero} очень хочет найти дорогу к старой мельнице, где живёт мудрая сова."
+_MIDDLE = [
+    "По пути {hero} встречает ручей, и перейти его не просто, потому что камни скользкие.",
+    "Друзья помогают строить мостик из веток, и каждый приносит то, что может.",
+    "Ветер мешал идти, но {hero} держался за руку друга и шёл дальше.",
+    "Белка подсказывает короткую тропинку, а ёжик делится яблоком.",
+    "Иногда было трудно, но герои смеялись и пели песенку про солнце.",
+    "Сова рассказывает, что доброе дело похоже на фонарик в тёмном лесу.",
+]
+_CLOSE = "В конце дня {hero} понял, что вместе любая дорога становится короче."
+
+def fake_story_text(hero: str, words: int, rng: random.Random) -> str:
+    # связный «сюжет» заданного объёма: цель → препятствия → развязка, 3–6 абзацев
+    sents = [_OPEN.format(hero=hero)]; n = len(sents[0].split())
+    close = _CLOSE.format(hero=hero); n_close = len(close.split())
+    while n + n_close < words:
+        s = rng.choice(_MIDDLE).format(hero=hero); sents.append(s); n += len(s.split())
+    sents.append(close)
+    per = max(1, len(sents) // 5)
+    return "\n\n".join(" ".join(sents[i:i + per]) for i in range(0, len(sents), per))
+
+class FakeOpenAI:
+    # Ровно то подмножество клиента, которым пользуется бот: client.responses.create(model, input, stream, text).
+    # Пауза latency (± jitter) — на вызов; в потоковом режиме она размазана по кускам по chunk символов.
+    # miss_rate — доля черновиков, не попадающих в диапазон слов (чтобы срабатывала правка).
+    # tail_rate — доля «хвостовых» вызовов, которые идут в tail_mult раз дольше; hang > 0 — API «висит» столько секунд.
+    def __init__(self, latency: float = 0.02, jitter: float = 0.2, miss_rate: float = 0.1, chunk: int = 40, seed: int = 1,
+                 tail_rate: float = 0.0, tail_mult: float = 30.0):
+        self.latency, self.jitter, self.miss_rate, self.chunk = latency, jitter, miss_rate, chunk
+        self.tail_rate, self.tail_mult, self.hang = tail_rate, tail_mult, 0.0
+        self.rng = random.Random(seed); self.lock = threading.Lock()
+        self.calls: Counter = Counter()
+        self.responses = self
+
+    def _pause(self) -> float:
+        if self.hang: return self.hang
+        with self.lock:
+            k = self.tail_mult if self.rng.random() < self.tail_rate else 1.0
+            return max(0.0, k * self.latency * (1 + self.rng.uniform(-self.jitter, self.jitter)))
+
+    def _words(self, prompt: str, exact: bool) -> int:
+        m = re.search(r"(\d+)–(\d+) слов", prompt)
+        lo, hi = (int(m.group(1)), int(m.group(2))) if m else (450, 700)
+        with self.lock:
+            if not exact and self.rng.random() < self.miss_rate: return int(hi * 1.3)
+            return self.rng.randint(lo + 10, hi - 10)
+
+    def _body(self, kind: str, prompt: str) -> str:
+        with self.lock: seed = self.rng.random()
+        rng = random.Random(seed); hero = "герой"
+        if kind == "outline":
+            return json.dumps({"title": "Дорога к мельнице", "scenes": [{"name": f"Сцена {i}", "beats": ["цель", "препятствие"]} for i in range(4)]},
+                              ensure_ascii=False)
+        text = fake_story_text(hero, self._words(prompt, exact=(kind == "revise")), rng)
+        moral = "Вместе любая дорога короче."
+        questions = ["Куда шёл герой?", "Что ему мешало?", "Кто помог?", "Что бы сделал ты?"]
+        if kind == "draft_text":
+            return f"{text}\n\nМОРАЛЬ: {moral}\nВОПРОСЫ:\n" + "\n".join(f"{i}) {q}" for i, q in enumerate(questions, 1))
+        data = {"text": text, "moral": moral, "questions": questions}
+        if kind == "single": data = {"title": "Дорога к мельнице", **data}
+        return json.dumps(data, ensure_ascii=False)
+
+    @staticmethod
+    def _kind(prompt: str, text: Any) -> str:
+        if "outline" in prompt: return "outline"
+        if prompt.lstrip().startswith("Отредактируй"): return "revise"
+        if text is not None: return "single"
+        if "МОРАЛЬ:" in prompt: return "draft_text"
+        return "draft"
+
+    def create(self, model: str, input: str, stream: bool = False, text: Any = None, **kw):
+        kind = self._kind(input, text)
+        with self.lock: self.calls[kind] += 1
+        body = self._body(kind, input)
+        usage = SimpleNamespace(input_tokens=len(input) // 3, output_tokens=len(body) // 3,
+                                total_tokens=len(input) // 3 + len(body) // 3)
+        if stream: return self._stream(body, usage)
+        time.sleep(self._pause())
+        return SimpleNamespace(output_text=body, usage=usage)
+
+    def _stream(self, body: str, usage):
+        parts = [body[i:i + self.chunk] for i in range(0, len(body), self.chunk)]
+        pause = self._pause(); time.sleep(pause * 0.2)   # «первый токен»
+        for p in parts:
+            time.sleep(pause * 0.8 / len(parts))
+            yield SimpleNamespace(type="response.output_text.delta", delta=p)
+        yield SimpleNamespace(type="response.completed", response=SimpleNamespace(usage=usage))
+
+# ──────────────────────────────────────────────────────────────────────────────
+# ПОДДЕЛЬНЫЙ Telegram Bot API
+# ──────────────────────────────────────────────────────────────────────────────
+def fake_request_class():
+    from telegram.request import BaseRequest
+
+    class FakeRequest(BaseRequest):
+        # Отвечает на вызовы Bot API как сервер Telegram, ничего не отправляя. Пауза api_latency (±50%) — на вызов.
+        # На каждый sendDocument срабатывает on_document(chat_id) — по нему бенчмарк понимает, что сказка доставлена.
+        # upload_bps — скорость отдачи файлов (байт/с): загрузка PDF стоит len/upload_bps, отправка по file_id — нет.
+        def __init__(self, api_latency: float = 0.0, upload_bps: float = 0.0):
+            self.api_latency, self.upload_bps = api_latency, upload_bps
+            self.calls: Counter = Counter(); self.sent_bytes = 0
+            self.on_document: Callable[[int], None] = lambda chat_id: None
+            self.sent: Dict[int, List[Tuple[float, str]]] = {}   # chat_id → (время, текст) отправленных сообщений
+            self._mid = 0; self._rng = random.Random(api_latency)
+
+        @property
+        def read_timeout(self): return None
+        async def initialize(self): pass
+        async def shutdown(self): pass
+
+        def _message(self, chat_id: int, **extra) -> Dict[str, Any]:
+            self._mid += 1
+            return {"message_id": self._mid, "date": int(time.time()), "chat": {"id": chat_id, "type": "private"}, **extra}
+
+        async def do_request(self, url, method, request_data=None, read_timeout=None, write_timeout=None,
+                             connect_timeout=None, pool_timeout=None) -> Tuple[int, bytes]:
+            api = url.rsplit("/", 1)[-1]; self.calls[api] += 1
+            params = request_data.parameters if request_data else {}
+            if self.api_latency: await asyncio.sleep(self.api_latency * self._rng.uniform(0.5, 1.5))
+            chat_id = int(params.get("chat_id") or 0)
+            if api == "getMe":
+                result: Any = {"id": 1, "is_bot": True, "first_name": "Bench", "username": "bench_bot",
+                               "can_join_groups": False, "can_read_all_group_messages": False, "supports_inline_queries": False}
+            elif api in ("sendMessage", "editMessageText"):
+                result = self._message(chat_id, text=params.get("text", ""))
+                if api == "sendMessage": self.sent.setdefault(chat_id, []).append((time.perf_counter(), result["text"]))
+            elif api == "sendDocument":
+                if request_data and request_data.contains_files:
+                    size = sum(len(v[1]) for v in request_data.multipart_data.values() if isinstance(v, tuple))
+                    self.sent_bytes += size
+                    if self.upload_bps: await asyncio.sleep(size / self.upload_bps)
+                result = self._message(chat_id, document={"file_id": f"f{self._mid}", "file_unique_id": f"u{self._mid}"})
+                self.on_document(chat_id)
+            else:
+                result = True
+            return 200, json.dumps({"ok": True, "result": result}).encode()
+
+    return FakeRequest
+
+# ──────────────────────────────────────────────────────────────────────────────
+# ИЗМЕРЕНИЯ
+# ──────────────────────────────────────────────────────────────────────────────
+def summarize(samples: List[float], wall: float) -> Dict[str, Any]:
+    s = sorted(samples); n = len(s)
+    pct = lambda q: s[min(n - 1, max(0, math.ceil(q * n) - 1))] * 1000
+    return {"n": n, "wall_s": round(wall, 4), "throughput_per_s": round(n / wall, 2) if wall else None,
+            "mean_ms": round(sum(s) / n * 1000, 3), "p50_ms": round(pct(0.50), 3), "p95_ms": round(pct(0.95), 3),
+            "p99_ms": round(pct(0.99), 3), "max_ms": round(s[-1] * 1000, 3)}
+
+def run_sync(fn: Callable[[int], Any], n: int, warmup: int = 1) -> Dict[str, Any]:
+    for i in range(warmup): fn(-1 - i)
+    samples = []; t0 = time.perf_counter()
+    for i in range(n):
+        t = time.perf_counter(); fn(i); samples.append(time.perf_counter() - t)
+    return summarize(samples, time.perf_counter() - t0)
+
+async def run_async(fn: Callable[[int], Any], n: int, concurrency: int) -> Dict[str, Any]:
+    # n задач, не больше concurrency одновременно; задержка — от старта задачи до её завершения
+    sem = asyncio.Semaphore(concurrency); samples: List[float] = []
+    async def one(i):
+        async with sem:
+            t = time.perf_counter(); await fn(i); samples.append(time.perf_counter() - t)
+    t0 = time.perf_counter()
+    await asyncio.gather(*(one(i) for i in range(n)))
+    return summarize(samples, time.perf_counter() - t0)
+
+def sample_story(words: int = 600, seed: int = 0) -> Dict[str, Any]:
+    text = fake_story_text("ёжик", words, random.Random(seed))
+    return {"title": "Ёжик и дорога к мельнице", "text": text, "moral": "Вместе любая дорога короче.",
+            "questions": ["Куда шёл ёжик?", "Что ему мешало?", "Кто помог?", "Что бы сделал ты?"], "source": "ai"}
+
+# ──────────────────────────────────────────────────────────────────────────────
+# СЦЕНАРИИ
+# ──────────────────────────────────────────────────────────────────────────────
+def bench_generation(bm, fake: FakeOpenAI, a, out: Dict[str, Any]):
+    avoid = ["страшилки", "волк"]
+    for mode in ("3stage", "single"):
+        bm.oa_client = fake
+        out[f"synthesize_story/{mode}"] = run_sync(
+            lambda i, mode=mode: bm.synthesize_story(6, "ёжик", "дружба", "средняя", avoid, "классика", mode=mode), a.n_gen)
+    bm.oa_client = None
+    out["synthesize_story/local"] = run_sync(lambda i: bm.synthesize_story(6, "ёжик", "дружба", "средняя", avoid, "классика"), a.n_fast)
+    bm.oa_client = fake
+    out[f"synthesize_story_async/x{a.concurrency}"] = asyncio.run(run_async(
+        lambda i: bm.synthesize_story_async(6, f"ёжик{i}", "дружба", "средняя", avoid, "классика"), a.n_gen * 4, a.concurrency))
+
+def bench_resilience(bm, a, out: Dict[str, Any]):
+    # 1) «Хвост» API: tail_rate вызовов в 30 раз медленнее — p99 без подстраховочных запросов и с ними.
+    fake = FakeOpenAI(a.latency, a.jitter, 0.0, seed=a.seed, tail_rate=a.tail_rate)
+    bm.oa_client = fake
+    for hedge in (False, True):
+        bm.OA_HEDGE, bm.OA_HEDGE_MIN_DELAY = hedge, a.latency * 1.5; bm._stage_lat.clear()
+        out[f"hedge/{'on' if hedge else 'off'}"] = run_sync(
+            lambda i: bm.synthesize_story(6, "ёжик", "дружба", "средняя", [], "классика", mode="single"), a.n_gen * 5, warmup=25)
+    bm.OA_HEDGE = False
+    # 2) API «повис»: сказка должна уложиться в срок этапа, а после BREAKER_THRESHOLD сбоев — сразу писаться локально.
+    saved = dict(bm.OA_STAGE_TIMEOUT); bm.OA_STAGE_TIMEOUT.update({k: 0.3 for k in saved})
+    bm.breaker.cooldown = 0.5; fake.hang = 5.0; trips = bm.breaker.trips
+    out["outage/synthesize"] = run_sync(lambda i: bm.synthesize_story(6, "ёжик", "дружба", "средняя", [], "классика"), 20, warmup=0)
+    fake.hang = 0.0; t0 = time.perf_counter()
+    while not bm.breaker.allow() and time.perf_counter() - t0 < 10: time.sleep(0.05)
+    out["outage/breaker"] = {"trips": bm.breaker.trips - trips, "recovered": bm.breaker.allow(),
+                             "recover_s": round(time.perf_counter() - t0, 2)}
+    bm.OA_STAGE_TIMEOUT.update(saved); bm.breaker.cooldown = bm.BREAKER_COOLDOWN
+
+def bench_length(bm, a, out: Dict[str, Any]):
+    for length, band in bm.LEN_BANDS.items():
+        text = fake_story_text("ёжик", band[1] * 2, random.Random(7))
+        out[f"clamp_to_band_locally/{length}"] = run_sync(lambda i, t=text, b=band: bm.clamp_to_band_locally(t, b), a.n_fast)
+    # Локальный генератор: скорость по диапазонам и проверка, что каждая сказка попала в диапазон и полна по сюжету
+    heroes = ["ёжик", "Маша", "маленький ёжик", "храбрая мышь", "Миша", "медведь"]
+    for length, band in bm.LEN_BANDS.items():
+        for style in bm.STORY_STYLES:
+            texts = []
+            r = run_sync(lambda i, band=band, style=style: texts.append(
+                bm._local_story(6, heroes[i % len(heroes)], "дружба", band, style, ["волк"], seed=i)["text"]), a.n_fast, warmup=0)
+            tms = [bm.TextMetrics(t) for t in texts]
+            r.update(in_band=sum(tm.within(band) for tm in tms) / len(tms), plot_complete=sum(tm.plot_complete() for tm in tms) / len(tms),
+                     seeded=bm._local_story(6, "ёжик", "дружба", band, style, [], seed=1) == bm._local_story(6, "ёжик", "дружба", band, style, [], seed=1))
+            out[f"local_story/{length}/{style}"] = r
+
+def bench_pdf(bm, a, tmp: Path, out: Dict[str, Any]):
+    data = sample_story(1000)
+    path = tmp / "bench.pdf"
+    out["render_story_pdf/file"] = run_sync(lambda i: bm.render_story_pdf(path, data), a.n_pdf)
+
+    async def pooled():
+        await bm.render_story_pdf_async(data)   # прогрев пула процессов
+        return await run_async(lambda i: bm.render_story_pdf_async(data), a.n_pdf * 2, max(1, bm.PDF_WORKERS))
+    out[f"render_story_pdf_async/x{max(1, bm.PDF_WORKERS)}"] = asyncio.run(pooled())
+    out["render_story_pdf/bytes_kb"] = round(len(bm.render_story_pdf_bytes(data)) / 1024, 1)
+
+def use_backend(bm, backend: str, tmp: Path):
+    # чистое хранилище и архив под каждый прогон
+    for p in (bm.STATS_PATH, bm.STORIES_PATH, bm.DB_PATH, bm.ARCHIVE_PATH): Path(p).unlink(missing_ok=True)
+    if bm.store: bm.store.close()
+    if bm.archive: bm.archive.close()
+    bm.store = bm.open_store(backend); bm.archive = None
+
+def bench_storage(bm, a, tmp: Path, out: Dict[str, Any]):
+    stats = {str(u): dict(bm.default_stats(), stories_total=u) for u in range(a.users)}
+    out[f"save_json/{a.users}_users"] = run_sync(lambda i: bm.save_json(tmp / "bench_stats.json", stats), a.n_pdf)
+    story = sample_story()
+    for backend in ("json", "sqlite"):
+        use_backend(bm, backend, tmp)
+        rng = random.Random(3)
+        out[f"store_user_story/{backend}"] = run_sync(
+            lambda i: bm.store_user_story(rng.randrange(a.users), dict(story, title=f"Сказка {i}"), params={"hero": "ёжик"}),
+            a.n_store)
+    use_backend(bm, "json", tmp)
+
+def _update(bm, uid: int, n: int, text: str):
+    msg = {"message_id": n, "date": int(time.time()), "chat": {"id": uid, "type": "private"},
+           "from": {"id": uid, "is_bot": False, "first_name": "Bench"}, "text": text}
+    if text.startswith("/"): msg["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+    return {"update_id": n, "message": msg}
+
+async def bench_flow(bm, fake: FakeOpenAI, a, out: Dict[str, Any]):
+    # Полный диалог /story: команда → возраст → герой → мораль → длина → (генерация, текст, PDF в фоне).
+    # Апдейты идут через Application.process_update с теми же обработчиками, что в main(); Bot API подменён.
+    from telegram import Update
+    req = fake_request_class()(a.api_latency)
+    app = bm.build_application("123456:BENCH", 1, req, fake_request_class()())
+    bm.oa_client = fake
+    waiters: Dict[int, asyncio.Future] = {}
+    req.on_document = lambda chat_id: waiters.pop(chat_id).set_result(time.perf_counter()) if chat_id in waiters else None
+    steps: List[float] = []; seq = iter(range(1, 10**9))
+
+    async def send(uid: int, text: str):
+        t = time.perf_counter()
+        await app.process_update(Update.de_json(_update(bm, uid, next(seq), text), app.bot))
+        steps.append(time.perf_counter() - t)
+
+    async def dialog(i: int):
+        uid = 1000 + i
+        waiters[uid] = asyncio.get_running_loop().create_future()
+        for text in ("/story", "6", f"ёжик{i}", "дружба"): await send(uid, text)
+        t = time.perf_counter(); await send(uid, "средняя")
+        return await asyncio.wait_for(waiters[uid], 60) - t if uid in waiters else 0.0
+
+    async with app:
+        await app.start()
+        flows: List[float] = []
+        async def one(i): flows.append(await dialog(i))
+        res = await run_async(one, a.users_flow, a.users_flow)
+        await app.stop()
+    # задержка — от последнего ответа пользователя до прихода PDF; wall — все диалоги параллельно
+    out[f"on_text/story_flow/x{a.users_flow}"] = dict(summarize(flows, res["wall_s"]), dialog_p50_ms=res["p50_ms"])
+    out["on_text/step"] = summarize(steps, sum(steps))
+    out["on_text/bot_api_calls"] = dict(req.calls)
+
+# на каждое сообщение цикла бот отвечает ровно одним sendMessage, начало ответа известно заранее
+_DISPATCH_REPLIES = ["<b>Привет", "⚙️", "Герой", "Длина", "Стиль", "Каких", "Готово", "👪"]
+
+def _dispatch_script(uid: int, n: int) -> List[str]:
+    cycle = ["/start", "/settings", str(3 + uid % 12), f"герой{uid}", "короткая", "фантазия", "нет", "/parent"]
+    return [cycle[i % len(cycle)] for i in range(n)]
+
+async def bench_dispatch(bm, a, out: Dict[str, Any]):
+    # Тысячи апдейтов от многих пользователей вперемешку (порядок внутри пользователя сохранён) кладутся
+    # в update_queue запущенного приложения — тем же путём, что идут апдейты из polling/webhook.
+    # Задержка апдейта — от постановки в очередь до ответа бота. Порядок проверяем по ответам: k-й ответ
+    # пользователю должен отвечать на его k-е сообщение, а возраст в сохранённом профиле — совпасть.
+    from telegram import Update
+    per_user = max(8, a.updates // a.dispatch_users)
+    scripts = {50000 + u: _dispatch_script(50000 + u, per_user) for u in range(a.dispatch_users)}
+    rng = random.Random(a.seed); order: List[Tuple[int, str]] = []
+    pos = {uid: 0 for uid in scripts}; live = list(scripts)
+    while live:
+        uid = rng.choice(live); order.append((uid, scripts[uid][pos[uid]])); pos[uid] += 1
+        if pos[uid] == per_user: live.remove(uid)
+    for conc in sorted({1, a.update_concurrency}):
+        use_backend(bm, "json", Path.cwd())
+        req = fake_request_class()(a.dispatch_api_latency)
+        app = bm.build_application("123456:BENCH", conc, req, fake_request_class()())
+        put_at: Dict[int, List[float]] = {uid: [] for uid in scripts}
+        async with app:
+            await app.start()
+            t0 = time.perf_counter()
+            for i, (uid, text) in enumerate(order, 1):
+                put_at[uid].append(time.perf_counter())
+                await app.update_queue.put(Update.de_json(_update(bm, uid, i, text), app.bot))
+            while sum(map(len, req.sent.values())) < len(order) and time.perf_counter() - t0 < 600:
+                await asyncio.sleep(0.01)
+            wall = time.perf_counter() - t0
+            await app.stop()
+        lat = [r[0] - p for uid in scripts for p, r in zip(put_at[uid], req.sent.get(uid, []))]
+        in_order = all(text.startswith(_DISPATCH_REPLIES[i % len(_DISPATCH_REPLIES)])
+                       for uid in scripts for i, (_, text) in enumerate(req.sent.get(uid, [])))
+        ages_ok = all(bm.get_profile(uid)["age"] == 3 + uid % 12 for uid in scripts)
+        out[f"dispatch/x{conc}"] = dict(summarize(lat, wall), updates=len(order), users=len(scripts),
+                                        ordered=in_order and ages_ok, replies=sum(map(len, req.sent.values())))
+
+async def bench_resend(bm, a, out: Dict[str, Any]):
+    # /mystories N у пользователей с готовой историей, дважды. Первый проход — как раньше: рендер PDF и загрузка;
+    # второй — тот же документ по сохранённому file_id. Задержка — от команды до ответа sendDocument.
+    from telegram import Update
+    use_backend(bm, "json", Path.cwd())
+    for i in range(a.resend_users):
+        for j in range(3): bm.store_user_story(70000 + i, sample_story(600, seed=i * 3 + j) | {"title": f"Сказка {i}.{j}"})
+    req = fake_request_class()(a.api_latency, a.upload_mbps * 125_000)
+    app = bm.build_application("123456:BENCH", 1, req, fake_request_class()())
+    seq = iter(range(1, 10**9))
+
+    async def resend(i: int):
+        await app.process_update(Update.de_json(_update(bm, 70000 + i, next(seq), f"/mystories {1 + i % 3}"), app.bot))
+
+    async with app:
+        await app.start()
+        for name in ("upload", "file_id"):
+            sent0, docs0 = req.sent_bytes, req.calls["sendDocument"]
+            res = await run_async(resend, a.resend_users, a.concurrency)
+            out[f"mystories/{name}"] = dict(res, documents=req.calls["sendDocument"] - docs0, sent_kb=round((req.sent_bytes - sent0) / 1024, 1))
+        await app.stop()
+    sends = {dict(k[1]).get("how"): v for k, v in bm.metrics.counters.items() if k[0] == "skazka_pdf_bytes_total"}
+    out["mystories/bytes"] = {"uploaded_kb": round(sends.get("upload", 0) / 1024, 1), "saved_kb": round(sends.get("file_id", 0) / 1024, 1),
+                              "upload_mbps": a.upload_mbps}
+
+def bench_batch(bm, fake: FakeOpenAI, a, tmp: Path, out: Dict[str, Any]):
+    # python bot_min.py batch: a.batch_n профилей через FakeOpenAI. x1 — по одной сказке, как через диалог /story;
+    # xN — GEN_CONCURRENCY одновременно; files — пакетный файл через LocalBatchAPI. resume — прогон обрывается
+    # на половине и запускается снова: каждая сказка должна быть написана ровно один раз, манифест — полным.
+    bm.oa_client = fake
+    rng = random.Random(a.seed); src = tmp / "batch_profiles.jsonl"
+    src.write_text("".join(json.dumps({"age": rng.randint(4, 12), "hero": rng.choice(["ёжик", "Маша", "дракон", "лиса"]),
+                                       "moral": rng.choice(["дружба", "смелость", "честность"]),
+                                       "length": rng.choice(list(bm.LEN_BANDS)), "style": rng.choice(list(bm.STORY_STYLES)),
+                                       "avoid": "волк;гроза"}, ensure_ascii=False) + "\n" for _ in range(a.batch_n)), "utf-8")
+    runs = (("async/x1", "async", 1), (f"async/x{a.concurrency}", "async", a.concurrency), (f"files/x{a.concurrency}", "files", a.concurrency))
+    for name, api, conc in runs:
+        calls0 = sum(fake.calls.values())
+        st = asyncio.run(bm.run_batch(src, tmp / f"batch_{api}_{conc}", api, conc))
+        out[f"batch/{name}"] = dict(st, openai_calls=sum(fake.calls.values()) - calls0)
+
+    async def interrupted(dst: Path):
+        task = asyncio.ensure_future(bm.run_batch(src, dst, "async", a.concurrency))
+        man = dst / "manifest.jsonl"
+        while not task.done() and (not man.exists() or man.read_text("utf-8").count("\n") < a.batch_n // 2):
+            await asyncio.sleep(0.01)
+        task.cancel()
+        try: await task
+        except asyncio.CancelledError: pass
+    dst = tmp / "batch_resume"
+    asyncio.run(interrupted(dst))
+    first = len(list((dst / "stories").glob("*.json")))
+    st = asyncio.run(bm.run_batch(src, dst, "async", a.concurrency))
+    lines = [json.loads(l) for l in (dst / "manifest.jsonl").read_text("utf-8").splitlines() if l.strip()]
+    out["batch/resume"] = dict(st, before_interrupt=first, complete=len({l["id"] for l in lines}) == a.batch_n,
+                               written_once=first + st["generated"] == a.batch_n,
+                               pdfs=len(list((dst / "pdf").glob("*.pdf"))))
+
+def bench_book(bm, a, tmp: Path, out: Dict[str, Any]):
+    # /book: вся история одним PDF. Время — без трассировки, пик памяти Python — отдельным прогоном под tracemalloc;
+    # при потоковой вёрстке он не должен расти с числом сказок. Самый маленький размер — ещё и через команду /book.
+    import tracemalloc
+    from telegram import Update
+    bm._book_fonts()
+    for n in a.book_sizes:
+        use_backend(bm, "json", tmp); uid = "90000"
+        for i in range(n):
+            bm._archive().append(uid, f"2026-{1 + i // 28 % 12:02d}-{1 + i % 28:02d}T10:00:00+03:00",
+                                 dict(sample_story(600, seed=i), title=f"Сказка {i + 1}: ёжик и дорога к мельнице"))
+        path = tmp / f"book_{n}.pdf"
+        t = time.perf_counter()
+        info = bm.render_book(path, lambda: bm.user_history(uid, None), n)
+        took = time.perf_counter() - t
+        tracemalloc.start()
+        bm.render_book(path, lambda: bm.user_history(uid, None), n)
+        peak = tracemalloc.get_traced_memory()[1]; tracemalloc.stop()
+        out[f"book/{n}"] = dict(info, seconds=round(took, 3), ms_per_story=round(took / n * 1000, 2),
+                                peak_kb=round(peak / 1024), mb=round(info["bytes"] / 2**20, 2))
+        if n != min(a.book_sizes): continue
+        req = fake_request_class()(a.api_latency, a.upload_mbps * 125_000)
+        app = bm.build_application("123456:BENCH", 1, req, fake_request_class()())
+
+        async def via_command():
+            async with app:
+                t = time.perf_counter()
+                await app.process_update(Update.de_json(_update(bm, int(uid), 1, "/book"), app.bot))
+                return time.perf_counter() - t
+        took = asyncio.run(via_command())
+        out[f"book/{n}/command"] = {"seconds": round(took, 3), "documents": req.calls["sendDocument"], "sent_kb": round(req.sent_bytes / 1024, 1)}
+
+def _legacy_math_sheet():
+    # /math до движка листов: 10 примеров по одному, + и − в пределах 4–15 / 1–9 при любом возрасте
+    problems, answers = [], []
+    for _ in range(10):
+        a, b = random.randint(4, 15), random.randint(1, 9)
+        if random.random() < 0.5:
+            problems.append(f"{a} + {b} = "); answers.append(str(a + b))
+        else:
+            if b > a: a, b = b, a
+            problems.append(f"{a} − {b} = "); answers.append(str(a - b))
+    return problems, answers
+
+def _check_math(bm, engine: str, n: int = 200) -> Dict[str, Any]:
+    # на каждом уровне: без повторов (a + b и b + a — повтор), ответы верны, операции и числа — из таблицы уровня
+    bad = Counter()
+    for lv, (_, w, lim, mul, div) in bm.MATH_LEVELS.items():
+        sheets = bm.make_math_sheets(lv, n, seed=lv, engine=engine)
+        for i in range(len(sheets)):
+            keys = set()
+            for p, r in sheets.problems(i):
+                x, o, y, _ = p.split(); x, y, r = int(x), int(y), int(r); op = bm.MATH_OPS.index(o)
+                keys.add((op, min(x, y), max(x, y)) if op in (0, 2) else (op, x, y))
+                bad["answer"] += r != (x + y, x - y, x * y, x // y)[op] or (op == 3 and x % y != 0)
+                bad["level"] += (not w[op] or (op < 2 and not (1 <= r and max(x, r) <= lim))
+                                 or (op == 2 and not (mul[0] <= x <= mul[1] and mul[2] <= y <= mul[3]))
+                                 or (op == 3 and not (div[0] <= y <= div[1] and div[2] <= r <= div[3])))
+            bad["duplicate"] += len(keys) != bm.MATH_PROBLEMS
+        again = bm.make_math_sheets(lv, 3, seed=99, engine=engine).problems(2)
+        bad["seed"] += again != bm.make_math_sheets(lv, 3, seed=99, engine=engine).problems(2)
+    return {"sheets": n * len(bm.MATH_LEVELS), **{k: bad[k] for k in ("duplicate", "answer", "level", "seed")}}
+
+def bench_math(bm, a, out: Dict[str, Any]):
+    # /math: генерация листов пачкой на каждом движке (numpy — если установлен) против прежних примеров по одному,
+    # проверка листов, вёрстка PDF и сама команда: готовый лист из кэша (hit) и генерация с вёрсткой на запрос (miss).
+    # first_reply — до сообщения с примерами, total — до отправленного PDF.
+    from telegram import Update
+    def timed(fn) -> float:
+        t = time.perf_counter(); fn(); return time.perf_counter() - t
+    took = timed(lambda: [_legacy_math_sheet() for _ in range(10000)])
+    out["math/generate/legacy/10000"] = {"seconds": round(took, 3), "us_per_sheet": round(took / 10000 * 1e6, 2), "problems": 10}
+    for engine in ["python"] + (["numpy"] if bm._numpy() else []):
+        bm.make_math_sheets(4, 1, engine=engine)   # импорт numpy и первый генератор — не в замер
+        for n in a.math_sheets:
+            took = timed(lambda: bm.make_math_sheets(4, n, engine=engine))
+            out[f"math/generate/{engine}/{n}"] = {"seconds": round(took, 4), "us_per_sheet": round(took / n * 1e6, 2),
+                                                  "sheets_per_s": round(n / took), "problems": bm.MATH_PROBLEMS}
+        out[f"math/check/{engine}"] = _check_math(bm, engine)
+    rows = bm.make_math_sheets(6, 1, seed=1).problems(0)
+    out["math/pdf"] = run_sync(lambda i: bm.render_math_pdf_bytes(6, [rows]), a.n_pdf)
+    out["math/pdf/bytes_kb"] = round(len(bm.render_math_pdf_bytes(6, [rows])) / 1024, 1)
+
+    use_backend(bm, "json", Path.cwd())
+    n = a.math_users; level = bm.math_level(bm.get_profile(81000)["age"])
+    for name, per_level in (("hit", 2 * n + 2), ("miss", 0)):
+        bm.math_cache = bm.MathSheetCache(per_level)
+        if per_level:
+            bm.math_cache.needs_fill(level); took = timed(lambda: bm.math_cache.fill(level))
+            out["math/cache_fill"] = {"sheets": per_level, "seconds": round(took, 3), "ms_per_sheet": round(took / per_level * 1000, 2)}
+        req = fake_request_class()(a.api_latency, a.upload_mbps * 125_000)
+        app = bm.build_application("123456:BENCH", 1, req, fake_request_class()())
+        starts: Dict[int, float] = {}
+
+        async def cmd(i: int):
+            uid = 81000 + i; starts[uid] = time.perf_counter()
+            await app.process_update(Update.de_json(_update(bm, uid, i + 1, "/math"), app.bot))
+
+        async def run():
+            async with app:
+                return await run_async(cmd, n, a.concurrency)
+        res = asyncio.run(run())
+        first = [req.sent[uid][0][0] - t for uid, t in starts.items() if req.sent.get(uid)]
+        out[f"math/command/{name}"] = dict(res, documents=req.calls["sendDocument"],
+                                           first_reply_p50_ms=summarize(first, 1)["p50_ms"],
+                                           cache={"hits": bm.math_cache.hits, "misses": bm.math_cache.misses})
+
+HEAVY_MODULES = ("openai", "fpdf", "telegram", "zoneinfo", "fontTools", "tornado", "httpx")
+
+def _bot_env(**extra) -> Dict[str, str]:
+    env = {k: v for k, v in os.environ.items() if k not in ("OPENAI_API_KEY", "PUBLIC_URL", "TG_API_URL")}
+    env.update(BOT_TOKEN="123456:BENCH", PYTHONPATH=str(ROOT), PYTHONUNBUFFERED="1", **extra)
+    return env
+
+def import_profile(tmp: Path, top: int = 10) -> Dict[str, Any]:
+    # python -X importtime в свежем процессе: сколько стоит import bot_min, что он тянет сразу и что из тяжёлого
+    code = f"import sys, json, bot_min; print(json.dumps([m for m in {HEAVY_MODULES!r} if m in sys.modules]))"
+    r = subprocess.run([sys.executable, "-X", "importtime", "-c", code], capture_output=True, text=True, env=_bot_env(), cwd=tmp, timeout=120)
+    rows = []
+    for line in r.stderr.splitlines():
+        m = re.match(r"import time:\s+(\d+) \|\s+(\d+) \| ( *)(\S+)", line)
+        if m: rows.append((int(m[1]), int(m[2]), len(m[3]) // 2, m[4]))
+    i = max(k for k, row in enumerate(rows) if row[3] == "bot_min")
+    j = i
+    while j > 0 and rows[j - 1][2] > 0: j -= 1          # поддерево bot_min: дети печатаются перед родителем
+    direct = sorted((row for row in rows[j:i] if row[2] == 1), key=lambda row: -row[1])[:top]
+    return {"bot_min_ms": round(rows[i][1] / 1000, 2), "self_ms": round(rows[i][0] / 1000, 2),
+            "heavy_loaded": json.loads(r.stdout.strip().splitlines()[-1]),
+            "top_direct_ms": {name: round(cum / 1000, 2) for _, cum, _, name in direct}}
+
+def fake_bot_api():
+    # Bot API на localhost: getMe, setWebhook, setMyCommands… — всё «ok», чтобы бот мог стартовать без сети
+    from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+    class Handler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            self.rfile.read(int(self.headers.get("Content-Length") or 0))
+            method = self.path.rsplit("/", 1)[-1]
+            result = {"getMe": {"id": 1, "is_bot": True, "first_name": "bench", "username": "bench_bot"}, "getUpdates": []}.get(method, True)
+            body = json.dumps({"ok": True, "result": result}).encode()
+            self.send_response(200); self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body))); self.end_headers(); self.wfile.write(body)
+        do_GET = do_POST
+        def log_message(self, *args): pass
+    srv = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    threading.Thread(target=srv.serve_forever, daemon=True).start()
+    return srv
+
+def _free_port() -> int:
+    import socket
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0)); return sock.getsockname()[1]
+
+def start_to_ready(tmp: Path, api_url: str, timeout: float = 60) -> Dict[str, Any]:
+    # python bot_min.py в режиме вебхука: от запуска процесса до первого апдейта, принятого вебхуком (200)
+    import urllib.request
+    port = _free_port()
+    env = _bot_env(PUBLIC_URL=f"http://127.0.0.1:{port}", PORT=str(port), WEBHOOK_PATH="hook", TG_API_URL=api_url, METRICS_PORT="0")
+    t0 = time.perf_counter()
+    proc = subprocess.Popen([sys.executable, str(ROOT / "bot_min.py")], cwd=tmp, env=env, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
+    lines: List[str] = []
+    threading.Thread(target=lambda: lines.extend(iter(proc.stdout.readline, "")), daemon=True).start()
+    ready = None
+    try:
+        while ready is None and time.perf_counter() - t0 < timeout and proc.poll() is None:
+            try:
+                req = urllib.request.Request(f"http://127.0.0.1:{port}/hook", data=b'{"update_id": 1}', headers={"Content-Type": "application/json"})
+                if urllib.request.urlopen(req, timeout=1).status == 200: ready = time.perf_counter() - t0
+            except OSError:
+                time.sleep(0.01)
+        t1 = time.perf_counter()
+        while time.perf_counter() - t1 < 15 and not any("прогрев за" in l for l in lines): time.sleep(0.05)
+    finally:
+        proc.terminate()
+        try: proc.wait(15)
+        except subprocess.TimeoutExpired: proc.kill()
+    num = lambda pat: next((float(m[1]) for l in lines for m in [re.search(pat, l)] if m), None)
+    return {"ready_s": round(ready, 3) if ready else None, "reported_ready_s": num(r"принимаю апдейты через ([\d.]+)"),
+            "prewarm_s": num(r"прогрев за ([\d.]+)"), "log_tail": [l.rstrip() for l in lines[-3:]] if not ready else None}
+
+def bench_startup(a, tmp: Path, out: Dict[str, Any]):
+    # Холодный старт: import bot_min (отдельно — профиль -X importtime) и время до готовности вебхука
+    out["startup/import_profile"] = import_profile(tmp)
+    run = lambda code: subprocess.run([sys.executable, "-c", code], env=_bot_env(), cwd=tmp, check=True)
+    out["startup/python"] = run_sync(lambda i: run("pass"), a.n_start)
+    out["startup/import_bot_min"] = run_sync(lambda i: run("import bot_min"), a.n_start)
+    api = fake_bot_api()
+    try:
+        runs = [start_to_ready(tmp, f"http://127.0.0.1:{api.server_port}") for _ in range(a.n_start)]
+    finally:
+        api.shutdown(); api.server_close()
+    ok = [r["ready_s"] for r in runs if r["ready_s"]]
+    out["startup/webhook_ready"] = dict(summarize(ok, sum(ok)) if ok else {"n": 0}, runs=runs)
+
+# ──────────────────────────────────────────────────────────────────────────────
+# ЗАПУСК
+# ──────────────────────────────────────────────────────────────────────────────
+def _git_rev() -> Optional[str]:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, capture_output=True, text=True, timeout=10).stdout.strip() or None
+    except Exception:
+        return None
+
+def compare(base: Dict[str, Any], new: Dict[str, Any]):
+    print(f"\n{'сценарий':44} {'p50 было→стало, мс':>26} {'×p50':>7} {'×thr':>7}")
+    for name, r in new["results"].items():
+        b = base.get("results", {}).get(name)
+        if not (isinstance(r, dict) and isinstance(b, dict) and "p50_ms" in r and "p50_ms" in b): continue
+        k = b["p50_ms"] / r["p50_ms"] if r["p50_ms"] else float("inf")
+        kt = (r["throughput_per_s"] or 0) / b["throughput_per_s"] if b.get("throughput_per_s") else float("nan")
+        print(f"{name:44} {b['p50_ms']:>12.2f} → {r['p50_ms']:<11.2f} {k:>7.2f} {kt:>7.2f}")
+
+def main(argv: Optional[List[str]] = None) -> Dict[str, Any]:
+    ap = argparse.ArgumentParser(description="Офлайн-бенчмарк bot_min.py")
+    ap.add_argument("--out", default="bench_results.json", help="куда записать JSON с результатами")
+    ap.add_argument("--compare", help="JSON прошлого прогона для сравнения")
+    ap.add_argument("--only", default="", help="через запятую: startup,generation,resilience,length,pdf,storage,flow,dispatch,resend,batch,book,math")
+    ap.add_argument("--latency", type=float, default=0.02, help="задержка FakeOpenAI на вызов, с")
+    ap.add_argument("--jitter", type=float, default=0.2, help="разброс задержки, доля")
+    ap.add_argument("--tail-rate", type=float, default=0.05, help="доля медленных (×30) вызовов в прогоне resilience")
+    ap.add_argument("--miss-rate", type=float, default=0.1, help="доля черновиков вне диапазона слов")
+    ap.add_argument("--api-latency", type=float, default=0.0, help="задержка подменённого Bot API на вызов, с")
+    ap.add_argument("--upload-mbps", type=float, default=8, help="скорость загрузки файлов в подменённый Bot API, Мбит/с")
+    ap.add_argument("--resend-users", type=int, default=200, help="пользователей в прогоне resend (/mystories)")
+    ap.add_argument("--batch-n", type=int, default=100, help="профилей в прогоне batch")
+    ap.add_argument("--book-sizes", default="25,250,2500", help="сколько сказок в книге /book, через запятую")
+    ap.add_argument("--math-sheets", default="1,1000,10000", help="листов за вызов генератора в прогоне math, через запятую")
+    ap.add_argument("--math-users", type=int, default=40, help="команд /math в прогоне math (на hit и на miss)")
+    ap.add_argument("--concurrency", type=int, default=8)
+    ap.add_argument("--users", type=int, default=2000, help="пользователей в хранилище")
+    ap.add_argument("--users-flow", type=int, default=16, help="параллельных диалогов /story")
+    ap.add_argument("--updates", type=int, default=4000, help="апдейтов в нагрузочном прогоне dispatch")
+    ap.add_argument("--dispatch-users", type=int, default=400)
+    ap.add_argument("--dispatch-api-latency", type=float, default=0.005, help="задержка Bot API в прогоне dispatch, с")
+    ap.add_argument("--update-concurrency", type=int, default=64)
+    ap.add_argument("--quick", action="store_true", help="меньше повторов — для быстрой проверки")
+    ap.add_argument("--seed", type=int, default=1)
+    a = ap.parse_args(argv)
+    k = 0.25 if a.quick else 1
+    a.n_gen, a.n_fast, a.n_pdf, a.n_store = int(40 * k) or 1, int(400 * k) or 1, int(20 * k) or 1, int(400 * k) or 1
+    a.n_start = int(5 * k) or 1
+    a.resend_users = int(a.resend_users * k) or 1
+    a.batch_n = int(a.batch_n * k) or 1
+    a.book_sizes = [int(x) for x in a.book_sizes.split(",") if x.strip()]
+    if a.quick: a.book_sizes = [x for x in a.book_sizes if x <= 250] or a.book_sizes[:1]
+    a.math_sheets = [int(x) for x in a.math_sheets.split(",") if x.strip()]
+    a.math_users = int(a.math_users * k) or 1
+    a.updates = int(a.updates * k) or 1
+    only = {s.strip() for s in a.only.split(",") if s.strip()}
+    out_path = Path(a.out).resolve(); base = json.loads(Path(a.compare).read_text("utf-8")) if a.compare else None
+
+    # Всё, что бот пишет на диск (stats/stories/sqlite/архив/кэш шрифтов), — во временный каталог.
+    tmp = Path(tempfile.mkdtemp(prefix="bench_min_"))
+    fonts = tmp / "fonts"; fonts.mkdir()
+    for name in ("DejaVuSans.ttf", "DejaVuSans-Bold.ttf"):
+        src = ROOT / "fonts" / name if (ROOT / "fonts" / name).exists() else ROOT / name
+        if src.exists(): os.symlink(src, fonts / name)
+    os.environ.pop("OPENAI_API_KEY", None)
+    os.environ.setdefault("PREGEN_TOKEN_BUDGET", "0")
+    cwd = os.getcwd(); os.chdir(tmp); sys.path.insert(0, str(ROOT))
+    random.seed(a.seed)
+    try:
+        import bot_min as bm
+        fake = FakeOpenAI(a.latency, a.jitter, a.miss_rate, seed=a.seed)
+        results: Dict[str, Any] = {}
+        t0 = time.perf_counter()
+        if not only or "startup" in only: bench_startup(a, tmp, results)
+        if not only or "generation" in only: bench_generation(bm, fake, a, results)
+        if not only or "resilience" in only: bench_resilience(bm, a, results)
+        if not only or "length" in only: bench_length(bm, a, results)
+        if not only or "pdf" in only: bench_pdf(bm, a, tmp, results)
+        if not only or "storage" in only: bench_storage(bm, a, tmp, results)
+        if not only or "flow" in only:
+            use_backend(bm, "json", tmp); asyncio.run(bench_flow(bm, fake, a, results))
+        if not only or "dispatch" in only: asyncio.run(bench_dispatch(bm, a, results))
+        if not only or "resend" in only: asyncio.run(bench_resend(bm, a, results))
+        if not only or "batch" in only: bench_batch(bm, fake, a, tmp, results)
+        if not only or "book" in only: bench_book(bm, a, tmp, results)
+        if not only or "math" in only: bench_math(bm, a, results)
+        report = {
+            "meta": {"commit": _git_rev(), "python": platform.python_version(), "platform": platform.platform(),
+                     "cpu_count": os.cpu_count(), "started": time.strftime("%Y-%m-%dT%H:%M:%S"),
+                     "total_s": round(time.perf_counter() - t0, 2),
+                     "args": {k: v for k, v in vars(a).items() if k not in ("out", "compare")}},
+            "results": results,
+            "counters": {"openai_calls": dict(fake.calls), "pipelines": bm.pipeline_stats(), "story_cache": bm.story_cache.stats()},
+        }
+        bm.shutdown_pools()
+    finally:
+        os.chdir(cwd); shutil.rmtree(tmp, ignore_errors=True)
+
+    out_path.write_text(json.dumps(report, ensure_ascii=False, indent=2), "utf-8")
+    for name, r in results.items():
+        if isinstance(r, dict) and "p50_ms" in r:
+            print(f"{name:44} p50={r['p50_ms']:>9.2f} p95={r['p95_ms']:>9.2f} p99={r['p99_ms']:>9.2f} мс  {r['throughput_per_s']:>9.1f}/с")
+    print("→", out_path)
+    if base: compare(base, report)
+    return report
+
+if __name__ == "__main__":
+    main()
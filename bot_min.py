@@ -4,16 +4,28 @@
 # • Генерация: outline → draft → critique&revise → проверка объёма.
 # • Длину можно задавать: короткая (250–400), средняя (450–700), длинная (800–1100).
 # • Настройки: возраст, герой, длина по умолчанию, стиль, «избегать».
+# • Холодный старт: openai, fpdf, telegram и zoneinfo импортируются при первом использовании
+#   (аннотации — строками, см. __future__), а в post_init всё тяжёлое прогревается в фоне.
 
-import os, json, random, re, traceback
+from __future__ import annotations
+
+import os, sys, io, time, html, json, random, re, bisect, traceback, asyncio, functools, itertools, sqlite3, threading, struct, zlib, hashlib
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, wait as wait_futures, FIRST_COMPLETED
+from concurrent.futures.process import BrokenProcessPool
 from pathlib import Path
 from datetime import datetime, timedelta
-from typing import Dict, Any, List, Optional, Tuple
-from zoneinfo import ZoneInfo
+from typing import Dict, Any, List, Optional, Tuple, Callable
+from collections import OrderedDict, Counter, deque
+from array import array
+from contextlib import contextmanager
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:   # только для аннотаций
+    from fpdf import FPDF
+    from telegram import Update, Message
+    from telegram.ext import Application, ContextTypes
 
-from fpdf import FPDF
-from telegram import Update, InputFile, BotCommand
-from telegram.ext import Application, CommandHandler, MessageHandler, ContextTypes, filters
+_T_IMPORT = time.monotonic()
 
 # ──────────────────────────────────────────────────────────────────────────────
 # ENV
@@ -32,27 +44,213 @@ ALERT_CHAT_ID = os.getenv("ALERT_CHAT_ID")
 # OpenAI (только для текста; опционально)
 OPENAI_API_KEY    = os.getenv("OPENAI_API_KEY")
 OPENAI_MODEL_TEXT = os.getenv("OPENAI_MODEL_TEXT", "gpt-4.1-mini")
-try:
-    from openai import OpenAI
-    oa_client = OpenAI(api_key=OPENAI_API_KEY) if OPENAI_API_KEY else None
-except Exception:
-    oa_client = None
+# Сроки: бюджет сказки = OA_BUDGET_BASE + верх диапазона слов × OA_BUDGET_PER_WORD; у каждого этапа ещё свой
+# потолок (OA_STAGE_TIMEOUTS="outline=15,draft=45"). Повторы SDK — в пределах срока этапа.
+OA_BUDGET_BASE     = float(os.getenv("OA_BUDGET_BASE", "10"))
+OA_BUDGET_PER_WORD = float(os.getenv("OA_BUDGET_PER_WORD", "0.04"))      # средняя → 38 с, длинная → 54 с
+OA_STAGE_TIMEOUT   = {"outline": 15.0, "draft": 45.0, "single": 45.0, "revise": 30.0, "probe": 10.0}
+OA_STAGE_TIMEOUT.update({k: float(v) for k, v in (kv.split("=", 1) for kv in os.getenv("OA_STAGE_TIMEOUTS", "").replace(" ", "").split(",") if "=" in kv)})
+OA_REVISE_MIN      = float(os.getenv("OA_REVISE_MIN", "5"))              # меньше осталось — правку пропускаем
+OA_MAX_RETRIES     = int(os.getenv("OA_MAX_RETRIES", "1"))
+# подстраховочный (hedged) запрос: нет ответа дольше p95 этапа (но не меньше OA_HEDGE_MIN_DELAY) — шлём второй
+OA_HEDGE           = os.getenv("OA_HEDGE", "0") == "1"
+OA_HEDGE_MIN_DELAY = float(os.getenv("OA_HEDGE_MIN_DELAY", "2"))
+# предохранитель: BREAKER_THRESHOLD ошибок за BREAKER_WINDOW с — модель не зовём, пробуем раз в BREAKER_COOLDOWN с
+BREAKER_THRESHOLD    = max(1, int(os.getenv("BREAKER_THRESHOLD", "5")))
+BREAKER_WINDOW       = float(os.getenv("BREAKER_WINDOW", "60"))
+BREAKER_COOLDOWN     = float(os.getenv("BREAKER_COOLDOWN", "30"))
+BREAKER_MAX_COOLDOWN = float(os.getenv("BREAKER_MAX_COOLDOWN", "300"))
+
+class LazyOpenAI:
+    # Клиент создаётся при первом обращении к атрибуту: import openai — около полусекунды холодного старта.
+    # bool() — «ключ задан и SDK не отказал», без импорта; если клиент создать не вышло — False (локальный генератор).
+    def __init__(self, api_key: Optional[str]):
+        self._key, self._client, self._failed = api_key, None, False
+        self._lock = threading.Lock()
+
+    def __bool__(self) -> bool:
+        return bool(self._key) and not self._failed
+
+    def get(self):
+        if self._client is None and self:
+            with self._lock:
+                if self._client is None and not self._failed:
+                    try:
+                        from openai import OpenAI
+                        self._client = OpenAI(api_key=self._key, max_retries=OA_MAX_RETRIES)
+                    except Exception as e:
+                        print("[OpenAI] клиент не создан:", repr(e)); self._failed = True
+        return self._client
+
+    def __getattr__(self, name: str):
+        if name.startswith("_"): raise AttributeError(name)
+        client = self.get()
+        if client is None: raise RuntimeError("OpenAI недоступен")
+        return getattr(client, name)
+
+oa_client = LazyOpenAI(OPENAI_API_KEY)
+
+# сколько сказок пишется одновременно (запросы к модели идут в пуле потоков, не в event loop)
+GEN_CONCURRENCY = max(1, int(os.getenv("GEN_CONCURRENCY", "8")))
+# очередь генераций: одновременно у одного пользователя, всего заявок у одного (ждут + пишутся), мест в очереди
+GEN_PER_USER      = max(1, int(os.getenv("GEN_PER_USER", "1")))
+GEN_USER_PENDING  = max(1, int(os.getenv("GEN_USER_PENDING", "2")))
+GEN_QUEUE_MAX     = max(0, int(os.getenv("GEN_QUEUE_MAX", "50")))
+QUEUE_EDIT_INTERVAL = max(1.0, float(os.getenv("QUEUE_EDIT_INTERVAL", "3")))   # «вы №N в очереди» правим не чаще
+# апдейты разных пользователей — параллельно (1 — строго по одному, как раньше), одного — по порядку;
+# у одного пользователя в очереди не больше CHAT_MAX_PENDING апдейтов, у всех вместе ждущих — не больше
+# половины UPDATE_CONCURRENCY; лишние отбрасываются
+UPDATE_CONCURRENCY = max(1, int(os.getenv("UPDATE_CONCURRENCY", "64")))
+CHAT_MAX_PENDING   = max(1, int(os.getenv("CHAT_MAX_PENDING", "20")))
+# HTTP-клиент к Bot API: соединений хватает на все параллельные обработчики и доставку сказок;
+# ожидание свободного соединения — секунды, а не 1 с по умолчанию (иначе при всплеске — PoolTimeout)
+TG_POOL_SIZE         = int(os.getenv("TG_POOL_SIZE", str(min(256, UPDATE_CONCURRENCY + 2 * GEN_CONCURRENCY + 4))))
+TG_POOL_TIMEOUT      = float(os.getenv("TG_POOL_TIMEOUT", "5"))
+TG_READ_TIMEOUT      = float(os.getenv("TG_READ_TIMEOUT", "10"))
+TG_MEDIA_WRITE_TIMEOUT = float(os.getenv("TG_MEDIA_WRITE_TIMEOUT", "60"))   # загрузка PDF
+TG_HTTP_VERSION      = os.getenv("TG_HTTP_VERSION", "1.1")                 # "2" — нужен пакет h2
+# кэш готовых сказок: сколько вариантов держать на один набор параметров, сколько наборов, сколько секунд
+STORY_CACHE_VARIANTS = max(1, int(os.getenv("STORY_CACHE_VARIANTS", "4")))
+STORY_CACHE_KEYS     = max(0, int(os.getenv("STORY_CACHE_KEYS", "2000")))
+STORY_CACHE_TTL      = float(os.getenv("STORY_CACHE_TTL", str(7 * 24 * 3600)))
+# ночная предгенерация популярных сказок в кэш: тихие часы (Мск, включительно) и бюджет токенов на ночь
+PREGEN_HOURS         = os.getenv("PREGEN_HOURS", "1-6")
+PREGEN_TOKEN_BUDGET  = int(os.getenv("PREGEN_TOKEN_BUDGET", "0"))      # 0 — предгенерация выключена
+PREGEN_TOP           = int(os.getenv("PREGEN_TOP", "20"))              # сколько самых частых запросов держать готовыми
+PREGEN_LOOKBACK_DAYS = int(os.getenv("PREGEN_LOOKBACK_DAYS", "14"))
+PREGEN_INTERVAL      = float(os.getenv("PREGEN_INTERVAL", "600"))
+# потоковая выдача: черновик идёт из модели кусками, сообщение-заглушка правится не чаще раза в STREAM_EDIT_INTERVAL с
+STREAM_STORIES       = os.getenv("STREAM_STORIES", "1") == "1"
+STREAM_EDIT_INTERVAL = max(1.0, float(os.getenv("STREAM_EDIT_INTERVAL", "1.5")))
+STREAM_MIN_CHARS     = int(os.getenv("STREAM_MIN_CHARS", "60"))   # меньше нового текста — не правим
+TG_MSG_LIMIT = 4000                                                # запас до 4096 символов Telegram
+# процессы для рендера PDF (0 — рендерить в потоке основного процесса)
+PDF_WORKERS = max(0, int(os.getenv("PDF_WORKERS", str(min(4, os.cpu_count() or 1)))))
+# /math: примеров на листе; готовых листов с PDF на каждый уровень (0 — без кэша, генерировать на запрос)
+MATH_PROBLEMS        = min(40, max(4, int(os.getenv("MATH_PROBLEMS", "20"))))
+MATH_CACHE_PER_LEVEL = max(0, int(os.getenv("MATH_CACHE_PER_LEVEL", "8")))
+# метрики Prometheus: отдельный порт METRICS_PORT (0 — выключить) и при polling, и при вебхуке
+METRICS_PORT = int(os.getenv("METRICS_PORT", "9100"))
+METRICS_PATH = os.getenv("METRICS_PATH", "/metrics")
+# свой Bot API сервер (telegram-bot-api --local или заглушка в бенчмарке): http://host:8081
+TG_API_URL = os.getenv("TG_API_URL")
+# прогрев в фоне после старта: клиент OpenAI, fpdf и шрифты, хранилище, процессы PDF, готовые листы /math
+PREWARM = os.getenv("PREWARM", "1") == "1"
+
+# ──────────────────────────────────────────────────────────────────────────────
+# МЕТРИКИ
+# ──────────────────────────────────────────────────────────────────────────────
+METRIC_BUCKETS = (0.005, 0.025, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 40, 60)
+METRIC_HELP = {
+    "skazka_stage_seconds":        ("histogram", "Длительность этапа (outline, draft, revise, pdf_render, save, tg_upload…), с"),
+    "skazka_stage_errors_total":   ("counter", "Исключения, вылетевшие из этапа"),
+    "skazka_fallbacks_total":      ("counter", "Переходы на локальный генератор; stage — где сломалось"),
+    "skazka_revise_total":         ("counter", "Запуски правки; reason: band — объём, plot — чеклист сюжета"),
+    "skazka_cache_requests_total": ("counter", "Обращения к кэшу готовых сказок"),
+    "skazka_stories_total":        ("counter", "Сгенерированные сказки: ai — модель, local — запасной генератор"),
+    "skazka_openai_tokens_total":  ("counter", "Токены OpenAI по полю usage ответов"),
+    "skazka_updates_dropped_total": ("counter", "Апдейты, отброшенные из-за переполнения очереди одного пользователя"),
+    "skazka_openai_hedges_total":  ("counter", "Подстраховочные запросы; won: first/second — чей ответ пришёл первым"),
+    "skazka_openai_deadline_total": ("counter", "Этапы, не уложившиеся в срок"),
+    "skazka_breaker_trips_total":  ("counter", "Срабатывания предохранителя OpenAI"),
+    "skazka_revise_skipped_total": ("counter", "Правки, пропущенные из-за исчерпанного бюджета сказки"),
+    "skazka_queue_rejected_total": ("counter", "Отказы очереди генераций; reason: user — много заявок у пользователя, full — очередь полна"),
+    "skazka_pdf_sends_total":      ("counter", "Отправленные PDF; how: upload — рендер и загрузка, file_id — повтор уже загруженного"),
+    "skazka_pdf_bytes_total":      ("counter", "Байты PDF; how: upload — загружено в Telegram, file_id — не пришлось загружать"),
+    "skazka_math_sheets_total":    ("counter", "Листы /math; result: hit — готовый из кэша, miss — сгенерирован и свёрстан на запрос"),
+}
+
+class Metrics:
+    # Мини-реестр в текстовом формате Prometheus (без prometheus_client): счётчики и гистограммы
+    # с метками. Пишут сюда и event loop, и потоки генерации — поэтому под замком.
+    def __init__(self, buckets: Tuple[float, ...] = METRIC_BUCKETS):
+        self.buckets = buckets; self.lock = threading.Lock()
+        self.counters: Dict[Tuple[str, Tuple], float] = {}
+        self.hists: Dict[Tuple[str, Tuple], List[Any]] = {}   # [счётчики по корзинам, сумма, количество]
+
+    def inc(self, name: str, value: float = 1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock: self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name: str, value: float, **labels):
+        key = (name, tuple(sorted(labels.items()))); i = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            h = self.hists.get(key) or self.hists.setdefault(key, [[0] * (len(self.buckets) + 1), 0.0, 0])
+            h[0][i] += 1; h[1] += value; h[2] += 1
+
+    @contextmanager
+    def span(self, stage: str):
+        t0 = time.perf_counter()
+        try:
+            yield
+        except Exception:
+            self.inc("skazka_stage_errors_total", stage=stage); raise
+        finally:
+            self.observe("skazka_stage_seconds", time.perf_counter() - t0, stage=stage)
+
+    @staticmethod
+    def _labels(pairs) -> str:
+        esc = lambda v: str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+        return "{" + ",".join(f'{k}="{esc(v)}"' for k, v in pairs) + "}" if pairs else ""
+
+    def render(self, gauges: List[Tuple[str, str, Dict[str, Any], float]] = ()) -> str:
+        # gauges — (имя, описание, метки, значение): снимок состояния, который считается в момент запроса
+        with self.lock:
+            counters = sorted(self.counters.items())
+            hists = sorted((k, [list(v[0]), v[1], v[2]]) for k, v in self.hists.items())
+        out: List[str] = []; typed = set()
+        def head(name: str, kind: str, text: str):
+            if name not in typed: typed.add(name); out.extend([f"# HELP {name} {text}", f"# TYPE {name} {kind}"])
+        for (name, labels), v in counters:
+            head(name, "counter", METRIC_HELP.get(name, ("", name))[1]); out.append(f"{name}{self._labels(labels)} {v:g}")
+        for (name, labels), (counts, total, n) in hists:
+            head(name, "histogram", METRIC_HELP.get(name, ("", name))[1]); acc = 0
+            for le, c in zip([*map(str, self.buckets), "+Inf"], counts):
+                acc += c; out.append(f"{name}_bucket{self._labels((*labels, ('le', le)))} {acc}")
+            out.append(f"{name}_sum{self._labels(labels)} {total:.6f}"); out.append(f"{name}_count{self._labels(labels)} {n}")
+        for name, text, labels, v in gauges:
+            head(name, "gauge", text); out.append(f"{name}{self._labels(sorted(labels.items()))} {float(v):g}")
+        return "\n".join(out) + "\n"
+
+metrics = Metrics()
+span = metrics.span
 
 # ──────────────────────────────────────────────────────────────────────────────
 # STORAGE
 # ──────────────────────────────────────────────────────────────────────────────
-TZ_MSK = ZoneInfo("Europe/Moscow")
 DATA_DIR     = Path(".")
 STATS_PATH   = DATA_DIR / "stats.json"
 STORIES_PATH = DATA_DIR / "stories.json"
+DB_PATH      = Path(os.getenv("DB_PATH", str(DATA_DIR / "bot.sqlite3")))
+STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", "json").lower()   # json / sqlite
+USER_CACHE_MB   = float(os.getenv("USER_CACHE_MB", "64"))        # бюджет кэша записей (sqlite)
+ARCHIVE_PATH = Path(os.getenv("ARCHIVE_PATH", str(DATA_DIR / "history.arc")))
+# сжатие архива в самом боте: раз в ARCHIVE_COMPACT_INTERVAL с, если кто-то удалил данные через /delete (0 — выключить)
+ARCHIVE_COMPACT_INTERVAL = float(os.getenv("ARCHIVE_COMPACT_INTERVAL", "3600"))
+ARCHIVE_LOCK_WAIT        = float(os.getenv("ARCHIVE_LOCK_WAIT", "60"))   # сколько ждать замок архива при открытии, с
+HISTORY_LIMIT = 25   # сколько последних сказок считается «историей» пользователя
+MYSTORIES_LIMIT = 10 # сколько последних сказок показывает /mystories
+# очередь заданий для отдельных процессов-воркеров (python bot_min.py worker [N]); 0 — генерация в процессе бота
+JOB_QUEUE        = os.getenv("JOB_QUEUE", "0") == "1"
+JOBS_DB_PATH     = Path(os.getenv("JOBS_DB", str(DATA_DIR / "jobs.sqlite3")))
+JOB_WORKERS      = max(1, int(os.getenv("JOB_WORKERS", str(os.cpu_count() or 1))))
+JOB_LEASE        = float(os.getenv("JOB_LEASE", "300"))     # с; не уложился — задание заберёт другой воркер
+JOB_POLL         = float(os.getenv("JOB_POLL", "1"))
+JOB_MAX_ATTEMPTS = max(1, int(os.getenv("JOB_MAX_ATTEMPTS", "3")))
 
 FONT_DIR  = Path("fonts")
 FONT_REG  = FONT_DIR / "DejaVuSans.ttf"
 FONT_BOLD = FONT_DIR / "DejaVuSans-Bold.ttf"
 PDF_FONT   = "DejaVu"
 PDF_FONT_B = "DejaVuB"
+FONT_CACHE_DIR = Path(os.getenv("FONT_CACHE_DIR", str(DATA_DIR / ".font_cache")))  # урезанные копии TTF
 
-def msk_now() -> datetime: return datetime.now(TZ_MSK)
+@functools.lru_cache(maxsize=None)
+def msk_tz():
+    from zoneinfo import ZoneInfo
+    return ZoneInfo("Europe/Moscow")
+
+def msk_now() -> datetime: return datetime.now(msk_tz())
 def msk_today_str() -> str: return msk_now().strftime("%Y-%m-%d")
 
 def load_json(p: Path) -> Dict[str, Any]:
@@ -62,11 +260,402 @@ def load_json(p: Path) -> Dict[str, Any]:
     return {}
 
 def save_json(p: Path, data: Dict[str, Any]):
-    try: p.write_text(json.dumps(data, ensure_ascii=False, indent=2), encoding="utf-8")
+    # пишем во временный файл и подменяем — обрыв посреди записи не портит старый файл
+    try:
+        with span("save_json"):
+            tmp = p.with_name(p.name + ".tmp")
+            tmp.write_text(json.dumps(data, ensure_ascii=False, indent=2), encoding="utf-8")
+            os.replace(tmp, p)
     except Exception as e: print(f"[FS] save_json error: {e}")
 
-stats_all: Dict[str, Dict[str, Any]]   = load_json(STATS_PATH)
-stories_all: Dict[str, Dict[str, Any]] = load_json(STORIES_PATH)
+# Хранилище: две «таблицы» — stats и stories, запись = dict на пользователя (ключ — str(uid)).
+class JsonStore:
+    # Прежний формат: каждый файл целиком в памяти и целиком перезаписывается при изменении.
+    def __init__(self, stats_path: Path, stories_path: Path):
+        self.paths = {"stats": stats_path, "stories": stories_path}
+        self.tables = {name: load_json(path) for name, path in self.paths.items()}
+
+    def get(self, table: str, uid: str) -> Optional[Dict[str, Any]]:
+        rec = self.tables[table].get(uid)
+        return json.loads(json.dumps(rec)) if rec is not None else None
+
+    def put(self, table: str, uid: str, rec: Dict[str, Any]):
+        self.tables[table][uid] = rec; save_json(self.paths[table], self.tables[table])
+
+    def delete_user(self, uid: str):
+        for name, data in self.tables.items():
+            if data.pop(uid, None) is not None: save_json(self.paths[name], data)
+
+    def close(self): pass
+
+class SqliteStore:
+    # SQLite в режиме WAL: одна строка на пользователя, изменение — UPDATE одной строки.
+    TABLES = ("stats", "stories")
+
+    def __init__(self, path: Path):
+        self.db = sqlite3.connect(str(path), check_same_thread=False, isolation_level=None)
+        self.lock = threading.Lock()
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        for t in self.TABLES:
+            self.db.execute(f"CREATE TABLE IF NOT EXISTS {t} (uid TEXT PRIMARY KEY, data TEXT NOT NULL)")
+
+    def get(self, table: str, uid: str) -> Optional[Dict[str, Any]]:
+        with self.lock:
+            row = self.db.execute(f"SELECT data FROM {table} WHERE uid=?", (uid,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def put(self, table: str, uid: str, rec: Dict[str, Any]):
+        data = json.dumps(rec, ensure_ascii=False, separators=(",", ":"))
+        with self.lock:
+            self.db.execute(f"INSERT INTO {table}(uid, data) VALUES(?, ?) "
+                            "ON CONFLICT(uid) DO UPDATE SET data=excluded.data", (uid, data))
+
+    def put_many(self, table: str, items: List[Tuple[str, Dict[str, Any]]]):
+        rows = [(uid, json.dumps(rec, ensure_ascii=False, separators=(",", ":"))) for uid, rec in items]
+        with self.lock:
+            self.db.execute("BEGIN")
+            self.db.executemany(f"INSERT OR REPLACE INTO {table}(uid, data) VALUES(?, ?)", rows)
+            self.db.execute("COMMIT")
+
+    def delete_user(self, uid: str):
+        with self.lock:
+            self.db.execute("BEGIN")
+            for t in self.TABLES: self.db.execute(f"DELETE FROM {t} WHERE uid=?", (uid,))
+            self.db.execute("COMMIT")
+
+    def close(self):
+        with self.lock: self.db.close()
+
+class CachedStore:
+    # LRU-кэш записей поверх медленного хранилища: в памяти живут только активные пользователи.
+    # Записи лежат сериализованными — так бюджет считается в байтах, а get отдаёт свежую копию.
+    def __init__(self, inner, budget_bytes: int):
+        self.inner = inner; self.budget = max(0, int(budget_bytes))
+        self.lru: "OrderedDict[Tuple[str, str], str]" = OrderedDict()
+        self.used = 0
+        self.hits = self.misses = self.evictions = 0
+        self.lock = threading.Lock()
+
+    def _remember(self, key: Tuple[str, str], raw: str):
+        old = self.lru.pop(key, None)
+        if old is not None: self.used -= len(old)
+        if len(raw) > self.budget: return
+        self.lru[key] = raw; self.used += len(raw)
+        while self.used > self.budget:
+            _, dropped = self.lru.popitem(last=False)
+            self.used -= len(dropped); self.evictions += 1
+
+    def get(self, table: str, uid: str) -> Optional[Dict[str, Any]]:
+        key = (table, uid)
+        with self.lock:
+            raw = self.lru.get(key)
+            if raw is not None:
+                self.lru.move_to_end(key); self.hits += 1
+                return json.loads(raw)
+            self.misses += 1
+        rec = self.inner.get(table, uid)
+        if rec is not None:
+            with self.lock: self._remember(key, json.dumps(rec, ensure_ascii=False))
+        return rec
+
+    def put(self, table: str, uid: str, rec: Dict[str, Any]):
+        self.inner.put(table, uid, rec)
+        with self.lock: self._remember((table, uid), json.dumps(rec, ensure_ascii=False))
+
+    def delete_user(self, uid: str):
+        self.inner.delete_user(uid)
+        with self.lock:
+            for key in [k for k in self.lru if k[1] == uid]:
+                self.used -= len(self.lru.pop(key))
+
+    def stats(self) -> Dict[str, Any]:
+        with self.lock:
+            return {"hits": self.hits, "misses": self.misses, "evictions": self.evictions,
+                    "entries": len(self.lru), "bytes": self.used, "budget": self.budget}
+
+    def close(self): self.inner.close()
+
+# Архив сказок: только дописывание, каждая сказка — отдельный zlib-кадр.
+# Кадр: заголовок (MAGIC, вид, длины uid/ts/тела, blake2b-хэш содержимого) + uid + ts + тело.
+#   D — данные: тело = zlib(JSON сказки)
+#   R — ссылка: тело = смещение уже записанного D-тела с тем же хэшем (одинаковые сказки не дублируются)
+#   X — «забыть пользователя»: всё, что было у uid раньше, больше не видно
+#   F — PDF сказки уже загружен в Telegram: хэш = ключ содержимого PDF (pdf_key), uid = hex-хэш сказки,
+#       тело = JSON {file_id, size, sha}; более поздний кадр с тем же ключом заменяет ранний
+# Индекс (uid → [(ts, смещение тела, длина)]) строится при первом обращении по заголовкам, без распаковки.
+# Архив открывает один процесс: на файле-спутнике <архив>.lock — замок (lockf), бот держит его, пока работает.
+# Поэтому compact из консоли при запущенном боте отказывается, а бот сжимает архив сам (archive_compact_loop).
+class ArchiveBusy(Exception):
+    pass
+
+class StoryArchive:
+    MAGIC = b"SK"
+    HEAD = struct.Struct(">2scHHI16s")
+
+    def __init__(self, path: Path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.index: Optional[Dict[str, List[Tuple[str, int, int, bytes]]]] = None
+        self.by_digest: Dict[bytes, Tuple[int, int]] = {}
+        self.files: Dict[bytes, Tuple[str, Dict[str, Any]]] = {}   # ключ PDF → (hex-хэш сказки, {file_id, size, sha})
+        self.fh = self.lock_fh = None
+        self.forgotten = 0   # кадров X, чьи сказки ещё лежат в файле; > 0 — есть что сжимать
+        self.journal: Optional[List[Tuple]] = None   # идёт compact: записи, сделанные за это время, для повтора в новом файле
+
+    @staticmethod
+    def _try_lock(fh):
+        # fcntl есть только на POSIX — импорт здесь, чтобы bot_min импортировался и без него
+        try:
+            import fcntl
+        except ImportError:
+            import msvcrt
+            fh.seek(0); msvcrt.locking(fh.fileno(), msvcrt.LK_NBLCK, 1); return
+        # lockf, а не flock: замок принадлежит процессу и не наследуется процессами пула PDF (fork)
+        fcntl.lockf(fh.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+
+    def _take_lock(self, wait: float):
+        fh = open(self.path.with_name(self.path.name + ".lock"), "a+b")
+        deadline = time.monotonic() + wait
+        while True:
+            try:
+                self._try_lock(fh); break
+            except OSError:
+                if time.monotonic() >= deadline:
+                    fh.close(); raise ArchiveBusy(f"архив {self.path} открыт другим процессом")
+                time.sleep(0.1)
+        self.lock_fh = fh
+
+    def _open(self, wait: float = ARCHIVE_LOCK_WAIT):
+        if self.index is not None: return
+        if self.lock_fh is None: self._take_lock(wait)
+        self.index, self.by_digest, self.files, self.forgotten = {}, {}, {}, 0
+        self.fh = open(self.path, "a+b")
+        self.fh.seek(0, os.SEEK_END); size = self.fh.tell(); pos = 0
+        while pos + self.HEAD.size <= size:
+            head = os.pread(self.fh.fileno(), self.HEAD.size, pos)
+            magic, kind, ulen, tlen, blen, digest = self.HEAD.unpack(head)
+            body_at = pos + self.HEAD.size + ulen + tlen
+            if magic != self.MAGIC or body_at + blen > size: break
+            meta = os.pread(self.fh.fileno(), ulen + tlen, pos + self.HEAD.size)
+            uid, ts = meta[:ulen].decode(), meta[ulen:].decode()
+            if kind == b"X":
+                self.forgotten += self.index.pop(uid, None) is not None
+            elif kind == b"D":
+                self.by_digest[digest] = (body_at, blen)
+                self.index.setdefault(uid, []).append((ts, body_at, blen, digest))
+            elif kind == b"R":
+                off = struct.unpack(">Q", os.pread(self.fh.fileno(), 8, body_at))[0]
+                self.index.setdefault(uid, []).append((ts, off, self.by_digest.get(digest, (off, 0))[1], digest))
+            elif kind == b"F":
+                self.files[digest] = (uid, json.loads(os.pread(self.fh.fileno(), blen, body_at)))
+            pos = body_at + blen
+        if pos < size:
+            # хвост недописанного кадра после сбоя — отрезаем
+            print(f"[ARCHIVE] обрезаю повреждённый хвост {self.path}: {size - pos} байт")
+            self.fh.truncate(pos)
+
+    def _write(self, kind: bytes, uid: str, ts: str, body: bytes, digest: bytes) -> int:
+        u, t = uid.encode(), ts.encode()
+        self.fh.seek(0, os.SEEK_END); pos = self.fh.tell()
+        self.fh.write(self.HEAD.pack(self.MAGIC, kind, len(u), len(t), len(body), digest) + u + t + body)
+        self.fh.flush()
+        return pos + self.HEAD.size + len(u) + len(t)
+
+    @staticmethod
+    def _encode(story: Dict[str, Any]) -> Tuple[bytes, bytes]:
+        # хэш — только по содержимому сказки: параметры запроса ("params") на совпадение не влияют
+        content = {k: v for k, v in story.items() if k not in ("ts", "params")}
+        raw = json.dumps(dict(content, params=story["params"]) if story.get("params") else content,
+                         ensure_ascii=False, sort_keys=True).encode()
+        digest = hashlib.blake2b(json.dumps(content, ensure_ascii=False, sort_keys=True).encode(), digest_size=16).digest()
+        return raw, digest
+
+    @classmethod
+    def digest_of(cls, story: Dict[str, Any]) -> bytes:
+        return cls._encode(story)[1]
+
+    def _journal(self, *op):
+        if self.journal is not None: self.journal.append(op)
+
+    def _append(self, uid: str, ts: str, raw: bytes, digest: bytes):
+        known = self.by_digest.get(digest)
+        if known:
+            self._write(b"R", uid, ts, struct.pack(">Q", known[0]), digest)
+            off, blen = known
+        else:
+            body = zlib.compress(raw, 6)
+            off = self._write(b"D", uid, ts, body, digest); blen = len(body)
+            self.by_digest[digest] = (off, blen)
+        self.index.setdefault(uid, []).append((ts, off, blen, digest))
+
+    def append(self, uid: str, ts: str, story: Dict[str, Any]) -> Dict[str, Any]:
+        raw, digest = self._encode(story)
+        with self.lock:
+            self._open(); self._append(uid, ts, raw, digest); self._journal(self._append, uid, ts, raw, digest)
+        return {"ts": ts, "title": story.get("title")}
+
+    @staticmethod
+    def _read(fh, off: int, blen: int) -> Dict[str, Any]:
+        # fh — взятый под замком вместе со смещениями: после compact у старых смещений свой (старый) файл
+        return json.loads(zlib.decompress(os.pread(fh.fileno(), blen, off)))
+
+    def find(self, uid: str, ts: str) -> Optional[Dict[str, Any]]:
+        with self.lock:
+            self._open(); fh = self.fh
+            hit = next((e for e in reversed(self.index.get(uid, [])) if e[0] == ts), None)
+        return dict(self._read(fh, hit[1], hit[2]), ts=ts) if hit else None
+
+    def count(self, uid: str) -> int:
+        with self.lock:
+            self._open(); return len(self.index.get(uid, []))
+
+    def history(self, uid: str, limit: Optional[int] = HISTORY_LIMIT):
+        # генератор: сказки от старых к новым, распаковываются по одной
+        with self.lock:
+            self._open(); fh = self.fh; entries = list(self.index.get(uid, []))
+        if limit: entries = entries[-limit:]
+        for ts, off, blen, _ in entries:
+            yield dict(self._read(fh, off, blen), ts=ts)
+
+    def recent(self, since_ts: str, limit: int):
+        # самые свежие сказки всех пользователей (ts >= since_ts), не больше limit; тела читаются по одному
+        with self.lock:
+            self._open(); fh = self.fh
+            entries = [e for lst in self.index.values() for e in lst if e[0] >= since_ts]
+        entries.sort(key=lambda e: e[0])
+        for ts, off, blen, _ in entries[-limit:]:
+            yield dict(self._read(fh, off, blen), ts=ts)
+
+    def digests(self, uid: str) -> set:
+        # хэши всех сказок пользователя — по индексу, без чтения тел
+        with self.lock:
+            self._open(); return {e[3] for e in self.index.get(uid, [])}
+
+    def file_of(self, key: bytes) -> Optional[Dict[str, Any]]:
+        with self.lock:
+            self._open(); hit = self.files.get(key)
+        return hit[1] if hit else None
+
+    def _attach(self, key: bytes, story_hex: str, meta: Dict[str, Any]):
+        self._write(b"F", story_hex, "", json.dumps(meta, ensure_ascii=False).encode(), key)
+        self.files[key] = (story_hex, meta)
+
+    def attach_file(self, key: bytes, story_digest: bytes, meta: Dict[str, Any]):
+        # file_id загруженного PDF — рядом со сказкой, в том же архиве; кадр не привязан к пользователю,
+        # потому что одну сказку (из кэша) получают разные люди, а file_id годится для любого чата бота
+        with self.lock:
+            self._open(); self._attach(key, story_digest.hex(), meta); self._journal(self._attach, key, story_digest.hex(), meta)
+
+    def _forget(self, uid: str):
+        if uid in self.index:
+            self._write(b"X", uid, "", b"", bytes(16)); self.index.pop(uid, None); self.forgotten += 1
+
+    def forget(self, uid: str):
+        with self.lock:
+            self._open(); self._forget(uid); self._journal(self._forget, uid)
+
+    def load(self, wait: float = ARCHIVE_LOCK_WAIT):
+        # первый проход по заголовкам и замок файла — заранее (в прогреве), а не в первом обработчике
+        with self.lock: self._open(wait)
+
+    def compact(self, wait: float = ARCHIVE_LOCK_WAIT) -> int:
+        # переписывает архив без забытых пользователей; возвращает новый размер.
+        # Новый файл пишется по снимку индекса без self.lock — бот в это время и читает, и дописывает старый.
+        # Дописанное за время сжатия ведётся в журнале и под self.lock повторяется в новом файле перед подменой.
+        with self.lock:
+            self._open(wait)
+            if self.journal is not None: raise ArchiveBusy(f"архив {self.path} уже сжимается")
+            self.journal = []
+            src = self.fh; snapshot = {uid: list(entries) for uid, entries in self.index.items()}; files = dict(self.files)
+        tmp = self.path.with_name(self.path.name + ".tmp")
+        try:
+            moved: Dict[int, int] = {}
+            new_index: Dict[str, List[Tuple[str, int, int, bytes]]] = {}
+            new_digest: Dict[bytes, Tuple[int, int]] = {}
+            with open(tmp, "wb") as out:
+                for uid, entries in snapshot.items():
+                    u = uid.encode()
+                    for ts, off, blen, digest in entries:
+                        t = ts.encode()
+                        if off in moved:
+                            new_off = moved[off]
+                            out.write(self.HEAD.pack(self.MAGIC, b"R", len(u), len(t), 8, digest) + u + t + struct.pack(">Q", new_off))
+                        else:
+                            body = os.pread(src.fileno(), blen, off)
+                            out.write(self.HEAD.pack(self.MAGIC, b"D", len(u), len(t), blen, digest) + u + t)
+                            new_off = out.tell(); out.write(body)
+                            moved[off] = new_off; new_digest[digest] = (new_off, blen)
+                        new_index.setdefault(uid, []).append((ts, new_off, blen, digest))
+                # file_id PDF — только для сказок, которые остались в архиве
+                live = {d.hex() for d in new_digest}
+                new_files = {key: f for key, f in files.items() if f[0] in live}
+                for key, (story, meta) in new_files.items():
+                    u, body = story.encode(), json.dumps(meta, ensure_ascii=False).encode()
+                    out.write(self.HEAD.pack(self.MAGIC, b"F", len(u), 0, len(body), key) + u + body)
+                out.flush(); os.fsync(out.fileno())
+        except BaseException:
+            with self.lock: self.journal = None
+            tmp.unlink(missing_ok=True); raise
+        with self.lock:
+            journal, self.journal = self.journal, None
+            # старый fh не закрываем: history()/recent(), начатые до сжатия, дочитают свои смещения из него
+            self.fh = open(tmp, "a+b"); self.index, self.by_digest, self.files = new_index, new_digest, new_files
+            self.forgotten = 0
+            for fn, *args in journal: fn(*args)
+            os.fsync(self.fh.fileno()); os.replace(tmp, self.path)
+            self.fh.seek(0, os.SEEK_END); return self.fh.tell()
+
+    def close(self):
+        with self.lock:
+            if self.fh: self.fh.close()
+            if self.lock_fh: self.lock_fh.close()
+            self.fh = self.lock_fh = None; self.index = None
+
+def open_store(backend: str = STORAGE_BACKEND):
+    if backend == "sqlite": return CachedStore(SqliteStore(DB_PATH), int(USER_CACHE_MB * 1024 * 1024))
+    if backend != "json": print(f"[FS] неизвестный STORAGE_BACKEND={backend!r}, беру json")
+    return JsonStore(STATS_PATH, STORIES_PATH)
+
+def migrate_json_to_sqlite(stats_path: Path = STATS_PATH, stories_path: Path = STORIES_PATH,
+                           db_path: Path = DB_PATH) -> Dict[str, int]:
+    # Разовый перенос stats.json / stories.json в SQLite. Повторный запуск перезапишет те же строки.
+    # История сказок при этом уезжает в архив (ARCHIVE_PATH), в записи остаётся только ссылка на последнюю.
+    db = SqliteStore(db_path)
+    try:
+        counts = {}
+        for table, path in (("stats", stats_path), ("stories", stories_path)):
+            data = load_json(path)
+            if table == "stories":
+                for uid, rec in data.items(): _split_history(uid, rec)
+            db.put_many(table, list(data.items())); counts[table] = len(data)
+        return counts
+    finally:
+        db.close()
+
+# хранилище открывается при первом обращении, а не при импорте
+store = None
+archive: Optional[StoryArchive] = None
+_open_lock = threading.Lock()   # первым может прийти и event loop, и поток прогрева — второй экземпляр недопустим
+
+def _store():
+    global store
+    if store is None:
+        with _open_lock:
+            if store is None: store = open_store()
+    return store
+
+def _archive() -> StoryArchive:
+    global archive
+    if archive is None:
+        with _open_lock:
+            if archive is None: archive = StoryArchive(ARCHIVE_PATH)
+    return archive
+
+def user_cache_stats() -> Dict[str, Any]:
+    # счётчики кэша записей (hits/misses/evictions); для json-хранилища — пусто
+    st = _store()
+    return st.stats() if hasattr(st, "stats") else {}
 
 def default_stats() -> Dict[str, Any]:
     return {
@@ -76,8 +665,9 @@ def default_stats() -> Dict[str, Any]:
     }
 
 def default_user_stories() -> Dict[str, Any]:
+    # "last" — ссылка {"ts","title"} на сказку в архиве, сама история живёт в StoryArchive
     return {
-        "last": None, "history": [],
+        "last": None,
         "profile": {
             "age": 6,
             "hero": "котёнок",
@@ -87,43 +677,86 @@ def default_user_stories() -> Dict[str, Any]:
         },
     }
 
+def _split_history(uid: str, rec: Dict[str, Any]) -> bool:
+    # старый формат: полные сказки прямо в записи ("history" + копия в "last") → в архив
+    if "history" not in rec and not (rec.get("last") or {}).get("text"): return False
+    hist = rec.pop("history", None) or []
+    last = rec.get("last")
+    if last and last.get("text") and not any(h.get("ts") == last.get("ts") for h in hist): hist.append(last)
+    ref = None
+    for h in hist:
+        ref = _archive().append(uid, h.get("ts") or msk_now().isoformat(), {k: v for k, v in h.items() if k != "ts"})
+    rec["last"] = ref
+    return True
+
+def _stories_rec(uid: int) -> Optional[Dict[str, Any]]:
+    rec = _store().get("stories", str(uid))
+    if rec and _split_history(str(uid), rec): _store().put("stories", str(uid), rec)
+    return rec
+
 def get_user_stats(uid: int) -> Dict[str, Any]:
-    u = stats_all.get(str(uid))
+    u = _store().get("stats", str(uid))
     if not u:
-        u = default_stats(); stats_all[str(uid)] = u; save_json(STATS_PATH, stats_all)
+        u = default_stats(); _store().put("stats", str(uid), u)
     if u.get("today_date") != msk_today_str():
-        u["today_date"] = msk_today_str(); u["today_stories"] = 0; save_json(STATS_PATH, stats_all)
+        u["today_date"] = msk_today_str(); u["today_stories"] = 0; _store().put("stats", str(uid), u)
     return u
 
+# Дневной лимит резервируется в момент постановки в очередь: проверка и +1 идут без await между ними,
+# поэтому в одном event loop два параллельных /story не пройдут оба по последнему свободному месту.
+def reserve_daily_story(uid: int) -> Optional[str]:
+    u = get_user_stats(uid)
+    if not DISABLE_LIMIT and u["today_stories"] >= MAX_STORIES_PER_DAY: return None
+    u["today_stories"] += 1; _store().put("stats", str(uid), u)
+    return u["today_date"]
+
+def release_daily_story(uid: int, day: str):
+    # сказка не получилась (отказ очереди, ошибка) — место возвращаем, если сутки ещё те же
+    u = get_user_stats(uid)
+    if u.get("today_date") == day and u["today_stories"] > 0:
+        u["today_stories"] -= 1; _store().put("stats", str(uid), u)
+
 def inc_story_counters(uid: int, title: str):
+    # today_stories уже учтён в reserve_daily_story
     u = get_user_stats(uid)
     u["stories_total"] += 1
-    u["today_stories"] += 1
     u["last_story_ts"] = msk_now().isoformat()
     u["last_story_title"] = title
-    stats_all[str(uid)] = u
-    save_json(STATS_PATH, stats_all)
+    _store().put("stats", str(uid), u)
 
 def inc_math_counter(uid: int):
     u = get_user_stats(uid); u["math_total"] += 1
-    stats_all[str(uid)] = u; save_json(STATS_PATH, stats_all)
+    _store().put("stats", str(uid), u)
 
 def get_profile(uid: int) -> Dict[str, Any]:
-    rec = stories_all.get(str(uid))
+    rec = _stories_rec(uid)
     if not rec:
-        rec = default_user_stories(); stories_all[str(uid)] = rec; save_json(STORIES_PATH, stories_all)
+        rec = default_user_stories(); _store().put("stories", str(uid), rec)
     return rec["profile"]
 
 def save_profile(uid: int, prof: Dict[str, Any]):
-    rec = stories_all.get(str(uid), default_user_stories())
-    rec["profile"] = prof; stories_all[str(uid)] = rec; save_json(STORIES_PATH, stories_all)
+    rec = _stories_rec(uid) or default_user_stories()
+    rec["profile"] = prof; _store().put("stories", str(uid), rec)
+
+def store_user_story(uid: int, story: Dict[str, Any], params: Optional[Dict[str, Any]] = None):
+    # params — с какими настройками просили сказку (для статистики популярных запросов)
+    rec = _stories_rec(uid) or default_user_stories()
+    stored = dict(story, params=params) if params else dict(story)
+    rec["last"] = _archive().append(str(uid), msk_now().isoformat(), stored)
+    _store().put("stories", str(uid), rec)
+    return rec["last"]
+
+def last_user_story(uid: int) -> Optional[Dict[str, Any]]:
+    rec = _stories_rec(uid) or {}
+    ref = rec.get("last")
+    return _archive().find(str(uid), ref["ts"]) if ref else None
 
-def store_user_story(uid: int, story: Dict[str, Any]):
-    rec = stories_all.get(str(uid), default_user_stories())
-    stamped = dict(story); stamped["ts"] = msk_now().isoformat()
-    rec["last"] = stamped
-    hist = rec.get("history", []); hist.append(stamped); rec["history"] = hist[-25:]
-    stories_all[str(uid)] = rec; save_json(STORIES_PATH, stories_all)
+def user_history(uid: int, limit: Optional[int] = HISTORY_LIMIT):
+    return _archive().history(str(uid), limit)
+
+def delete_user_data(uid: int):
+    _store().delete_user(str(uid))
+    _archive().forget(str(uid))
 
 # ──────────────────────────────────────────────────────────────────────────────
 # ДЛИНА/ВОЗРАСТ/СТИЛЬ
@@ -142,92 +775,814 @@ LEN_BANDS = {
     "длинная":  (800, 1100),
 }
 
+_WORD_RE = re.compile(r"[А-Яа-яЁёA-Za-z0-9-]+")
+_PARA_RE = re.compile(r"\n\n+")
+_SENT_RE = re.compile(r"(?<=[\.\!\?])\s+")
+# мини-чеклист сюжета одним проходом: цель героя, препятствия, развязка
+_CHECK_RE = re.compile(
+    r"(?P<goal>хочет|решил|мечтал|цель)"
+    r"|(?P<obstacle>трудн|препятств|не просто|мешал)"
+    r"|(?P<ending>к вечеру|в конце|понял|итог|вывод)",
+    re.IGNORECASE,
+)
+STORY_CHECKS = ("goal", "obstacle", "ending")
+
+class TextMetrics:
+    # Один разбор текста: позиции начала слов (по ним bisect даёт число слов в любом префиксе),
+    # границы абзацев и предложений, найденные пункты чеклиста. Дальше всё — без повторных проходов.
+    # Части, нужные не всегда (границы, чеклист), считаются при первом обращении и запоминаются.
+    __slots__ = ("text", "words", "_word_starts", "_para_cuts", "_sent_cuts", "_checks")
+
+    def __init__(self, text: str):
+        self.text = text
+        self.words = len(_WORD_RE.findall(text))
+        self._word_starts = self._para_cuts = self._sent_cuts = self._checks = None
+
+    @property
+    def word_starts(self) -> List[int]:
+        if self._word_starts is None: self._word_starts = [m.start() for m in _WORD_RE.finditer(self.text)]
+        return self._word_starts
+
+    @property
+    def para_cuts(self) -> List[int]:
+        if self._para_cuts is None: self._para_cuts = [m.start() for m in _PARA_RE.finditer(self.text)]
+        return self._para_cuts
+
+    @property
+    def sent_cuts(self) -> List[int]:
+        if self._sent_cuts is None: self._sent_cuts = [m.start() for m in _SENT_RE.finditer(self.text)]
+        return self._sent_cuts
+
+    @property
+    def checks(self) -> set:
+        if self._checks is None:
+            self._checks = {k for m in _CHECK_RE.finditer(self.text) for k, v in m.groupdict().items() if v}
+        return self._checks
+
+    def words_before(self, pos: int) -> int:
+        return bisect.bisect_left(self.word_starts, pos)
+
+    def within(self, band: Tuple[int, int]) -> bool:
+        return band[0] <= self.words <= band[1]
+
+    def plot_complete(self) -> bool:
+        return all(k in self.checks for k in STORY_CHECKS)
+
+    def _last_fitting(self, cuts: List[int], limit: int) -> int:
+        # сколько первых границ из cuts дают префикс не длиннее limit слов (бинарный поиск)
+        lo, hi = 0, len(cuts)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.words_before(cuts[mid]) <= limit: lo = mid + 1
+            else: hi = mid
+        return lo
+
+    def trim(self, limit: int) -> str:
+        # Сначала целыми абзацами; если не влезает даже первый — по предложениям первого абзаца (но не меньше трёх).
+        if self.words <= limit: return self.text
+        n = self._last_fitting(self.para_cuts, limit)
+        if n: return self.text[:self.para_cuts[n - 1]]
+        first_end = self.para_cuts[0] if self.para_cuts else len(self.text)
+        cuts = [c for c in self.sent_cuts if c < first_end] + [first_end]
+        n = max(self._last_fitting(cuts, limit), min(3, len(cuts)))
+        return self.text[:cuts[n - 1]]
+
+def text_metrics(text) -> TextMetrics:
+    return text if isinstance(text, TextMetrics) else TextMetrics(text)
+
 def word_count_ru(text: str) -> int:
     # грубо, но стабильно для контроля диапазона
-    return len(re.findall(r"[А-Яа-яЁёA-Za-z0-9-]+", text))
-
-def within_band(text: str, band: Tuple[int,int]) -> bool:
-    wc = word_count_ru(text)
-    return band[0] <= wc <= band[1]
-
-def clamp_to_band_locally(text: str, band: Tuple[int,int]) -> str:
-    # Если длиннее — мягко урезаем последние предложения; если короче — слегка расширяем связками.
-    wc = word_count_ru(text)
-    if wc > band[1]:
-        parts = re.split(r"(\n\n+)", text)  # абзацы
-        while word_count_ru("".join(parts)) > band[1] and len(parts) > 1:
-            parts = parts[:-1]  # убираем финальную реплику/абзац
-        text = "".join(parts)
-        # если всё ещё длинно — отрежем последние предложения
-        sents = re.split(r"(?<=[\.\!\?])\s+", text)
-        while word_count_ru(" ".join(sents)) > band[1] and len(sents) > 3:
-            sents = sents[:-1]
-        return " ".join(sents)
-    if wc < band[0]:
-        gap = band[0] - wc
-        filler = (
-            " Малые шаги приносят большие перемены. "
-            "Когда рядом добрые люди, любое дело становится понятнее и светлее. "
-        )
-        # добавим 1–3 фразы на конце
-        need = 1 if gap < 40 else (2 if gap < 120 else 3)
-        return text.rstrip() + "\n\n" + (filler * need).strip()
-    return text
+    return len(_WORD_RE.findall(text))
+
+def within_band(text, band: Tuple[int,int]) -> bool:
+    return text_metrics(text).within(band)
+
+def clamp_to_band_locally(text, band: Tuple[int,int]) -> str:
+    # Если длиннее — мягко урезаем последние абзацы/предложения. Короткий текст не добиваем общими фразами:
+    # его дописывает правка модели (_revise), а не успели — пусть лучше будет короче диапазона.
+    # text — строка или уже готовый TextMetrics (чтобы не разбирать текст второй раз).
+    m = text_metrics(text)
+    return m.trim(band[1]) if m.words > band[1] else m.text
 
 # ──────────────────────────────────────────────────────────────────────────────
 # ГЕНЕРАЦИЯ СКАЗКИ
 # ──────────────────────────────────────────────────────────────────────────────
+# «Избегать»: один скомпилированный шаблон на весь список, с русскими словоформами.
+# От каждого слова отрезаем окончание (лиса → лис, страшный → страшн) и ищем основу + любое окончание
+# из списка, целым словом: «лисой», «лисами», «страшного» — тоже под замену. Фразы — по словам через пробелы.
+RU_ENDINGS = sorted({
+    "а", "я", "о", "е", "ё", "ы", "и", "у", "ю", "ь", "й",
+    "ам", "ям", "ами", "ями", "ах", "ях", "ов", "ев", "ёв", "ей", "ой", "ом", "ем", "ём", "ою", "ею",
+    "ая", "яя", "ое", "ее", "ые", "ие", "ый", "ий", "ой", "ую", "юю", "ого", "его", "ому", "ему", "ым", "им", "ых", "их", "ыми", "ими",
+    "ешь", "ет", "ем", "ете", "ут", "ют", "ишь", "ит", "им", "ите", "ат", "ят",
+    "ал", "ала", "ало", "али", "ил", "ила", "ило", "или", "ел", "ела", "ело", "ели",
+    "ть", "ться", "ся", "сь", "ется", "ится", "утся", "ются", "атся", "ятся",
+}, key=len, reverse=True)
+_WORD_CHARS = r"[0-9A-Za-zА-Яа-яЁё_]"
+
+def _trie_regex(words: List[str]) -> str:
+    # Список слов → регулярка-префиксное дерево: «лис|лес|лето» → «л(?:ес|ето|ис)».
+    # В одной alternation на 50+ слов re перебирает варианты по очереди, по дереву — идёт по буквам.
+    trie: Dict[str, Any] = {}
+    for w in words:
+        node = trie
+        for c in w: node = node.setdefault(c, {})
+        node[""] = {}
+    def emit(node: Dict[str, Any]) -> str:
+        alts = [("[её]" if c in "её" else re.escape(c)) + emit(sub) for c, sub in sorted(node.items()) if c]
+        if not alts: return ""
+        body = alts[0] if len(alts) == 1 else "(?:" + "|".join(alts) + ")"
+        return f"(?:{body})?" if "" in node else body
+    return emit(trie)
+
+_ENDING_RE = f"(?:{_trie_regex(RU_ENDINGS)})?"
+
+def _avoid_stem(word: str) -> Tuple[str, bool]:
+    # (основа, русское ли слово): окончания перебираем от длинных к коротким, основа — не короче 3 букв
+    w = word.lower()
+    if not re.fullmatch(r"[а-яё]+", w): return w, False
+    for end in RU_ENDINGS:
+        if w.endswith(end) and len(w) - len(end) >= 3: return w[:-len(end)], True
+    return w, True
+
+def _avoid_word_pattern(word: str) -> str:
+    stem, ru = _avoid_stem(word)
+    return _trie_regex([stem]) + (_ENDING_RE if ru else "")
+
+class AvoidMatcher:
+    def __init__(self, avoid: Tuple[str, ...]):
+        phrases = [a.split() for a in avoid if a.strip()]
+        # в словах safe_cut: дефис делит «баба-яга» на два слова, поэтому считаем по _WORD_CHARS, а не по пробелам
+        self.max_words = max((len(re.findall(rf"{_WORD_CHARS}+", a)) for a in avoid if a.strip()), default=0)
+        ru, other = [], []
+        for ph in phrases:
+            if len(ph) == 1:
+                stem, is_ru = _avoid_stem(ph[0]); (ru if is_ru else other).append(stem)
+        alts = [r"\s+".join(_avoid_word_pattern(w) for w in ph) for ph in phrases if len(ph) > 1]
+        if ru: alts.append(_trie_regex(ru) + _ENDING_RE)
+        if other: alts.append(_trie_regex(other))
+        self.rx = re.compile(rf"(?<!{_WORD_CHARS})(?:{'|'.join(alts)})(?!{_WORD_CHARS})", re.IGNORECASE) if alts else None
+
+    def sub(self, text: str) -> str:
+        return self.rx.sub("🌟", text) if self.rx else text
+
+    def safe_cut(self, text: str) -> int:
+        # Докуда текст можно отдавать из потока. Совпадение, которое ещё может появиться, начинается не раньше
+        # max_words-го слова с конца (последнее слово могло оборваться) — его и придерживаем; а если уже
+        # найденное совпадение перекрывает эту границу — режем перед ним.
+        if not self.rx: return len(text)
+        starts = [m.start() for m in re.finditer(rf"{_WORD_CHARS}+", text)]
+        if len(starts) < self.max_words: return 0
+        cut = starts[-self.max_words]
+        for m in self.rx.finditer(text):
+            if m.start() >= cut: break
+            if m.end() > cut: return m.start()
+        return cut
+
+@functools.lru_cache(maxsize=4096)
+def _avoid_matcher_cached(key: Tuple[str, ...]) -> AvoidMatcher:
+    return AvoidMatcher(key)
+
+def avoid_matcher(avoid: List[str]) -> AvoidMatcher:
+    # кэш по содержимому списка: профиль с новым списком сразу получает новый ключ, старый уйдёт по LRU
+    return _avoid_matcher_cached(tuple(sorted({a.strip().lower() for a in avoid or [] if a.strip()})))
+
+class AvoidStream:
+    # Фильтр для потока: feed(кусок) возвращает готовый к показу (уже отфильтрованный) текст.
+    # stop — маркер, после которого поток больше не показываем (например, «МОРАЛЬ:»).
+    def __init__(self, matcher: AvoidMatcher, stop: Optional[str] = None):
+        self.m, self.stop = matcher, stop
+        self.pending = ""; self.stopped = False
+
+    def feed(self, chunk: str) -> str:
+        if self.stopped or not chunk: return ""
+        self.pending += chunk
+        if self.stop and self.stop in self.pending:
+            self.pending = self.pending.split(self.stop, 1)[0]; self.stopped = True
+            return self.flush()
+        cut = self.m.safe_cut(self.pending)
+        if self.stop:
+            # недописанный маркер в хвосте тоже придерживаем
+            for k in range(min(len(self.stop) - 1, len(self.pending)), 0, -1):
+                if self.pending.endswith(self.stop[:k]): cut = min(cut, len(self.pending) - k); break
+        out, self.pending = self.pending[:cut], self.pending[cut:]
+        return self.m.sub(out)
+
+    def flush(self) -> str:
+        out, self.pending = self.pending, ""
+        return self.m.sub(out)
+
 def _avoid_filter(text: str, avoid: List[str]) -> str:
     if not avoid: return text
-    for w in [a.strip() for a in avoid if a.strip()]:
-        text = re.sub(re.escape(w), "🌟", text, flags=re.IGNORECASE)
-    return text
+    return avoid_matcher(avoid).sub(text)
+
+# ──────────────────────────────────────────────────────────────────────────────
+# ЛОКАЛЬНЫЙ ГЕНЕРАТОР (когда OpenAI недоступен)
+# ──────────────────────────────────────────────────────────────────────────────
+# Шаблонная грамматика: сказка = вступление → эпизоды (место, препятствие, друг, помощь, вывод) → кульминация → развязка.
+# Эпизоды добавляются, пока текст не войдёт в диапазон длины, поэтому подгонка филлером не нужна.
+# Шаблоны компилируются один раз при импорте. Разметка:
+#   {H} {Hg} {Hd} {Ha} {Hi} {Hp} — герой в падежах (им., род., дат., вин., твор., предл.); {F…} — друг, {M…} — мораль;
+#   {Pw}/{Pt} — место «где»/«куда»; {On}/{Og}/{Oa} — предмет поиска; «^» после «{» — с заглавной буквы;
+#   [м|ж] — вариант по роду героя, <м|ж> — по роду друга.
+_CASES = {"": 0, "g": 1, "d": 2, "a": 3, "i": 4, "p": 5}
+_SLOT_CASES = {"H": _CASES, "F": _CASES, "M": _CASES, "P": {"w": 0, "t": 1}, "O": {"n": 0, "g": 1, "a": 2}}
+_TPL_RE = re.compile(r"\{(\^?)([HFMPO])([a-z]?)\}|\[([^\]]*)\]|<([^>]*)>")
+
+# Склонение в единственном числе по окончанию. Род: 0 — мужской (и средний), 1 — женский.
+_RU_VOWELS = "аеёиоуыэюя"
+_MALE_A = {"папа", "дедушка", "дядя", "мишка", "мишутка", "миша", "саша", "петя", "ваня", "дима", "коля", "вася", "гоша",
+           "лёша", "паша", "серёжа", "никита", "илья", "кузя", "федя", "женя", "юра", "слава", "мальчишка"}
+_FEM_SOFT = {"лошадь", "рысь", "моль", "выпь", "ель", "тень", "дверь", "морковь", "радость", "сельдь", "лань"}
+_FLEET_EC_KEEP = {"кузнец", "храбрец", "мудрец", "гонец", "купец", "жрец"}
+_NOUN_EXCEPTIONS = {
+    "ёж":      ("ёж", "ежа", "ежу", "ежа", "ежом", "еже"),
+    "лев":     ("лев", "льва", "льву", "льва", "львом", "льве"),
+    "заяц":    ("заяц", "зайца", "зайцу", "зайца", "зайцем", "зайце"),
+    "пёс":     ("пёс", "пса", "псу", "пса", "псом", "псе"),
+    "орёл":    ("орёл", "орла", "орлу", "орла", "орлом", "орле"),
+    "осёл":    ("осёл", "осла", "ослу", "осла", "ослом", "осле"),
+    "козёл":   ("козёл", "козла", "козлу", "козла", "козлом", "козле"),
+    "дятел":   ("дятел", "дятла", "дятлу", "дятла", "дятлом", "дятле"),
+    "любовь":  ("любовь", "любви", "любви", "любовь", "любовью", "любви"),
+}
+
+def _match_case(forms, word: str):
+    return tuple(f[:1].upper() + f[1:] for f in forms) if word[:1].isupper() else forms
+
+def _noun_forms(w: str, animate: bool) -> Tuple[Tuple[str, ...], int]:
+    low = w.lower()
+    if low in _NOUN_EXCEPTIONS:
+        return _match_case(_NOUN_EXCEPTIONS[low], w), 1 if low.endswith("ь") else 0
+    last, stem = low[-1:], w[:-1]
+    if not low or not re.fullmatch(r"[а-яё-]+", low):
+        return (w,) * 6, 0
+    if low.endswith("ия"):
+        return (w, stem + "и", stem + "и", stem + "ю", stem + "ей", stem + "и"), 1
+    if last in "ая":
+        g = 0 if low in _MALE_A else 1
+        if last == "я": return (w, stem + "и", stem + "е", stem + "ю", stem + "ей", stem + "е"), g
+        gen = "и" if stem[-1:].lower() in "гкхжшчщ" else "ы"
+        ins = "ей" if stem[-1:].lower() in "жшчщц" else "ой"
+        return (w, stem + gen, stem + "е", stem + "у", stem + ins, stem + "е"), g
+    if last in "оеё" and w[:1].islower():
+        # средний род: солнышко, чудище, создание
+        ins, prep = ("ем", "и") if low.endswith("ие") else (("ем", "е") if last == "е" else ("ом", "е"))
+        gen, dat = ("я", "ю") if low.endswith("ие") else ("а", "у")
+        return (w, stem + gen, stem + dat, w, stem + ins, stem + prep), 0
+    if last in _RU_VOWELS:
+        # несклоняемые: пони, кенгуру, Буратино
+        return (w,) * 6, 0
+    if last == "ь":
+        if low in _FEM_SOFT or low.endswith(("сть", "знь", "щь", "чь", "шь", "жь")):
+            return (w, stem + "и", stem + "и", w, w + "ю", stem + "и"), 1
+        acc = stem + "я" if animate else w
+        return (w, stem + "я", stem + "ю", acc, stem + "ем", stem + "е"), 0
+    if last == "й":
+        if low.endswith("ий"):
+            return (w, stem + "я", stem + "ю", stem + "я" if animate else w, stem + "ем", stem + "и"), 0
+        if low.endswith("ей") and w[:1].islower() and len(low) > 4:
+            stem = w[:-2] + "ь"  # воробей → воробья, воробьём
+            return (w, stem + "я", stem + "ю", stem + "я" if animate else w, stem + "ём", stem + "е"), 0
+        return (w, stem + "я", stem + "ю", stem + "я" if animate else w, stem + "ем", stem + "е"), 0
+    base = w
+    if low.endswith("ок") and len(low) > 3 and low[-3] not in _RU_VOWELS:
+        base = w[:-2] + "к"                                      # щенок → щенка, котёнок → котёнка
+    elif low.endswith("ёк") and len(low) > 3:
+        base = w[:-2] + ("ь" if low[-3] in "лн" else "й" if low[-3] in _RU_VOWELS else "") + "к"  # огонёк → огонька
+    elif low.endswith("ец") and low not in _FLEET_EC_KEEP and len(low) > 3:
+        base = w[:-2] + "ц"                                      # скворец → скворца
+    ins = "ем" if base[-1:].lower() == "ц" else "ом"
+    return (w, base + "а", base + "у", base + "а" if animate else w, base + ins, base + "е"), 0
+
+def _adj_forms(w: str, animate: bool) -> Tuple[Tuple[str, ...], int]:
+    low, stem = w.lower(), w[:-2]
+    if low.endswith("яя"): return (w, stem + "ей", stem + "ей", stem + "юю", stem + "ей", stem + "ей"), 1
+    if low.endswith("ая"):
+        e = "ей" if low[-3:-2] in "жшчщ" else "ой"
+        return (w, stem + e, stem + e, stem + "ую", stem + e, stem + e), 1
+    if low.endswith("ое"): return (w, stem + "ого", stem + "ому", w, stem + "ым", stem + "ом"), 0
+    if low.endswith("ее"): return (w, stem + "его", stem + "ему", w, stem + "им", stem + "ем"), 0
+    hard = low.endswith(("ый", "ой")) or low[-3:-2] in "гкх"
+    o, i = ("о", "ы") if hard else ("е", "и")
+    if low.endswith("ий"): i = "и"
+    gen = stem + o + "го"
+    return (w, gen, stem + o + "му", gen if animate else w, stem + i + "м", stem + o + "м"), 0
+
+@functools.lru_cache(maxsize=4096)
+def ru_forms(phrase: str, animate: bool = True) -> Tuple[Tuple[str, ...], int]:
+    # (им., род., дат., вин., твор., предл.), род. «Маленький ёжик» → «маленького ёжика»; прилагательное
+    # перед существительным согласуем с ним. Что разобрать не получилось (несколько слов, цифры) — не склоняем.
+    words = phrase.split()
+    if len(words) == 1: return _noun_forms(words[0], animate)
+    if len(words) == 2 and re.search(r"(?:ый|ий|ой|ая|яя|ое|ее)$", words[0].lower()):
+        noun, g = _noun_forms(words[1], animate)
+        adj, ag = _adj_forms(words[0], animate)
+        if ag == 1: g = 1
+        return tuple(f"{a} {n}" for a, n in zip(adj, noun)), g
+    return (phrase,) * 6, _noun_forms(words[-1], animate)[1] if words else 0
+
+class _Tpl:
+    # Шаблон, заранее разложенный в четыре format-строки (род героя × род друга), и его длина в словах
+    # без слотов: при сборке длина предложения = static + слова подставленных значений, без разбора текста.
+    __slots__ = ("fmt", "static", "slots")
+
+    def __init__(self, src: str):
+        fmt = []
+        for hg in (0, 1):
+            for fg in (0, 1):
+                def field(m, hg=hg, fg=fg):
+                    cap, slot, case, halt, falt = m.groups()
+                    if slot: return "{%s%s%d}" % ("c" if cap else "", slot, _SLOT_CASES[slot][case])
+                    alts = (halt if halt is not None else falt).split("|")
+                    return alts[min(hg if halt is not None else fg, len(alts) - 1)]
+                fmt.append(_TPL_RE.sub(field, src))
+        self.fmt = tuple(fmt)
+        self.static = tuple(word_count_ru(re.sub(r"\{\w+\}", " ", f)) for f in fmt)
+        self.slots = tuple(m.group(2) for m in _TPL_RE.finditer(src) if m.group(2))
+
+    def render(self, vals: Dict[str, str], g: int) -> str:
+        return self.fmt[g].format_map(vals)
+
+    def words(self, wc: Dict[str, int], g: int) -> int:
+        return self.static[g] + sum(wc[s] for s in self.slots)
+
+@functools.lru_cache(maxsize=4096)
+def _slot_table(slot: str, forms: Tuple[str, ...]) -> Tuple[Dict[str, str], int]:
+    vals = {}
+    for i, v in enumerate(forms):
+        vals[f"{slot}{i}"] = v; vals[f"c{slot}{i}"] = v[:1].upper() + v[1:]
+    return vals, word_count_ru(forms[0])
+
+def _slot_vals(vals: Dict[str, str], wc: Dict[str, int], slot: str, forms):
+    table, wc[slot] = _slot_table(slot, tuple(forms))
+    vals.update(table)
+
+# Общие для всех стилей части эпизода
+_STORY_SHARED = {
+    "trait": [
+        "{^H} был[|а] добр[ым|ой] и очень любопытн[ым|ой].",
+        "Все вокруг знали: {H} никогда не пройдёт мимо того, кому нужна помощь.",
+        "У {Hg} было доброе сердце и неугомонный характер.",
+        "{^H} любил[|а] задавать вопросы и слушать ответы до самого конца.",
+        "Больше всего на свете {H} любил[|а] новые дороги и старых друзей.",
+    ],
+    "arrive": [
+        "Вскоре {H} [пришёл|пришла] {Pt}.",
+        "Тропинка привела {Ha} {Pt}.",
+        "Следующая остановка была {Pw}.",
+        "{^Pw} было тихо и немного таинственно.",
+        "Немного погодя {H} [оказался|оказалась] {Pw}.",
+        "Дальше путь {Hg} лежал {Pt}.",
+    ],
+    "obstacle": [
+        "Путь {Hd} преградил глубокий овраг, и перебраться через него было не просто.",
+        "Поднялся холодный ветер, он мешал идти и путал все тропинки.",
+        "{^H} устал[|а]: идти было трудно, и на минутку е[му|й] показалось, что ничего не выйдет.",
+        "Самым трудным оказалось то, что никто не знал верной дороги.",
+        "Туман спрятал всё вокруг, и {H} долго не [мог|могла] понять, куда идти, — это было не просто.",
+        "На пути лежало поваленное дерево — настоящее препятствие: ни обойти, ни перелезть.",
+        "Начался дождь, тропинка стала скользкой, как лёд, и идти стало трудно.",
+        "Вдруг выяснилось, что мостик через ручей сломан, и это было настоящим препятствием.",
+        "Для {Hg} это было трудное испытание, но отступать [он|она] не хотел[|а].",
+        "Кто-то оставил на дороге большую корзину с шишками, и она мешала пройти.",
+        "Дверца, за которой начиналась дорога, никак не хотела открываться, — вот так препятствие!",
+        "Сил оставалось немного, а впереди ждал крутой и трудный подъём.",
+    ],
+    "meet": [
+        "Там {H} встретил[|а] {Fa}.",
+        "{^Pw} жил<|а> {F}, котор<ый|ая> всегда был<|а> рад<|а> гостям.",
+        "Из-за куста выглянул<|а> {F} и спросил<|а>, что случилось.",
+        "Неподалёку сидел<|а> {F} и с интересом смотрел<|а> на {Ha}.",
+        "На помощь поспешил<|а> {F}.",
+        "Вдруг {H} услышал[|а] знакомый голос — это был<|а> {F}.",
+    ],
+    "help": [
+        "{^F} предложил<|а> помощь, и вдвоём они придумали, как быть.",
+        "Вместе с {Fi} {H} [нашёл|нашла] выход.",
+        "{^F} показал<|а> {Hd} короткую тропинку.",
+        "«Не бойся, я рядом», — сказал<|а> {F}, и {Hd} стало спокойнее.",
+        "{^F} подсказал<|а>, что любую трудность легче одолеть по шагу.",
+        "{^H} и {F} взялись за дело вместе, и работа пошла быстрее.",
+        "{^F} поделил<ся|ась> с {Hi} своим секретом.",
+        "Пока {F} держал<|а> фонарик, {H} аккуратно [прошёл|прошла] опасное место.",
+    ],
+    "result": [
+        "{^H} [попробовал|попробовала] ещё раз — и на этот раз всё получилось.",
+        "Шаг за шагом дело пошло на лад.",
+        "Когда трудность осталась позади, {H} почувствовал[|а], как внутри стало тепло.",
+        "Оказалось, что вместе даже самое трудное становится простым.",
+        "{^H} поблагодарил[|а] {Fa} и [поделился|поделилась] с <ним|ней> своим угощением.",
+        "На прощание {F} помахал<|а> {Hd} лапкой.",
+        "Вскоре препятствие осталось позади, и дорога снова стала светлой.",
+    ],
+    "reflect": [
+        "«Вот что такое {M}», — подумал[|а] {H}.",
+        "{^H} запомнил[|а] этот урок про {Ma}.",
+        "Теперь {H} лучше понимал[|а], что значит {M}.",
+        "Так {H} снова увидел[|а], как много может {M}.",
+        "В сердце {Hg} стало ещё больше места для {Mg}.",
+    ],
+    "resolve": [
+        "К вечеру {H} вернул[ся|ась] домой, уставш[ий|ая], но счастлив[ый|ая].",
+        "В конце пути {H} понял[|а]: {M} живёт в поступках, а не в словах.",
+        "Итог этого дня был прост: когда делишься теплом, его становится больше.",
+        "{^H} понял[|а], что самые важные открытия делаются вместе с друзьями.",
+    ],
+    "close": [
+        "{^H} [лёг|легла] спать с улыбкой, и е[му|й] снились новые друзья.",
+        "А утром {H} уже придумывал[|а] новое доброе дело.",
+        "С тех пор, встречая друзей, {H} всегда рассказывал[|а] эту историю.",
+    ],
+    "moral": [
+        "Важно помнить: {M} делает мир теплее. Даже маленький добрый поступок меняет день.",
+        "Мораль проста: {M} сильнее любой трудности, если о ней не забывать.",
+        "Запомни: {M} начинается с малого — с улыбки, помощи и доброго слова.",
+    ],
+    "questions": [
+        "Что {H} понял[|а] про {Ma}?",
+        "Кто помог {Hd} в пути?",
+        "Что было самым трудным для {Hg}?",
+        "Как бы ты поступил(а) на месте {Hg}?",
+    ],
+    "friends": ["белка", "сова", "ёжик", "бобр", "заяц", "лиса", "барсук", "мышка", "воробей", "черепаха",
+                "олень", "енот", "крот", "синица", "медвежонок", "утка", "лягушка", "светлячок", "муравей", "дятел"],
+}
 
-def _local_story(age: int, hero: str, moral: str, target_band: Tuple[int,int], style: str, avoid: List[str]) -> Dict[str, Any]:
-    # Локальный разумный генератор: простая дуга «цель → попытки → развязка», 3–5 абзацев, целевая длина.
+# Своё для каждого стиля: начало, цель, детали эпизодов, кульминация, заголовки, места, предметы, особые друзья
+_STORY_STYLE_CORPUS = {
+    "классика": {
+        "open": ["[Жил-был|Жила-была] {H} на опушке большого леса.",
+                 "В одной тихой деревне жил[|а] {H}.",
+                 "Давным-давно, когда трава была выше облаков, жил[|а] на свете {H}."],
+        "goal": ["Однажды {H} решил[|а] найти {Oa}, чтобы порадовать всех вокруг.",
+                 "{^H} мечтал[|а] отыскать {Oa} и узнать, что на самом деле значит {M}.",
+                 "Как-то утром {H} решил[|а]: сегодня обязательно найду {Oa}!"],
+        "detail": ["Солнце грело спину, и в траве звенели кузнечики.",
+                   "Пахло мёдом и тёплым хлебом.",
+                   "Над головой плыли белые облака, похожие на добрых овечек.",
+                   "Где-то далеко пела иволга, словно подбадривая {Ha}.",
+                   "Ветер качал колоски и шептал старую песенку."],
+        "climax": ["И вот наконец {H} увидел[|а] {Oa}.",
+                   "Сердце {Hg} забилось быстрее: цель была совсем близко.",
+                   "Оставалось сделать последний, самый трудный шаг — и {H} его сделал[|а]."],
+        "title": ["{^H} и {On}", "Как {H} искал[|а] {Oa}", "{^H} и урок про {Ma}"],
+        "places": [("на лесной поляне", "на лесную поляну"), ("у старой мельницы", "к старой мельнице"),
+                   ("на берегу реки", "на берег реки"), ("в берёзовой роще", "в берёзовую рощу"),
+                   ("у тихого пруда", "к тихому пруду"), ("на краю деревни", "на край деревни"),
+                   ("в яблоневом саду", "в яблоневый сад"), ("на пригорке", "на пригорок")],
+        "objects": [("первый подснежник", "первого подснежника", "первый подснежник"),
+                    ("потерянная варежка", "потерянной варежки", "потерянную варежку"),
+                    ("самое красивое яблоко", "самого красивого яблока", "самое красивое яблоко"),
+                    ("тёплый шарф для бабушки", "тёплого шарфа для бабушки", "тёплый шарф для бабушки")],
+        "friends": ["петушок", "корова", "кот"],
+    },
+    "приключение": {
+        "open": ["{^H} с детства мечтал[|а] о настоящих приключениях.",
+                 "В рюкзаке у {Hg} всегда лежали верёвка, фонарик и компас.",
+                 "Утро выдалось ветреным — самое время отправиться в путь, решил[|а] {H}."],
+        "goal": ["Однажды {H} услышал[|а] легенду про {Oa} и решил[|а] отправиться на поиски.",
+                 "Цель была ясна: найти {Oa} и вернуться домой до заката.",
+                 "{^H} мечтал[|а] найти {Oa} — об этом рассказывали все путешественники."],
+        "detail": ["Компас уверенно показывал на север.",
+                   "{^H} сверил[ся|ась] с картой и поправил[|а] лямки рюкзака.",
+                   "Ветер свистел в ушах, а впереди ждали новые испытания.",
+                   "Фонарик выхватывал из темноты то корень, то камень.",
+                   "Где-то внизу шумела река, и её голос звал вперёд."],
+        "climax": ["На самой вершине {H} наконец увидел[|а] {Oa}.",
+                   "Последнее испытание было самым трудным, но {H} не отступил[|а].",
+                   "Эхо повторило радостный крик {Hg}: цель достигнута!"],
+        "title": ["Как {H} искал[|а] {Oa}", "Большое путешествие {Hg}", "{^H} и {On}"],
+        "places": [("у подножия Синей горы", "к подножию Синей горы"), ("в глубоком ущелье", "в глубокое ущелье"),
+                   ("на шатком мостике", "на шаткий мостик"), ("в пещере с эхом", "в пещеру с эхом"),
+                   ("на острове посреди озера", "на остров посреди озера"), ("в густых камышах", "в густые камыши"),
+                   ("на старом маяке", "на старый маяк"), ("у водопада", "к водопаду")],
+        "objects": [("старая карта", "старой карты", "старую карту"),
+                    ("сундучок с ключом", "сундучка с ключом", "сундучок с ключом"),
+                    ("Поющий камень", "Поющего камня", "Поющий камень"),
+                    ("золотое перо", "золотого пера", "золотое перо")],
+        "friends": ["горный козёл", "орёл", "выдра"],
+    },
+    "детектив": {
+        "open": ["{^H} был[|а] самым внимательным жителем во всей округе.",
+                 "У {Hg} были лупа, блокнот и привычка замечать мелочи.",
+                 "Никто не умел разгадывать загадки так, как {H}."],
+        "goal": ["Однажды утром обнаружилась пропажа: нигде не было {Og}, и {H} решил[|а] разобраться.",
+                 "{^H} решил[|а] во что бы то ни стало найти {Oa} и понять, что случилось.",
+                 "Соседи попросили {Ha} помочь, и цель была ясна: найти {Oa}."],
+        "detail": ["На земле {H} заметил[|а] странные следы.",
+                   "{^H} записал[|а] в блокнот новую подсказку.",
+                   "Лупа помогла разглядеть крошечную ниточку на ветке.",
+                   "Подсказки складывались, как кусочки мозаики.",
+                   "У двери лежало пёрышко — ещё одна улика."],
+        "climax": ["Все подсказки сложились вместе — и {H} всё понял[|а].",
+                   "Оказалось, что пропажу унёс ветер, и никто ни в чём не был виноват.",
+                   "Так {H} [нашёл|нашла] {Oa} и вернул[|а] хозяевам."],
+        "title": ["Загадка для {Hg}", "{^H} и пропажа", "Дело о пропаже: расследует {H}"],
+        "places": [("у старого дупла", "к старому дуплу"), ("на скрипучем чердаке", "на скрипучий чердак"),
+                   ("в библиотеке", "в библиотеку"), ("у почтового ящика", "к почтовому ящику"),
+                   ("на рыночной площади", "на рыночную площадь"), ("в сарае у мельника", "в сарай к мельнику"),
+                   ("у часовой башни", "к часовой башне"), ("в тёмном коридоре", "в тёмный коридор")],
+        "objects": [("бабушкин колокольчик", "бабушкиного колокольчика", "бабушкин колокольчик"),
+                    ("ключ от кладовой", "ключа от кладовой", "ключ от кладовой"),
+                    ("праздничный пирог", "праздничного пирога", "праздничный пирог"),
+                    ("письмо с печатью", "письма с печатью", "письмо с печатью")],
+        "friends": ["сорока", "пёс", "галка"],
+    },
+    "фантазия": {
+        "open": ["В стране, где по ночам светятся облака, жил[|а] {H}.",
+                 "{^H} жил[|а] там, где цветы умеют петь, а ручьи — смеяться.",
+                 "[Жил-был|Жила-была] {H}, и был[|а] [он|она] немножко волшебн[ым|ой]."],
+        "goal": ["Однажды {H} узнал[|а], что только {On} может вернуть в лес чудеса, и решил[|а] отправиться в путь.",
+                 "{^H} решил[|а] найти {Oa}, чтобы в мире стало больше света.",
+                 "Старая фея попросила {Ha} отыскать {Oa}, и {H} решил[|а] помочь."],
+        "detail": ["Вокруг кружились светлячки, рисуя в воздухе узоры.",
+                   "Листья шептали {Hd} добрые слова.",
+                   "С неба сыпались тихие звёздочки.",
+                   "Из травы выглядывали крошечные грибы в кружевных шляпках.",
+                   "Где-то звенели колокольчики, хотя ветра не было."],
+        "climax": ["И тут вокруг всё засияло: {H} [нашёл|нашла] {Oa}.",
+                   "Волшебство случилось, когда {H} поделил[ся|ась] теплом с другими.",
+                   "Лес вздохнул, и чудеса вернулись на свои места."],
+        "title": ["{^H} и {On}", "Волшебное путешествие {Hg}", "Как {H} вернул[|а] чудо"],
+        "places": [("в хрустальной пещере", "в хрустальную пещеру"), ("на облачном острове", "на облачный остров"),
+                   ("в саду говорящих цветов", "в сад говорящих цветов"), ("у волшебного колодца", "к волшебному колодцу"),
+                   ("в замке из ракушек", "в замок из ракушек"), ("на радужном мосту", "на радужный мост"),
+                   ("в лунном лесу", "в лунный лес"), ("у звёздного озера", "к звёздному озеру")],
+        "objects": [("лунный фонарик", "лунного фонарика", "лунный фонарик"),
+                    ("волшебное зёрнышко", "волшебного зёрнышка", "волшебное зёрнышко"),
+                    ("поющая ракушка", "поющей ракушки", "поющую ракушку"),
+                    ("радужное перо", "радужного пера", "радужное перо")],
+        "friends": ["дракончик", "фея", "единорог", "гном"],
+    },
+    "научпоп": {
+        "open": ["{^H} обожал[|а] задавать вопросы «почему?» и «как?».",
+                 "У {Hg} была маленькая тетрадка для наблюдений.",
+                 "[Жил-был|Жила-была] {H} — [юный исследователь|юная исследовательница]."],
+        "goal": ["Однажды {H} решил[|а] разгадать {Oa}.",
+                 "{^H} мечтал[|а] понять {Oa} и проверить всё на опыте.",
+                 "Цель была простая и важная: разобраться, в чём {On}."],
+        "detail": ["{^H} [провёл|провела] маленький опыт и записал[|а] результат.",
+                   "Оказалось, что свет, проходя через капли воды, распадается на цвета.",
+                   "Если крикнуть в пустую бочку, звук отражается и возвращается эхом.",
+                   "Тень становится длиннее, когда солнце опускается ниже.",
+                   "Лёгкие вещи держатся на воде, потому что вода их выталкивает."],
+        "climax": ["Все наблюдения сложились в одно простое правило.",
+                   "И тут {H} воскликнул[|а]: «Я понял[|а]!»",
+                   "Опыт подтвердил догадку {Hg}."],
+        "title": ["{^H} и {On}", "Маленькие открытия {Hg}", "Как {H} разгадал[|а] {Oa}"],
+        "places": [("у ручья", "к ручью"), ("в маленькой лаборатории", "в маленькую лабораторию"),
+                   ("на метеостанции", "на метеостанцию"), ("в теплице", "в теплицу"),
+                   ("на крыше с телескопом", "на крышу с телескопом"), ("у муравейника", "к муравейнику"),
+                   ("на берегу моря", "на берег моря"), ("в школьном кабинете", "в школьный кабинет")],
+        "objects": [("тайна радуги", "тайны радуги", "тайну радуги"),
+                    ("загадка эха", "загадки эха", "загадку эха"),
+                    ("секрет плавающей лодочки", "секрета плавающей лодочки", "секрет плавающей лодочки"),
+                    ("тайна тени", "тайны тени", "тайну тени")],
+        "friends": ["учёный кот", "филин", "учёная сова"],
+    },
+}
+
+def _compile_corpus(style: Dict[str, Any]) -> Dict[str, Any]:
+    c = {k: v for k, v in style.items() if k in ("places", "objects")}
+    c["friends"] = style["friends"] + _STORY_SHARED["friends"]
+    for k, v in list(_STORY_SHARED.items()) + list(style.items()):
+        if k not in ("places", "objects", "friends"): c[k] = [_Tpl(t) for t in v]
+    # средняя длина роли для оценки «сколько ещё эпизодов»: (слов при однословном герое, слотов героя)
+    typical = {"H": 1, "F": 1, "M": 1, "P": 3, "O": 2}
+    c["avg"] = {k: (sum(t.words(typical, 0) for t in ts) / len(ts), sum(t.slots.count("H") for t in ts) / len(ts))
+                for k, ts in c.items() if k not in ("places", "objects", "friends")}
+    return c
+
+LOCAL_CORPUS = {name: _compile_corpus(st) for name, st in _STORY_STYLE_CORPUS.items()}
+
+class _Deck:
+    # Шаблоны роли выдаются без повторов, пока колода не кончится; потом — новая перетасовка
+    # (и так, чтобы последний шаблон старой колоды не шёл сразу первым в новой)
+    __slots__ = ("items", "rng", "left", "last")
+    def __init__(self, items, rng):
+        self.items, self.rng, self.left, self.last = items, rng, [], None
+    def draw(self):
+        if not self.left:
+            self.left = list(self.items); self.rng.shuffle(self.left)
+            if len(self.left) > 1 and self.left[-1] is self.last: self.left[0], self.left[-1] = self.left[-1], self.left[0]
+        self.last = self.left.pop()
+        return self.last
+
+def _local_story(age: int, hero: str, moral: str, target_band: Tuple[int,int], style: str, avoid: List[str],
+                 seed: Optional[int] = None) -> Dict[str, Any]:
+    # Одинаковые параметры + seed → одна и та же сказка. Длина набирается эпизодами до цели внутри диапазона.
     hero  = hero or "герой"
     moral = moral or "доброта"
-    style_note = STORY_STYLES.get(style, STORY_STYLES["классика"])
+    style = style if style in LOCAL_CORPUS else "классика"
+    corpus, rng = LOCAL_CORPUS[style], random.Random(seed)
+    deck = {k: _Deck(v, rng) for k, v in corpus.items() if k not in ("places", "objects", "friends", "avg")}
+    rx = avoid_matcher(avoid).rx
+    own = hero.lower().split()[-1:]
+    friends = [f for f in corpus["friends"] if f.split()[-1] not in own and not (rx and rx.search(f))] or ["друг"]
+    rng.shuffle(friends)
+    places = list(corpus["places"]); rng.shuffle(places)
+    vals: Dict[str, str] = {}; wc: Dict[str, int] = {}
+    hforms, hg = ru_forms(hero)
+    _slot_vals(vals, wc, "H", hforms)
+    _slot_vals(vals, wc, "M", ru_forms(moral, False)[0])
+    _slot_vals(vals, wc, "O", rng.choice(corpus["objects"]))
+    g = 0
+
+    def scene(i: int):
+        nonlocal g
+        forms, fg = ru_forms(friends[i % len(friends)])
+        _slot_vals(vals, wc, "F", forms); _slot_vals(vals, wc, "P", places[i % len(places)])
+        g = hg * 2 + fg
+
+    lo, hi = target_band
+    target = rng.randint(lo + (hi - lo) // 4, hi - (hi - lo) // 4)
+    words, paras = 0, []
+
+    def para(roles):
+        nonlocal words
+        out = []
+        for role in roles:
+            t = deck[role].draw()
+            out.append(t.render(vals, g)); words += t.words(wc, g)
+        paras.append(out)
+        return out
+
+    def episode(i: int, short: bool):
+        scene(i)
+        para(("arrive", "obstacle", "meet", "help", "result") if short else
+             ("arrive", "detail", "obstacle", "meet", "help", "result", "reflect"))
+
+    scene(0)
+    para(("open", "trait", "goal"))
+    # кульминация и развязка (5 предложений) — по средней длине шаблонов; эпизод целиком — так же
+    avg = {r: n + h * (wc["H"] - 1) for r, (n, h) in corpus["avg"].items()}
+    tail = 2 * avg["climax"] + 2 * avg["resolve"] + avg["close"]
+    full = sum(avg[r] for r in ("arrive", "detail", "obstacle", "meet", "help", "result", "reflect"))
+    i = 0
+    while words + tail < target:
+        episode(i, target - words - tail < full * 0.7); i += 1
+    para(("climax", "climax"))
+    para(("resolve", "resolve", "close"))
+    # оценка хвоста могла промахнуться на несколько слов — поправляем по предложениям эпизодов, без филлера
+    while words > hi and i and len(paras[i]) > 3:
+        words -= word_count_ru(paras[i].pop(-2))
+    if words < lo:
+        ending = paras[-2:]; del paras[-2:]
+        while words < lo: episode(i, True); i += 1
+        paras.extend(ending)
+
+    text = _avoid_filter("\n\n".join(" ".join(p) for p in paras), avoid)
+    title = _avoid_filter(deck["title"].draw().render(vals, g), avoid)
+    questions = [_avoid_filter(t.render(vals, g), avoid) for t in corpus["questions"]]
+    moral_txt = _avoid_filter(deck["moral"].draw().render(vals, g), avoid)
+    return {"title": title, "text": text, "moral": moral_txt, "questions": questions,
+            "style_note": STORY_STYLES[style], "source": "local"}
+
+_usage = threading.local()
+
+def _count_usage(usage):
+    _usage.tokens = getattr(_usage, "tokens", 0) + (getattr(usage, "total_tokens", 0) or 0)
+    for kind in ("input", "output"):
+        n = getattr(usage, f"{kind}_tokens", 0) or 0
+        if n: metrics.inc("skazka_openai_tokens_total", n, kind=kind)
+
+class DeadlineExceeded(Exception):
+    pass
+
+class CircuitBreaker:
+    # closed — запросы идут; threshold ошибок/таймаутов за window секунд → open: сказки сразу пишет локальный
+    # генератор. Пока open, фоновый поток раз в cooldown (с удвоением до max_cooldown) делает пробный
+    # крошечный запрос; прошёл — снова closed. Поток свой, без event loop — работает и в процессах-воркерах.
+    def __init__(self, threshold: int, window: float, cooldown: float, max_cooldown: float, probe: Callable[[], Any]):
+        self.threshold, self.window, self.cooldown, self.max_cooldown, self.probe = threshold, window, cooldown, max_cooldown, probe
+        self.lock = threading.Lock(); self.fails: deque = deque()
+        self.state = "closed"; self.trips = 0
+
+    def allow(self) -> bool:
+        return self.state == "closed"
+
+    def record(self, ok: bool):
+        if ok: return
+        now = time.monotonic()
+        with self.lock:
+            if self.state != "closed": return
+            self.fails.append(now)
+            while self.fails and self.fails[0] < now - self.window: self.fails.popleft()
+            if len(self.fails) < self.threshold: return
+            self.state = "open"; self.trips += 1; self.fails.clear()
+        metrics.inc("skazka_breaker_trips_total")
+        print(f"[BREAKER] OpenAI недоступен ({self.threshold} ошибок за {self.window:g} с) — пишем локально")
+        threading.Thread(target=self._probe_loop, name="breaker-probe", daemon=True).start()
+
+    def _probe_loop(self):
+        delay = self.cooldown
+        while True:
+            time.sleep(delay)
+            try:
+                self.probe()
+            except Exception as e:
+                delay = min(delay * 2, self.max_cooldown)
+                print(f"[BREAKER] проба не прошла ({e!r}), следующая через {delay:g} с"); continue
+            with self.lock: self.state = "closed"; self.fails.clear()
+            print("[BREAKER] OpenAI снова отвечает"); return
+
+_call = threading.local()   # срок текущей сказки (time.monotonic), задаёт synthesize_story
+
+def story_budget(band: Tuple[int, int]) -> float:
+    return OA_BUDGET_BASE + band[1] * OA_BUDGET_PER_WORD
+
+def _time_left() -> Optional[float]:
+    deadline = getattr(_call, "deadline", None)
+    return None if deadline is None else deadline - time.monotonic()
+
+def _stage_timeout(stage: str) -> float:
+    t = OA_STAGE_TIMEOUT.get(stage, 30.0); left = _time_left()
+    if left is not None: t = min(t, left)
+    if t <= 0.05:
+        metrics.inc("skazka_openai_deadline_total", stage=stage); raise DeadlineExceeded(f"{stage}: бюджет сказки исчерпан")
+    return t
+
+_oa_pool: Optional[ThreadPoolExecutor] = None
+_stage_lat: Dict[str, deque] = {}
+_lat_lock = threading.Lock()
+
+def _oa_executor() -> ThreadPoolExecutor:
+    # запас потоков: запрос, который мы перестали ждать, досиживает в своём потоке до таймаута SDK
+    global _oa_pool
+    if _oa_pool is None:
+        _oa_pool = ThreadPoolExecutor(max_workers=GEN_CONCURRENCY * 3, thread_name_prefix="oa")
+    return _oa_pool
+
+def _hedge_delay(stage: str) -> Optional[float]:
+    if not OA_HEDGE: return None
+    with _lat_lock: xs = sorted(_stage_lat.get(stage, ()))
+    if len(xs) < 20: return None   # мало замеров — p95 ещё не знаем
+    return max(OA_HEDGE_MIN_DELAY, xs[int(0.95 * (len(xs) - 1))])
+
+def _oa_create(prompt: str, stage: str, **kw):
+    # Единая точка вызова модели. Запрос идёт в пуле _oa_executor, а ждём мы не дольше срока этапа
+    # (и остатка бюджета сказки) — что бы ни творилось с API, дольше срока поток генерации не висит.
+    # С OA_HEDGE=1, если ответа нет дольше p95 этапа, дублируем запрос и берём первый успешный ответ.
+    # Токены считаем здесь, в потоке сказки (по потоку — генерация сказки идёт в одном потоке).
+    timeout = _stage_timeout(stage)
+    call = functools.partial(oa_client.responses.create, model=OPENAI_MODEL_TEXT, input=prompt, timeout=timeout, **kw)
+    t0 = time.monotonic(); end = t0 + timeout; hedge = _hedge_delay(stage)
+    first = _oa_executor().submit(call); futs = [first]; hedged = False; err: Optional[BaseException] = None
+    while futs:
+        now = time.monotonic()
+        if now >= end: break
+        hedge_at = t0 + hedge if hedge is not None and not hedged else end
+        done, _ = wait_futures(futs, timeout=max(0.0, min(end, hedge_at) - now), return_when=FIRST_COMPLETED)
+        for f in done:
+            futs.remove(f)
+            if f.exception() is not None: err = f.exception(); continue
+            resp = f.result()
+            with _lat_lock: _stage_lat.setdefault(stage, deque(maxlen=200)).append(time.monotonic() - t0)
+            if hedged: metrics.inc("skazka_openai_hedges_total", stage=stage, won="first" if f is first else "second")
+            breaker.record(True); _count_usage(getattr(resp, "usage", None))
+            return resp
+        if futs and not hedged and hedge is not None and time.monotonic() >= hedge_at:
+            futs.append(_oa_executor().submit(call)); hedged = True
+    breaker.record(False)
+    if err is not None and not futs: raise err
+    metrics.inc("skazka_openai_deadline_total", stage=stage)
+    raise DeadlineExceeded(f"{stage}: нет ответа за {timeout:.1f} с")
+
+def _oa_stream(prompt: str, on_delta: Callable[[str], None], stage: str, **kw) -> str:
+    # Поток не дублируем (куски уже ушли в on_delta). Срок: таймаут SDK ограничивает паузы между кусками,
+    # а общий срок проверяем на каждом событии.
+    timeout = _stage_timeout(stage); end = time.monotonic() + timeout
+    parts: List[str] = []
+    try:
+        stream = oa_client.responses.create(model=OPENAI_MODEL_TEXT, input=prompt, stream=True, timeout=timeout, **kw)
+        try:
+            for ev in stream:
+                if time.monotonic() > end:
+                    metrics.inc("skazka_openai_deadline_total", stage=stage)
+                    raise DeadlineExceeded(f"{stage}: поток не уложился в {timeout:.1f} с")
+                if ev.type == "response.output_text.delta":
+                    parts.append(ev.delta); on_delta(ev.delta)
+                elif ev.type == "response.completed":
+                    _count_usage(getattr(ev.response, "usage", None))
+        finally:
+            close = getattr(stream, "close", None)
+            if close: close()
+    except Exception:
+        breaker.record(False); raise
+    breaker.record(True)
+    return "".join(parts)
 
-    def sent_pool():
-        starts = [
-            f"Жил-был {hero}, который решил понять, что такое {moral}.",
-            f"Однажды {hero} проснулся и загадал день, в котором {moral} станет видна.",
-            f"С раннего утра {hero} чувствовал, что сегодня научится замечать {moral}.",
-        ]
-        tries = [
-            f"{hero.capitalize()} помогал тем, кто рядом, и замечал, как меняется настроение.",
-            f"Иногда было трудно, но маленькие шаги давали смелость продолжать.",
-            f"Друзья поддерживали, и вместе они находили простые ответы.",
-            f"Каждая добрая мысль превращалась в тихое действие — и становилось светлее.",
-        ]
-        reveals = [
-            f"К вечеру {hero} понял: {moral} — это не слово, а поступок, который согревает.",
-            f"Возвращаясь домой, {hero} улыбался: {moral} живёт в заботе и внимании.",
-            f"Так {hero} запомнил: если делишься теплом, {moral} становится заметной для всех.",
-        ]
-        return starts, tries, reveals
-
-    start_pool, try_pool, reveal_pool = sent_pool()
-    paras = [random.choice(start_pool)]
-    paras += random.sample(try_pool, k=2)
-    paras.append(random.choice(try_pool))
-    paras.append(random.choice(reveal_pool))
-
-    # Сборка, затем расширение/сжатие под диапазон
-    text = "\n\n".join(paras)
-    text = clamp_to_band_locally(text, target_band)
-    text = _avoid_filter(text, avoid)
-
-    title = f"{hero.capitalize()} и урок про «{moral}»"
-    questions = [
-        f"Что {hero} понял про {moral}?",
-        "Какие шаги помогли героям продвинуться?",
-        "Где в истории чувствовалась дружба?",
-        "Как бы ты поступил(а) на месте героя?",
-    ]
-    moral_txt = f"Важно помнить: {moral}. Даже маленькое добро меняет день."
-    return {"title": title, "text": text, "moral": moral_txt, "questions": questions, "style_note": style_note}
+def _oa_probe():
+    resp = oa_client.responses.create(model=OPENAI_MODEL_TEXT, input="Ответь одним словом: да", max_output_tokens=16,
+                                      timeout=OA_STAGE_TIMEOUT["probe"])
+    _count_usage(getattr(resp, "usage", None))
+
+breaker = CircuitBreaker(BREAKER_THRESHOLD, BREAKER_WINDOW, BREAKER_COOLDOWN, BREAKER_MAX_COOLDOWN, probe=lambda: _oa_probe())
+
+def _take_usage() -> int:
+    tokens = getattr(_usage, "tokens", 0); _usage.tokens = 0
+    return tokens
 
 def _json_from_response(resp) -> Dict[str, Any]:
     try:
@@ -235,16 +1590,72 @@ def _json_from_response(resp) -> Dict[str, Any]:
     except Exception:
         return {}
 
-def synthesize_story(age: int, hero: str, moral: str, length: str, avoid: List[str], style: str) -> Dict[str, Any]:
-    band = LEN_BANDS.get((length or "").lower(), LEN_BANDS["средняя"])
-    hero  = hero or "герой"
-    moral = moral or "доброта"
-    style_note = STORY_STYLES.get(style, STORY_STYLES["классика"])
+MORAL_MARK, QUESTIONS_MARK = "МОРАЛЬ:", "ВОПРОСЫ:"
+
+def _draft_stream(prompt: str, on_draft: Callable[[str], None]) -> Dict[str, Any]:
+    # Черновик потоком: обычный текст с маркерами вместо JSON, чтобы куски можно было сразу показывать.
+    full = _oa_stream(prompt, on_draft, "draft")
+    text, _, tail = full.partition(MORAL_MARK)
+    moral_txt, _, qs = tail.partition(QUESTIONS_MARK)
+    questions = [re.sub(r"^\s*\d+[\).]\s*", "", q).strip() for q in qs.splitlines() if q.strip()]
+    return {"text": text.strip(), "moral": moral_txt.strip(), "questions": questions[:4]}
+
+class _JsonTextStream:
+    # Достаёт из потока JSON значение строкового поля field и отдаёт его раскодированным по кускам.
+    def __init__(self, field: str, out: Callable[[str], None]):
+        self.key_re = re.compile(re.escape(f'"{field}"') + r'\s*:\s*"'); self.out = out
+        self.buf = ""; self.pos = 0; self.state = "seek"   # seek → value → done
+
+    def feed(self, delta: str):
+        self.buf += delta
+        if self.state == "seek":
+            m = self.key_re.search(self.buf)
+            if not m: return
+            self.state, self.pos = "value", m.end()
+        if self.state != "value": return
+        i, buf, chunk = self.pos, self.buf, []
+        while i < len(buf):
+            c = buf[i]
+            if c == '"': self.state = "done"; break
+            if c == "\\":
+                if i + 1 >= len(buf): break
+                if buf[i + 1] == "u":
+                    if i + 6 > len(buf): break
+                    code = int(buf[i + 2:i + 6], 16)
+                    if 0xD800 <= code < 0xDC00:
+                        # эмодзи и прочее вне BMP — пара \uD8xx\uDCxx: ждём вторую половину и склеиваем
+                        nxt = buf[i + 6:i + 8]
+                        if i + 12 > len(buf) and "\\u".startswith(nxt): break
+                        low = int(buf[i + 8:i + 12], 16) if nxt == "\\u" else 0
+                        if 0xDC00 <= low < 0xE000:
+                            chunk.append(chr(0x10000 + (code - 0xD800) * 0x400 + low - 0xDC00)); i += 12; continue
+                        code = 0xFFFD
+                    elif 0xDC00 <= code < 0xE000:
+                        code = 0xFFFD   # одинокая половина пары в UTF-8 не кодируется
+                    chunk.append(chr(code)); i += 6; continue
+                chunk.append({"n": "\n", "t": "\t", "r": "", "b": "", "f": ""}.get(buf[i + 1], buf[i + 1])); i += 2; continue
+            chunk.append(c); i += 1
+        self.pos = i
+        if chunk: self.out("".join(chunk))
+
+STORY_SCHEMA = {
+    "type": "object", "additionalProperties": False,
+    "properties": {
+        "title": {"type": "string"},
+        "text": {"type": "string"},
+        "moral": {"type": "string"},
+        "questions": {"type": "array", "items": {"type": "string"}},
+    },
+    "required": ["title", "text", "moral", "questions"],
+}
+STORY_FORMAT = {"format": {"type": "json_schema", "name": "story", "schema": STORY_SCHEMA, "strict": True}}
 
-    # Если нет OpenAI — локальный генератор с контролем длины:
-    if not oa_client:
-        return _local_story(age, hero, moral, band, style, avoid)
+def _default_questions(hero: str, moral: str) -> List[str]:
+    return [f"Что {hero} понял про {moral}?", "Какие шаги помогли героям?",
+            "Где в истории дружба?", "Как бы ты поступил(а)?"]
 
+def _story_3stage(age: int, hero: str, moral: str, band: Tuple[int, int], style_note: str, avoid: List[str],
+                  on_draft: Optional[Callable[[str], None]]) -> Optional[Dict[str, Any]]:
     # 1) План
     try:
         prompt1 = f"""
@@ -253,12 +1664,12 @@ def synthesize_story(age: int, hero: str, moral: str, length: str, avoid: List[s
 Структура: завязка → 3–4 сцены (цель, препятствие, решение) → светлая развязка → чёткая мораль.
 Ответ строго JSON: {{"title":"...","scenes":[{{"name":"...","beats":["...","..."]}}]}}
 """
-        r1 = oa_client.responses.create(model=OPENAI_MODEL_TEXT, input=prompt1)
-        outline = _json_from_response(r1)
+        with span("outline"):
+            outline = _json_from_response(_oa_create(prompt1, "outline"))
         title = outline.get("title") or f"{hero.capitalize()} и урок про «{moral}»"
     except Exception as e:
-        print("[AI outline]", e)
-        return _local_story(age, hero, moral, band, style, avoid)
+        print("[AI outline]", repr(e)); metrics.inc("skazka_fallbacks_total", stage="outline")
+        return None
 
     # 2) Черновик по плану
     try:
@@ -270,76 +1681,394 @@ def synthesize_story(age: int, hero: str, moral: str, length: str, avoid: List[s
 - Язык: простой и тёплый, без взрослой лексики, без форм "(ась)/(ёл)".
 - Структура: 3–6 абзацев, каждый логически ведёт к следующему.
 - В конце блок "Мораль" (1–2 фразы) и 4 вопроса ребёнку.
-Ответ строго JSON: {{"text":"...","moral":"...","questions":["...","...","...","..."]}}
 """
-        r2 = oa_client.responses.create(model=OPENAI_MODEL_TEXT, input=prompt2)
-        draft = _json_from_response(r2)
-        text = draft.get("text","")
-        moral_txt = draft.get("moral") or f"Важно помнить: {moral}."
-        questions = draft.get("questions") or [
-            f"Что {hero} понял про {moral}?", "Какие шаги помогли героям?",
-            "Где в истории дружба?", "Как бы ты поступил(а)?"
-        ]
+        with span("draft"):
+            if on_draft:
+                prompt2 += (f"Ответ — обычный текст без JSON и без заголовка: сначала сказка абзацами, затем строка "
+                            f"«{MORAL_MARK}» и мораль, затем строка «{QUESTIONS_MARK}» и 4 вопроса, каждый с новой строки.\n")
+                draft = _draft_stream(prompt2, on_draft)
+            else:
+                prompt2 += 'Ответ строго JSON: {"text":"...","moral":"...","questions":["...","...","...","..."]}\n'
+                draft = _json_from_response(_oa_create(prompt2, "draft"))
     except Exception as e:
-        print("[AI draft]", e)
-        return _local_story(age, hero, moral, band, style, avoid)
+        print("[AI draft]", repr(e)); metrics.inc("skazka_fallbacks_total", stage="draft")
+        return None
+    return {"title": title, "text": draft.get("text", ""), "moral": draft.get("moral") or f"Важно помнить: {moral}.",
+            "questions": draft.get("questions") or _default_questions(hero, moral)}
+
+def _single_prompt(age: int, hero: str, moral: str, band: Tuple[int, int], style_note: str, avoid: List[str]) -> str:
+    return f"""
+Ты — детский писатель. Напиши связную сказку на русском для ребёнка {age} лет.
+Стиль: {style_note}. Герой: {hero}. Главная идея/мораль: {moral}. Тем избегать: {", ".join(avoid) or "нет"}.
+Сначала мысленно составь план: завязка → 3–4 сцены (цель, препятствие, решение) → светлая развязка → чёткая мораль.
+Требования:
+- Объём текста: {band[0]}–{band[1]} слов, соблюдай диапазон.
+- Язык: простой и тёплый, без взрослой лексики, без форм "(ась)/(ёл)".
+- Структура: 3–6 абзацев, каждый логически ведёт к следующему.
+- moral — 1–2 фразы, questions — ровно 4 вопроса ребёнку.
+"""
 
-    # 3) Критика и правка (если вышли за диапазон или нарушены требования)
+def _single_story(data: Dict[str, Any], hero: str, moral: str) -> Dict[str, Any]:
+    return {"title": data.get("title") or f"{hero.capitalize()} и урок про «{moral}»", "text": data["text"],
+            "moral": data.get("moral") or f"Важно помнить: {moral}.",
+            "questions": data.get("questions") or _default_questions(hero, moral)}
+
+def _story_single(age: int, hero: str, moral: str, band: Tuple[int, int], style_note: str, avoid: List[str],
+                  on_draft: Optional[Callable[[str], None]]) -> Optional[Dict[str, Any]]:
+    # Один вызов: план держится «в голове» модели, ответ — строго по JSON-схеме (structured outputs).
+    prompt = _single_prompt(age, hero, moral, band, style_note, avoid)
+    try:
+        with span("single"):
+            if on_draft:
+                data = json.loads(_oa_stream(prompt, _JsonTextStream("text", on_draft).feed, "single", text=STORY_FORMAT) or "{}")
+            else:
+                data = _json_from_response(_oa_create(prompt, "single", text=STORY_FORMAT))
+    except Exception as e:
+        print("[AI single]", repr(e)); metrics.inc("skazka_fallbacks_total", stage="single")
+        return None
+    if not data.get("text"):
+        print("[AI single] пустой text"); metrics.inc("skazka_fallbacks_total", stage="single_empty")
+        return None
+    return _single_story(data, hero, moral)
+
+def _needs_revision(tm: TextMetrics, band: Tuple[int, int]) -> bool:
+    # вышли за диапазон или в сюжете нет цели героя / препятствий / развязки
+    return not tm.within(band) or not tm.plot_complete()
+
+def _revise(age: int, band: Tuple[int, int], story: Dict[str, Any]) -> Dict[str, Any]:
+    # Критика и правка (если вышли за диапазон или нарушены требования)
+    text, moral_txt, questions = story["text"], story["moral"], story["questions"]
     try:
-        needs_fix = False
-        if not within_band(text, band): needs_fix = True
-        # Мини-чеклист: должна быть цель героя, препятствия, развязка, явная мораль.
-        checklist = [
-            ("цель героя", re.search(r"хочет|решил|мечтал|цель", text, re.IGNORECASE)),
-            ("препятствие/трудности", re.search(r"трудн|препятств|не просто|мешал", text, re.IGNORECASE)),
-            ("развязка/вывод", re.search(r"к вечеру|в конце|понял|итог|вывод", text, re.IGNORECASE)),
-        ]
-        if any(v is None for _, v in checklist): needs_fix = True
-
-        if needs_fix:
-            prompt3 = f"""
+        prompt3 = f"""
 Отредактируй сказку для ребёнка {age} лет так, чтобы она была связной и в диапазоне {band[0]}–{band[1]} слов.
 Соблюдай: цель героя → препятствия → решения → светлая развязка + явная мораль.
 Сделай язык тёплым и простым. Не используй взрослые темы.
 Верни строго JSON {{"text":"...","moral":"...","questions":[...]}}, 4 вопроса обязательно.
 Исходный JSON: {json.dumps({"text": text, "moral": moral_txt, "questions": questions}, ensure_ascii=False)}
 """
-            r3 = oa_client.responses.create(model=OPENAI_MODEL_TEXT, input=prompt3)
-            data = _json_from_response(r3)
-            text = data.get("text", text)
-            moral_txt = data.get("moral", moral_txt)
-            questions = (data.get("questions") or questions)[:4]
+        with span("revise"):
+            data = _json_from_response(_oa_create(prompt3, "revise"))
+        text = data.get("text", text)
+        moral_txt = data.get("moral", moral_txt)
+        questions = (data.get("questions") or questions)[:4]
     except Exception as e:
-        print("[AI revise]", e)
+        print("[AI revise]", repr(e))
+    return dict(story, text=text, moral=moral_txt, questions=questions)
+
+# Режим конвейера: "3stage" — план → черновик → правка (как было), "single" — один вызов по JSON-схеме.
+# STORY_PIPELINE_BANDS переопределяет режим для отдельных длин: "короткая=single,длинная=3stage".
+STORY_PIPELINES = {"3stage": _story_3stage, "single": _story_single}
+STORY_PIPELINE = os.getenv("STORY_PIPELINE", "3stage")
+STORY_PIPELINE_BANDS = dict(kv.split("=", 1) for kv in os.getenv("STORY_PIPELINE_BANDS", "").replace(" ", "").split(",") if "=" in kv)
+
+def pipeline_mode(length: str) -> str:
+    mode = STORY_PIPELINE_BANDS.get(length, STORY_PIPELINE)
+    return mode if mode in STORY_PIPELINES else "3stage"
+
+# счётчики по (режим, длина): сколько сказок, сколько ушло на правку/в запасной генератор, секунды и токены
+_pipeline_lock = threading.Lock()
+_pipeline_stats: Dict[Tuple[str, str], Dict[str, float]] = {}
+
+def _record_pipeline(mode: str, length: str, seconds: float, tokens: int, revised: bool, fallback: bool):
+    metrics.observe("skazka_stage_seconds", seconds, stage="synthesize")
+    with _pipeline_lock:
+        st = _pipeline_stats.setdefault((mode, length), {"stories": 0, "revised": 0, "fallback": 0, "seconds": 0.0, "tokens": 0})
+        st["stories"] += 1; st["revised"] += revised; st["fallback"] += fallback
+        st["seconds"] += seconds; st["tokens"] += tokens
+
+def pipeline_stats() -> Dict[str, Dict[str, float]]:
+    with _pipeline_lock:
+        out = {}
+        for (mode, length), st in _pipeline_stats.items():
+            n = st["stories"] or 1
+            out[f"{mode}/{length}"] = dict(st, avg_seconds=round(st["seconds"] / n, 3), avg_tokens=round(st["tokens"] / n, 1),
+                                           revise_rate=round(st["revised"] / n, 4))
+        return out
+
+def synthesize_story(age: int, hero: str, moral: str, length: str, avoid: List[str], style: str,
+                     on_draft: Optional[Callable[[str], None]] = None, mode: Optional[str] = None) -> Dict[str, Any]:
+    # on_draft(кусок) — если задан, черновик пишется потоком и каждый кусок сразу уходит в колбэк
+    length = (length or "").lower(); length = length if length in LEN_BANDS else "средняя"
+    band = LEN_BANDS[length]
+    hero  = hero or "герой"
+    moral = moral or "доброта"
+    style_note = STORY_STYLES.get(style, STORY_STYLES["классика"])
+
+    # Если нет OpenAI или он сейчас «лежит» (предохранитель открыт) — локальный генератор с контролем длины:
+    if not oa_client or not breaker.allow():
+        if oa_client: metrics.inc("skazka_fallbacks_total", stage="breaker")
+        metrics.inc("skazka_stories_total", source="local")
+        return _local_story(age, hero, moral, band, style, avoid)
+
+    mode = mode if mode in STORY_PIPELINES else pipeline_mode(length)
+    t0, tok0 = time.perf_counter(), getattr(_usage, "tokens", 0)
+    _call.deadline = time.monotonic() + story_budget(band)
+    try:
+        return _synthesize_ai(mode, age, hero, moral, length, band, avoid, style, style_note, on_draft, t0, tok0)
+    finally:
+        _call.deadline = None
+
+def _synthesize_ai(mode: str, age: int, hero: str, moral: str, length: str, band: Tuple[int, int], avoid: List[str], style: str,
+                   style_note: str, on_draft: Optional[Callable[[str], None]], t0: float, tok0: int) -> Dict[str, Any]:
+    story = STORY_PIPELINES[mode](age, hero, moral, band, style_note, avoid, on_draft)
+    revised = False
+    if story is None:
+        _record_pipeline(mode, length, time.perf_counter() - t0, getattr(_usage, "tokens", 0) - tok0, False, True)
+        metrics.inc("skazka_stories_total", source="local")
+        return _local_story(age, hero, moral, band, style, avoid)
+    tm = TextMetrics(story["text"])
+    if _needs_revision(tm, band):
+        metrics.inc("skazka_revise_total", mode=mode, reason="band" if not tm.within(band) else "plot")
+        if (_time_left() or 0) >= OA_REVISE_MIN:
+            story = _revise(age, band, story); revised = True
+            tm = TextMetrics(story["text"])
+        else:
+            metrics.inc("skazka_revise_skipped_total")   # длинное всё равно урежет clamp_to_band_locally
 
     # Страховка по длине (локально)
-    text = clamp_to_band_locally(text, band)
-    text = _avoid_filter(text, avoid)
+    with span("postprocess"):
+        text = clamp_to_band_locally(tm, band)
+        text = _avoid_filter(text, avoid)
+    metrics.inc("skazka_stories_total", source="ai")
+    _record_pipeline(mode, length, time.perf_counter() - t0, getattr(_usage, "tokens", 0) - tok0, revised, False)
+
+    return {"title": story["title"], "text": text, "moral": story["moral"], "questions": story["questions"][:4], "source": "ai"}
+
+_gen_pool: Optional[ThreadPoolExecutor] = None
+
+def _gen_executor() -> ThreadPoolExecutor:
+    global _gen_pool
+    if _gen_pool is None:
+        _gen_pool = ThreadPoolExecutor(max_workers=GEN_CONCURRENCY, thread_name_prefix="gen")
+    return _gen_pool
+
+async def synthesize_story_async(age: int, hero: str, moral: str, length: str, avoid: List[str], style: str,
+                                 on_draft: Optional[Callable[[str], None]] = None) -> Dict[str, Any]:
+    # Синхронный клиент OpenAI уходит в пул потоков: пока пишется одна сказка, остальные чаты обслуживаются.
+    # Размер пула (GEN_CONCURRENCY) — глобальный лимит одновременных генераций, лишние ждут очереди.
+    loop = asyncio.get_running_loop()
+    call = functools.partial(synthesize_story, age, hero, moral, length, avoid=avoid, style=style, on_draft=on_draft)
+    return await loop.run_in_executor(_gen_executor(), call)
 
-    return {"title": title, "text": text, "moral": moral_txt, "questions": questions}
+# ──────────────────────────────────────────────────────────────────────────────
+# КЭШ ГОТОВЫХ СКАЗОК
+# ──────────────────────────────────────────────────────────────────────────────
+def _norm_word(s: str) -> str:
+    return re.sub(r"\s+", " ", (s or "").replace("ё", "е").replace("Ё", "Е")).strip().lower()
+
+def story_cache_key(age: int, hero: str, moral: str, length: str, avoid: List[str], style: str) -> Tuple:
+    length = (length or "").lower(); length = length if length in LEN_BANDS else "средняя"
+    style = style if style in STORY_STYLES else "классика"
+    avoid_n = tuple(sorted({_norm_word(a) for a in avoid or [] if a.strip()}))
+    return (int(age), _norm_word(hero or "герой"), _norm_word(moral or "доброта"), length, style, avoid_n)
+
+class StoryCache:
+    # На ключ — до STORY_CACHE_VARIANTS разных сказок; ключи вытесняются по LRU и по возрасту (TTL).
+    # Отдаём только вариант, которого пользователь ещё не видел; если видел всё — генерируем новый.
+    def __init__(self, max_keys: int, variants: int, ttl: float):
+        self.max_keys, self.variants, self.ttl = max_keys, variants, ttl
+        self.items: "OrderedDict[Tuple, List[Tuple[float, bytes, Dict[str, Any]]]]" = OrderedDict()
+        self.hits = self.misses = self.seen_skips = self.expired = self.evictions = 0
+        self.lock = threading.Lock()
+
+    def get(self, key: Tuple, seen: set) -> Optional[Dict[str, Any]]:
+        now = time.monotonic()
+        with self.lock:
+            bucket = self.items.get(key, [])
+            fresh = [v for v in bucket if now - v[0] <= self.ttl]
+            self.expired += len(bucket) - len(fresh)
+            if fresh: self.items[key] = fresh; self.items.move_to_end(key)
+            elif key in self.items: del self.items[key]
+            unseen = [v for v in fresh if v[1] not in seen]
+            if not unseen:
+                self.misses += 1
+                if fresh: self.seen_skips += 1
+                return None
+            self.hits += 1
+            return dict(random.choice(unseen)[2])
+
+    def put(self, key: Tuple, story: Dict[str, Any]):
+        if not self.max_keys: return
+        with self.lock:
+            bucket = self.items.setdefault(key, []); self.items.move_to_end(key)
+            d = StoryArchive.digest_of(story)
+            if any(v[1] == d for v in bucket): return
+            bucket.append((time.monotonic(), d, dict(story)))
+            del bucket[:-self.variants]
+            while len(self.items) > self.max_keys:
+                self.items.popitem(last=False); self.evictions += 1
+
+    def fresh_count(self, key: Tuple) -> int:
+        now = time.monotonic()
+        with self.lock: return sum(1 for v in self.items.get(key, []) if now - v[0] <= self.ttl)
+
+    def stats(self) -> Dict[str, Any]:
+        with self.lock:
+            total = self.hits + self.misses
+            return {"hits": self.hits, "misses": self.misses, "hit_rate": round(self.hits / total, 4) if total else 0.0,
+                    "seen_skips": self.seen_skips, "expired": self.expired, "evictions": self.evictions,
+                    "keys": len(self.items), "variants": sum(len(v) for v in self.items.values())}
+
+story_cache = StoryCache(STORY_CACHE_KEYS, STORY_CACHE_VARIANTS, STORY_CACHE_TTL)
+
+async def get_story_for_user(uid: int, age: int, hero: str, moral: str, length: str, avoid: List[str], style: str,
+                             on_draft: Optional[Callable[[str], None]] = None) -> Dict[str, Any]:
+    key = story_cache_key(age, hero, moral, length, avoid, style)
+    seen = _archive().digests(str(uid))
+    story = story_cache.get(key, seen)
+    metrics.inc("skazka_cache_requests_total", result="hit" if story else "miss")
+    if story: return story
+    story = await synthesize_story_async(age, hero, moral, length, avoid=avoid, style=style, on_draft=on_draft)
+    # локальный запасной генератор не кэшируем — он дешёвый, а место лучше отдать ответам модели
+    if story.get("source") == "ai": story_cache.put(key, story)
+    return story
 
 # ──────────────────────────────────────────────────────────────────────────────
-# PDF (без картинок)
+# ПРЕДГЕНЕРАЦИЯ (тихие часы → кэш готовых сказок)
 # ──────────────────────────────────────────────────────────────────────────────
-class StoryPDF(FPDF):
-    def header(self): pass
+# Частые запросы берём из архива историй (поле "params"), в тихие часы дописываем в StoryCache
+# недостающие варианты. Шаг length в /story затем отвечает из кэша без обращения к модели.
+_pregen = {"night": None, "spent": 0, "made": 0}
+
+def popular_story_params(top: int = PREGEN_TOP, days: int = PREGEN_LOOKBACK_DAYS, sample: int = 5000) -> List[Tuple[Dict[str, Any], int]]:
+    since = (msk_now() - timedelta(days=days)).isoformat()
+    counts: Counter = Counter(); example: Dict[Tuple, Dict[str, Any]] = {}
+    for st in _archive().recent(since, sample):
+        p = st.get("params")
+        if not p: continue
+        key = story_cache_key(p["age"], p["hero"], p["moral"], p["length"], p.get("avoid") or [], p["style"])
+        counts[key] += 1; example[key] = p
+    return [(example[k], n) for k, n in counts.most_common(top)]
+
+def _in_quiet_hours(now: datetime) -> bool:
+    try: a, b = (int(x) for x in PREGEN_HOURS.split("-", 1))
+    except Exception: return False
+    return a <= now.hour <= b if a <= b else (now.hour >= a or now.hour <= b)
+
+def _synthesize_counted(p: Dict[str, Any]) -> Tuple[Dict[str, Any], int]:
+    _take_usage()
+    story = synthesize_story(p["age"], p["hero"], p["moral"], p["length"], avoid=p.get("avoid") or [], style=p["style"])
+    return story, _take_usage()
+
+async def pregen_once(now: Optional[datetime] = None) -> int:
+    now = now or msk_now()
+    if not oa_client or PREGEN_TOKEN_BUDGET <= 0 or not _in_quiet_hours(now): return 0
+    night = (now - timedelta(hours=12)).date().isoformat()   # «ночь» не рвётся на полуночи
+    if _pregen["night"] != night: _pregen.update(night=night, spent=0, made=0)
+    loop = asyncio.get_running_loop(); made = 0
+    for p, _ in await asyncio.to_thread(popular_story_params):
+        key = story_cache_key(p["age"], p["hero"], p["moral"], p["length"], p.get("avoid") or [], p["style"])
+        while story_cache.fresh_count(key) < STORY_CACHE_VARIANTS:
+            if _pregen["spent"] >= PREGEN_TOKEN_BUDGET: return made
+            story, tokens = await loop.run_in_executor(_gen_executor(), _synthesize_counted, p)
+            _pregen["spent"] += tokens
+            if story.get("source") != "ai": return made     # модель недоступна — до следующего захода
+            story_cache.put(key, story); made += 1; _pregen["made"] += 1
+    return made
+
+async def archive_compact_loop():
+    # данные, удалённые через /delete, физически уходят из архива не позже чем через ARCHIVE_COMPACT_INTERVAL
+    while True:
+        await asyncio.sleep(ARCHIVE_COMPACT_INTERVAL)
+        try:
+            arc = _archive()
+            if arc.forgotten:
+                size = await asyncio.to_thread(arc.compact)
+                print(f"[ARCHIVE] сжат: {size} байт")
+        except Exception as e:
+            print("[ARCHIVE] compact:", repr(e))
+
+async def pregen_loop():
+    while True:
+        try:
+            made = await pregen_once()
+            if made: print(f"[PREGEN] +{made} сказок, токенов за ночь: {_pregen['spent']}/{PREGEN_TOKEN_BUDGET}")
+        except Exception as e:
+            print("[PREGEN]", e)
+        await asyncio.sleep(PREGEN_INTERVAL)
 
-def _ensure_unicode_fonts(pdf: FPDF) -> bool:
+# ──────────────────────────────────────────────────────────────────────────────
+# PDF (без картинок)
+# ──────────────────────────────────────────────────────────────────────────────
+@functools.lru_cache(maxsize=None)
+def _story_pdf_cls():
+    # класс — при первом рендере: import fpdf стоит ~0,3 с, а нужен он не на каждом старте
+    from fpdf import FPDF
+
+    class StoryPDF(FPDF):
+        def header(self): pass
+
+    return StoryPDF
+
+# Полные DejaVu (~1.4 МБ) разбираются fpdf при каждом add_font — это почти всё время рендера.
+# Поэтому один раз на процесс (и на диске — для всех процессов) строим копии шрифтов, урезанные
+# до символов, которые реально встречаются в сказках, и подключаем их. Если в тексте есть что-то
+# за пределами набора — берём полные шрифты, как раньше.
+PDF_CHARSET = frozenset(
+    [*range(0x20, 0x7F), *range(0xA0, 0x180), *range(0x370, 0x530),
+     *range(0x2000, 0x2070), *range(0x20A0, 0x20C0), *range(0x2100, 0x2200)]
+    + [ord(c) for c in "\n\r\t\u2212"]   # U+2212 — минус в листах математики
+)
+# набор поменялся — меняется и имя файла в кэше, старые урезанные шрифты не подхватятся
+_CHARSET_TAG = hashlib.blake2b(repr(sorted(PDF_CHARSET)).encode(), digest_size=4).hexdigest()
+_font_lock = threading.Lock()
+_subset_fonts: Dict[Path, Optional[Path]] = {}
+
+def _subset_font(src: Path) -> Optional[Path]:
+    with _font_lock:
+        if src in _subset_fonts: return _subset_fonts[src]
+        dst = None
+        try:
+            st = src.stat()
+            dst = FONT_CACHE_DIR / f"{src.stem}-{st.st_size}-{int(st.st_mtime)}-{_CHARSET_TAG}.ttf"
+            if not dst.exists():
+                from fontTools import subset, ttLib
+                import logging; logging.getLogger("fontTools.subset").setLevel(logging.ERROR)
+                font = ttLib.TTFont(str(src), recalcTimestamp=False)
+                opts = subset.Options(notdef_outline=True, recommended_glyphs=True, name_IDs=["*"])
+                sub = subset.Subsetter(opts); sub.populate(unicodes=PDF_CHARSET); sub.subset(font)
+                FONT_CACHE_DIR.mkdir(parents=True, exist_ok=True)
+                tmp = dst.with_name(f"{dst.name}.{os.getpid()}.tmp"); font.save(str(tmp)); os.replace(tmp, dst)
+        except Exception as e:
+            print(f"[PDF] subset font error ({src.name}): {e}")
+            dst = None
+        _subset_fonts[src] = dst
+        return dst
+
+def _ensure_unicode_fonts(pdf: FPDF, text: str = "") -> bool:
     try:
         if not (FONT_REG.exists() and FONT_BOLD.exists()):
             print("[PDF] TTF не найдены (fonts/DejaVuSans*.ttf)")
             return False
-        pdf.add_font(PDF_FONT,   "", str(FONT_REG),  uni=True)
-        pdf.add_font(PDF_FONT_B, "", str(FONT_BOLD), uni=True)
+        reg, bold = FONT_REG, FONT_BOLD
+        if all(ord(c) in PDF_CHARSET for c in set(text)):
+            reg, bold = _subset_font(FONT_REG) or FONT_REG, _subset_font(FONT_BOLD) or FONT_BOLD
+        pdf.add_font(PDF_FONT,   "", str(reg))
+        pdf.add_font(PDF_FONT_B, "", str(bold))
         return True
     except Exception as e:
         print(f"[PDF] font error: {e}")
         return False
 
-def render_story_pdf(path: Path, data: Dict[str, Any]):
-    pdf = StoryPDF(orientation="P", unit="mm", format="A4")
+# Ключ PDF — хэш содержимого сказки (как в архиве) и версия вёрстки. Даты в ключе нет: сказку из кэша
+# и повторную отправку на другой день шлём по сохранённому file_id, на титуле остаётся дата первой загрузки.
+PDF_LAYOUT = 1   # поменялась вёрстка — увеличить, старые file_id перестанут подходить
+
+def _pdf_date(data: Dict[str, Any]) -> str:
+    # дата на титуле — день, когда сказка написана (ts из истории), а не день повторной отправки
+    try: return datetime.fromisoformat(data["ts"]).astimezone(msk_tz()).strftime("%d.%m.%Y")
+    except Exception: return msk_now().strftime("%d.%m.%Y")
+
+def pdf_key(data: Dict[str, Any]) -> bytes:
+    return hashlib.blake2b(b"%d:" % PDF_LAYOUT + StoryArchive.digest_of(data), digest_size=16).digest()
+
+def _story_chars(data: Dict[str, Any]) -> str:
+    return "".join([data["title"], data["text"], data["moral"], *data["questions"][:4], "Мораль Вопросы Создано: 0123456789.)"])
+
+def _build_story_pdf(data: Dict[str, Any]) -> FPDF:
+    pdf = _story_pdf_cls()(orientation="P", unit="mm", format="A4")
     pdf.set_auto_page_break(auto=True, margin=15)
-    uni = _ensure_unicode_fonts(pdf)
+    uni = _ensure_unicode_fonts(pdf, _story_chars(data))
 
     # титул
     pdf.add_page()
@@ -355,7 +2084,7 @@ def render_story_pdf(path: Path, data: Dict[str, Any]):
 
     if uni: pdf.set_font(PDF_FONT, size=12)
     else:   pdf.set_font("Helvetica", size=12)
-    meta = f"Создано: {msk_now().strftime('%d.%m.%Y')}"
+    meta = f"Создано: {_pdf_date(data)}"
     pdf.ln(4); pdf.multi_cell(0, 8, meta, align="C")
 
     # текст
@@ -385,9 +2114,1051 @@ def render_story_pdf(path: Path, data: Dict[str, Any]):
     if uni: pdf.set_font(PDF_FONT, size=12)
     else:   pdf.set_font("Helvetica", size=12)
     for i, q in enumerate(data["questions"][:4], 1):
-        pdf.multi_cell(0, 7, f"{i}) {q}")
+        pdf.multi_cell(0, 7, f"{i}) {q}", new_x="LMARGIN", new_y="NEXT")
+
+    return pdf
+
+def render_story_pdf(path: Path, data: Dict[str, Any]):
+    _build_story_pdf(data).output(str(Path(path)))
+
+def render_story_pdf_bytes(data: Dict[str, Any]) -> bytes:
+    return bytes(_build_story_pdf(data).output())
+
+# Рендер — чистая CPU-работа, поэтому в отдельных процессах: event loop и GIL основного процесса свободны.
+# Если пул умер (упал воркер), пробуем пересоздать его один раз, а дальше рендерим в потоке.
+_pdf_pool: Optional[ProcessPoolExecutor] = None
+_pdf_pool_broken = False
+_pdf_pool_lock = threading.Lock()   # пул создаёт и event loop, и поток прогрева
+
+def _pdf_executor() -> Optional[ProcessPoolExecutor]:
+    global _pdf_pool
+    with _pdf_pool_lock:
+        if _pdf_pool is None and PDF_WORKERS and not _pdf_pool_broken:
+            _pdf_pool = ProcessPoolExecutor(max_workers=PDF_WORKERS)
+        return _pdf_pool
+
+async def _in_pdf_pool(fn: Callable, *args):
+    global _pdf_pool, _pdf_pool_broken
+    loop = asyncio.get_running_loop()
+    for attempt in range(2):
+        pool = _pdf_executor()
+        if pool is None: break
+        try:
+            return await loop.run_in_executor(pool, fn, *args)
+        except BrokenProcessPool as e:
+            print(f"[PDF] пул процессов умер ({e}), попытка {attempt + 1}")
+            _pdf_pool = None; pool.shutdown(wait=False, cancel_futures=True)
+    if PDF_WORKERS and not _pdf_pool_broken:
+        _pdf_pool_broken = True; print("[PDF] рендер в потоке основного процесса")
+    return await asyncio.to_thread(fn, *args)
+
+async def render_story_pdf_async(data: Dict[str, Any]) -> bytes:
+    return await _in_pdf_pool(render_story_pdf_bytes, data)
+
+# Отправка PDF. Известен file_id документа с тем же ключом — шлём его: ни рендера, ни загрузки.
+# Telegram отверг file_id (другой бот, устарел) — рендерим и загружаем заново.
+async def send_story_pdf(bot, chat_id: int, data: Dict[str, Any], filename: str,
+                         known: Optional[Dict[str, Any]] = None, caption: Optional[str] = None) -> Dict[str, Any]:
+    from telegram import InputFile
+    from telegram.error import BadRequest
+    key = pdf_key(data).hex()
+    if known:
+        try:
+            with span("tg_resend"):
+                await _tg_call(bot.send_document, chat_id, known["file_id"], caption=caption)
+            metrics.inc("skazka_pdf_sends_total", how="file_id"); metrics.inc("skazka_pdf_bytes_total", known["size"], how="file_id")
+            return dict(known, key=key, uploaded=False)
+        except BadRequest as e:
+            print(f"[PDF] file_id не принят ({e}), загружаю заново")
+    with span("pdf_render"):
+        pdf_bytes = await render_story_pdf_async(data)
+    with span("tg_upload"):
+        msg = await _tg_call(bot.send_document, chat_id, InputFile(io.BytesIO(pdf_bytes), filename=filename), caption=caption)
+    metrics.inc("skazka_pdf_sends_total", how="upload"); metrics.inc("skazka_pdf_bytes_total", len(pdf_bytes), how="upload")
+    doc = getattr(msg, "document", None)
+    return {"key": key, "file_id": doc.file_id if doc else None, "size": len(pdf_bytes), "uploaded": True}
+
+def remember_pdf(data: Dict[str, Any], meta: Dict[str, Any]):
+    # только в процессе бота — архив принадлежит ему
+    if meta.get("uploaded") and meta.get("file_id"):
+        _archive().attach_file(bytes.fromhex(meta["key"]), StoryArchive.digest_of(data),
+                               {"file_id": meta["file_id"], "size": meta["size"]})
+
+async def deliver_story_pdf(bot, chat_id: int, data: Dict[str, Any], filename: str, caption: Optional[str] = None):
+    meta = await send_story_pdf(bot, chat_id, data, filename, _archive().file_of(pdf_key(data)), caption)
+    remember_pdf(data, meta)
+    return meta
+
+def shutdown_pools(wait: bool = False):
+    # wait=True — для CLI, который сразу завершает процесс: иначе atexit пула процессов пишет в закрытый канал
+    global _gen_pool, _pdf_pool, _oa_pool
+    if _pdf_pool: _pdf_pool.shutdown(wait=wait, cancel_futures=True); _pdf_pool = None
+    if _gen_pool: _gen_pool.shutdown(wait=wait, cancel_futures=True); _gen_pool = None
+    if _oa_pool: _oa_pool.shutdown(wait=wait, cancel_futures=True); _oa_pool = None
+
+# ──────────────────────────────────────────────────────────────────────────────
+# КНИГА: вся история пользователя одним PDF (/book)
+# ──────────────────────────────────────────────────────────────────────────────
+# fpdf держит документ в памяти до output(), а книга из тысяч сказок — это тысячи страниц. Поэтому здесь свой
+# маленький писатель PDF: страница уходит в файл, как только свёрстана, сказки читаются из архива по одной.
+# В памяти — текущая страница и по паре чисел на объект/главу в array (смещение; id и номер первой страницы).
+# Шрифты — те же урезанные DejaVu из кэша (_subset_font): метрики разбираются раз на процесс, в файл шрифт
+# встраивается один раз на книгу. Порядок страниц задаёт дерево /Pages, которое пишется последним, поэтому
+# титул и оглавление верстаются после глав (вторым проходом по архиву — заголовки не копятся), а стоят впереди.
+# Сколько страниц займёт оглавление, известно заранее — по числу сказок, так что номера страниц глав известны сразу.
+BOOK_W, BOOK_H = 595.28, 841.89     # A4, pt
+BOOK_MARGIN = 56.7                  # 20 мм
+BOOK_TOC_LEAD = 18.0
+
+class _BookFont:
+    def __init__(self, path: Path, name: str):
+        from fontTools import ttLib
+        f = ttLib.TTFont(str(path), lazy=True)
+        self.name, self.data = name, path.read_bytes()
+        k = 1000 / f["head"].unitsPerEm
+        order = f.getGlyphOrder(); hmtx = f["hmtx"]
+        self.widths = [round(hmtx[g][0] * k) for g in order]    # в 1/1000 кегля
+        gid = {g: i for i, g in enumerate(order)}
+        glyphs = {chr(cp): gid[g] for cp, g in f.getBestCmap().items()}
+        miss = glyphs.get("?", 0)
+        self.hex = {c: "%04X" % g for c, g in glyphs.items()}; self.hex_miss = "%04X" % miss
+        self.cw = {c: self.widths[g] for c, g in glyphs.items()}; self.cw_miss = self.widths[miss]
+        self.unicode: Dict[int, str] = {}
+        for c, g in glyphs.items(): self.unicode.setdefault(g, c)
+        self.ascent, self.descent = round(f["hhea"].ascent * k), round(f["hhea"].descent * k)
+        h = f["head"]; self.bbox = " ".join(str(round(v * k)) for v in (h.xMin, h.yMin, h.xMax, h.yMax))
+        self._words: Dict[str, int] = {}
+
+    def units(self, s: str) -> int:
+        # ширина в 1/1000 кегля; слова повторяются — держим их ширины (с потолком, чтобы память не росла)
+        w = self._words.get(s)
+        if w is None:
+            if len(self._words) > 5000: self._words.clear()
+            w = self._words[s] = sum(self.cw.get(c, self.cw_miss) for c in s)
+        return w
+
+    def encode(self, s: str) -> str:
+        return "".join(self.hex.get(c, self.hex_miss) for c in s)
+
+    def to_unicode(self) -> bytes:
+        pairs = [f"<{g:04X}> <{c.encode('utf-16-be').hex().upper()}>" for g, c in sorted(self.unicode.items())]
+        blocks = "".join(f"{len(b)} beginbfchar\n" + "\n".join(b) + "\nendbfchar\n" for b in (pairs[i:i + 100] for i in range(0, len(pairs), 100)))
+        return ("/CIDInit /ProcSet findresource begin\n12 dict begin\nbegincmap\n"
+                "/CIDSystemInfo << /Registry (Adobe) /Ordering (UCS) /Supplement 0 >> def\n"
+                "/CMapName /Adobe-Identity-UCS def\n/CMapType 2 def\n1 begincodespacerange\n<0000> <FFFF>\nendcodespacerange\n"
+                f"{blocks}endcmap\nCMapName currentdict /CMap defineresource pop\nend\nend\n").encode()
+
+@functools.lru_cache(maxsize=None)
+def _book_fonts() -> Tuple[_BookFont, _BookFont]:
+    if not (FONT_REG.exists() and FONT_BOLD.exists()): raise RuntimeError("нет шрифтов DejaVu (fonts/DejaVuSans*.ttf)")
+    return (_BookFont(_subset_font(FONT_REG) or FONT_REG, "DejaVuSans"),
+            _BookFont(_subset_font(FONT_BOLD) or FONT_BOLD, "DejaVuSans-Bold"))
+
+def _pdf_text(s: str) -> str:
+    return "<FEFF" + s.encode("utf-16-be").hex().upper() + ">"
+
+class _PdfWriter:
+    # объекты пишутся в файл сразу; в памяти — только их смещения для xref
+    def __init__(self, fh):
+        self.fh, self.offsets = fh, array("Q", [0])
+        fh.write(b"%PDF-1.7\n%\xe2\xe3\xcf\xd3\n")
+
+    def reserve(self, n: int = 1) -> int:
+        # n подряд идущих номеров объектов; возвращает первый
+        self.offsets.extend([0] * n); return len(self.offsets) - n
+
+    def put(self, body: Any, oid: Optional[int] = None) -> int:
+        oid = oid or self.reserve(); self.offsets[oid] = self.fh.tell()
+        self.fh.write(b"%d 0 obj\n" % oid + (body if isinstance(body, bytes) else body.encode()) + b"\nendobj\n")
+        return oid
+
+    def put_refs(self, head: str, ids, tail: str, oid: int):
+        # объект с длинным массивом ссылок (/Kids) — кусками, без сборки строки целиком
+        self.offsets[oid] = self.fh.tell(); self.fh.write(b"%d 0 obj\n%s" % (oid, head.encode()))
+        for i in range(0, len(ids), 1024): self.fh.write("".join(f"{k} 0 R " for k in ids[i:i + 1024]).encode())
+        self.fh.write(tail.encode() + b"\nendobj\n")
+
+    def put_stream(self, data: bytes, extra: str = "", oid: Optional[int] = None) -> int:
+        z = zlib.compress(data, 6)
+        return self.put(b"<< /Length %d /Filter /FlateDecode %s >>\nstream\n" % (len(z), extra.encode()) + z + b"\nendstream", oid)
+
+    def put_font(self, font: _BookFont) -> int:
+        ff = self.put_stream(font.data, f"/Length1 {len(font.data)}")
+        desc = self.put(f"<< /Type /FontDescriptor /FontName /{font.name} /Flags 32 /FontBBox [{font.bbox}] /ItalicAngle 0 "
+                        f"/Ascent {font.ascent} /Descent {font.descent} /CapHeight {font.ascent} /StemV 80 /FontFile2 {ff} 0 R >>")
+        cid = self.put(f"<< /Type /Font /Subtype /CIDFontType2 /BaseFont /{font.name} "
+                       f"/CIDSystemInfo << /Registry (Adobe) /Ordering (Identity) /Supplement 0 >> /FontDescriptor {desc} 0 R "
+                       f"/CIDToGIDMap /Identity /W [0 [{' '.join(map(str, font.widths))}]] >>")
+        tu = self.put_stream(font.to_unicode())
+        return self.put(f"<< /Type /Font /Subtype /Type0 /BaseFont /{font.name} /Encoding /Identity-H "
+                        f"/DescendantFonts [{cid} 0 R] /ToUnicode {tu} 0 R >>")
+
+    def finish(self, root: int, info: int):
+        xref = self.fh.tell(); n = len(self.offsets)
+        self.fh.write(b"xref\n0 %d\n0000000000 65535 f \n" % n)
+        for i in range(1, n, 1024): self.fh.write(b"".join(b"%010d 00000 n \n" % o for o in self.offsets[i:i + 1024]))
+        self.fh.write(b"trailer\n<< /Size %d /Root %d 0 R /Info %d 0 R >>\nstartxref\n%d\n%%%%EOF\n" % (len(self.offsets), root, info, xref))
+
+class _BookLayout:
+    # вёрстка: строки с переносом по словам и выравниванием по ширине, страница — в файл сразу по готовности
+    def __init__(self, w: _PdfWriter, fonts: Tuple[_BookFont, _BookFont], res: int, parent: int, number: int):
+        self.w, (self.reg, self.bold), self.res, self.parent = w, fonts, res, parent
+        self.number = number - 1; self.ids = array("I"); self.ops: Optional[List[str]] = None
+        self.annots: List[str] = []; self.width = BOOK_W - 2 * BOOK_MARGIN; self.y = 0.0; self.page_id = 0
+
+    def new_page(self, footer: bool = True):
+        self.end_page()
+        self.page_id = self.w.reserve(); self.number += 1
+        self.ops = []; self.annots = []; self.y = BOOK_H - BOOK_MARGIN
+        if footer:
+            s = str(self.number); x = (BOOK_W - self.reg.units(s) * 9 / 1000) / 2
+            self.ops.append(f"0.45 g BT /F1 9 Tf {x:.2f} {BOOK_MARGIN / 2:.2f} Td <{self.reg.encode(s)}> Tj ET 0 g")
+
+    def end_page(self):
+        if self.ops is None: return
+        c = self.w.put_stream("\n".join(self.ops).encode())
+        annots = f" /Annots [{' '.join(self.annots)}]" if self.annots else ""
+        self.w.put(f"<< /Type /Page /Parent {self.parent} 0 R /MediaBox [0 0 {BOOK_W} {BOOK_H}] /Resources {self.res} 0 R "
+                   f"/Contents {c} 0 R{annots} >>", self.page_id)
+        self.ids.append(self.page_id); self.ops = None
+
+    def _fid(self, font: _BookFont) -> str:
+        return "/F2" if font is self.bold else "/F1"
+
+    def text_at(self, x: float, y: float, s: str, font: _BookFont, size: float, gray: float = 0):
+        self.ops.append(f"{gray:g} g BT {self._fid(font)} {size:g} Tf {x:.2f} {y:.2f} Td <{font.encode(s)}> Tj ET")
+
+    def paragraph(self, text: str, font: _BookFont, size: float, lead: float, align: str = "J", gray: float = 0):
+        space = font.units(" "); limit = self.width * 1000 / size
+        line: List[str] = []; used = 0
+        for word in text.split():
+            wu = font.units(word)
+            if line and used + space + wu > limit:
+                self._line(line, used, font, size, lead, align, gray); line, used = [], 0
+            used += (space if line else 0) + wu; line.append(word)
+        if line: self._line(line, used, font, size, lead, "L" if align == "J" else align, gray)
+
+    def _line(self, words: List[str], used: int, font: _BookFont, size: float, lead: float, align: str, gray: float):
+        if self.y - lead < BOOK_MARGIN: self.new_page()
+        base = self.y - size * 0.93; x = BOOK_MARGIN; free = self.width * 1000 / size - used
+        if align == "C": x += free * size / 2000
+        if align == "J" and len(words) > 1:
+            # по ширине: TJ с поправкой после каждого пробела (Tw на двухбайтовых шрифтах не действует)
+            adj = -free / (len(words) - 1); sp = font.encode(" ")
+            body = f" {adj:.1f} ".join(f"<{font.encode(wd)}{sp if i < len(words) - 1 else ''}>" for i, wd in enumerate(words))
+            self.ops.append(f"{gray:g} g BT {self._fid(font)} {size:g} Tf {x:.2f} {base:.2f} Td [{body}] TJ ET")
+        else:
+            self.text_at(x, base, " ".join(words), font, size, gray)
+        self.y -= lead
+
+    def gap(self, pt: float):
+        self.y -= pt
+
+    def chapter(self, i: int, st: Dict[str, Any]):
+        self.paragraph(f"{i}. {st['title']}", self.bold, 16, 20, "L")
+        self.paragraph(_pdf_date(st), self.reg, 10, 14, "L", gray=0.45); self.gap(6)
+        for p in st["text"].split("\n\n"):
+            self.paragraph(p, self.reg, 12, 17); self.gap(4)
+        self.gap(6); self.paragraph("Мораль", self.bold, 13, 18, "L")
+        self.paragraph(st["moral"], self.reg, 12, 17); self.gap(6)
+        self.paragraph("Вопросы", self.bold, 13, 18, "L")
+        for k, q in enumerate(st["questions"][:4], 1): self.paragraph(f"{k}) {q}", self.reg, 12, 17, "L")
+
+def _toc_capacity() -> Tuple[int, int]:
+    # строк оглавления на первой странице (под заголовком) и на следующих
+    rows = int((BOOK_H - 2 * BOOK_MARGIN) // BOOK_TOC_LEAD)
+    return rows - 3, rows
+
+def _toc_pages(n: int) -> int:
+    first, rest = _toc_capacity()
+    return 1 + max(0, -(-(n - first) // rest))
+
+def _plural(n: int, one: str, few: str, many: str) -> str:
+    if n % 10 == 1 and n % 100 != 11: return one
+    return few if 2 <= n % 10 <= 4 and not 12 <= n % 100 <= 14 else many
+
+def render_book(path: Path, stories: Callable[[], Any], count: int, title: str = "Мои сказки") -> Dict[str, Any]:
+    # stories() — новый проход по сказкам от старых к новым (lambda: user_history(uid, None)); count — их число
+    # по индексу архива. Первый проход — главы, второй — оглавление и закладки.
+    fonts = _book_fonts(); reg, bold = fonts
+    tmp = path.with_name(path.name + ".tmp")
+    with open(tmp, "wb") as fh:
+        w = _PdfWriter(fh)
+        pages = w.reserve()
+        res = w.put(f"<< /Font << /F1 {w.put_font(reg)} 0 R /F2 {w.put_font(bold)} 0 R >> >>")
+        body = _BookLayout(w, fonts, res, pages, 2 + _toc_pages(count))
+        first_id, first_no = array("I"), array("I"); first_ts = last_ts = None
+        for i, st in enumerate(itertools.islice(stories(), count), 1):
+            body.new_page(); first_id.append(body.page_id); first_no.append(body.number)
+            body.chapter(i, st)
+            first_ts = first_ts or st.get("ts"); last_ts = st.get("ts")
+        body.end_page()
+        n = len(first_id)
+
+        # титул и оглавление — теперь, когда известны страницы глав
+        front = _BookLayout(w, fonts, res, pages, 1)
+        front.new_page(footer=False)
+        front.ops.append(f"0.922 0.941 1 rg 0 0 {BOOK_W} {BOOK_H} re f")
+        m = 8 * 72 / 25.4
+        front.ops.append(f"0.235 0.314 0.706 RG 3.4 w {m:.2f} {m:.2f} {BOOK_W - 2 * m:.2f} {BOOK_H - 2 * m:.2f} re S")
+        front.y = BOOK_H - 170
+        front.paragraph(title, bold, 30, 38, "C"); front.gap(10)
+        front.paragraph(f"{n} {_plural(n, 'сказка', 'сказки', 'сказок')}", reg, 14, 20, "C")
+        dates = " — ".join(dict.fromkeys(_pdf_date({"ts": t}) for t in (first_ts, last_ts) if t))
+        if dates: front.paragraph(dates, reg, 12, 18, "C", gray=0.3)
+        front.paragraph(f"Собрано: {msk_now().strftime('%d.%m.%Y')}", reg, 12, 18, "C", gray=0.3)
+
+        # второй проход: строка оглавления со ссылкой и закладка на каждую главу
+        outlines = w.reserve(); item0 = w.reserve(n) if n else 0
+        first, rest = _toc_capacity(); dot = reg.units(".") * 12 / 1000
+        it = itertools.islice(stories(), n)
+        for i in range(n):
+            st = next(it, None)
+            t = f"{i + 1}. {st['title'] if st else 'Сказка'}"
+            pid, num = first_id[i], str(first_no[i])
+            if i == 0 or (i >= first and (i - first) % rest == 0):
+                front.new_page()
+                if i == 0: front.paragraph("Оглавление", bold, 18, 3 * BOOK_TOC_LEAD, "L")
+            nw = reg.units(num) * 12 / 1000; label = t
+            while reg.units(label) * 12 / 1000 > front.width - nw - 4 * dot and len(label) > 4: label = label[:-2] + "…"
+            lw = reg.units(label) * 12 / 1000; base = front.y - 12 * 0.93
+            dots = "." * max(0, int((front.width - lw - nw - 2 * dot) / dot))
+            front.text_at(BOOK_MARGIN, base, label, reg, 12)
+            front.text_at(BOOK_MARGIN + front.width - nw - (len(dots) + 1) * dot, base, dots, reg, 12, gray=0.6)
+            front.text_at(BOOK_MARGIN + front.width - nw, base, num, reg, 12)
+            front.annots.append(f"<< /Type /Annot /Subtype /Link /Border [0 0 0] /Rect [{BOOK_MARGIN:.2f} {base - 4:.2f} "
+                                f"{BOOK_W - BOOK_MARGIN:.2f} {base + 12:.2f}] /Dest [{pid} 0 R /Fit] >>")
+            front.y -= BOOK_TOC_LEAD
+            link = (f" /Prev {item0 + i - 1} 0 R" if i else "") + (f" /Next {item0 + i + 1} 0 R" if i + 1 < n else "")
+            w.put(f"<< /Title {_pdf_text(t)} /Parent {outlines} 0 R{link} /Dest [{pid} 0 R /Fit] >>", item0 + i)
+        front.end_page()
+        w.put(f"<< /Type /Outlines /First {item0} 0 R /Last {item0 + n - 1} 0 R /Count {n} >>" if n
+              else "<< /Type /Outlines /Count 0 >>", outlines)
+
+        w.put_refs("<< /Type /Pages /Kids [", front.ids + body.ids, f"] /Count {len(front.ids) + len(body.ids)} >>", pages)
+        root = w.put(f"<< /Type /Catalog /Pages {pages} 0 R /Outlines {outlines} 0 R /PageMode /UseOutlines >>")
+        info = w.put(f"<< /Title {_pdf_text(title)} /Producer (bot_min) >>")
+        w.finish(root, info)
+        size = fh.tell()
+    os.replace(tmp, path)
+    return {"stories": n, "pages": len(front.ids) + len(body.ids), "bytes": size}
+
+# ──────────────────────────────────────────────────────────────────────────────
+# ОЧЕРЕДЬ ГЕНЕРАЦИЙ
+# ──────────────────────────────────────────────────────────────────────────────
+class QueueFull(Exception):
+    def __init__(self, reason: str):
+        super().__init__(reason); self.reason = reason   # "user" / "full"
+
+class GenTicket:
+    # Заявка на генерацию: async with ticket — дождаться своей очереди и занять место, на выходе — освободить.
+    def __init__(self, sched: "GenScheduler", uid: int):
+        self.sched, self.uid = sched, uid
+        self.started = asyncio.Event(); self.done = False
+
+    @property
+    def position(self) -> int:
+        return 0 if self.started.is_set() else self.sched.position(self)
+
+    async def wait(self, on_position: Optional[Callable[[int], Any]] = None):
+        # пока ждём — сообщаем номер в очереди (не чаще QUEUE_EDIT_INTERVAL и только если он изменился)
+        shown, last = None, 0.0
+        while not self.started.is_set():
+            pos = self.position
+            if on_position and pos != shown and time.monotonic() - last >= QUEUE_EDIT_INTERVAL:
+                shown, last = pos, time.monotonic()
+                try: await on_position(pos)
+                except Exception as e: print("[QUEUE position]", e)
+            changed = self.sched.changed
+            try: await asyncio.wait_for(changed.wait(), QUEUE_EDIT_INTERVAL)
+            except asyncio.TimeoutError: pass
+
+    async def __aenter__(self):
+        try:
+            await self.wait()
+        except BaseException:
+            self.sched.release(self); raise
+        return self
+
+    async def __aexit__(self, *exc):
+        self.sched.release(self)
+
+class GenScheduler:
+    # Все генерации идут через планировщик, живущий в event loop (без потоков — без замков):
+    # • не больше cap одновременно (= GEN_CONCURRENCY, размер пула потоков с вызовами модели);
+    # • у одного пользователя пишется не больше per_user сразу, заявок всего — не больше user_pending;
+    # • пользователи обслуживаются по кругу: после выдачи место пользователя в круге уходит в конец;
+    # • ждущих не больше max_queue — лишние получают отказ сразу, а не после минуты ожидания.
+    def __init__(self, cap: int, per_user: int, user_pending: int, max_queue: int):
+        self.cap, self.per_user, self.user_pending, self.max_queue = cap, per_user, user_pending, max_queue
+        self.waiting: "OrderedDict[int, List[GenTicket]]" = OrderedDict()   # порядок ключей — круг
+        self.running: Counter = Counter()
+        self.n_waiting = self.n_running = 0
+        self.served = self.rejected = 0
+        self.changed = asyncio.Event()
+
+    def submit(self, uid: int) -> GenTicket:
+        mine = len(self.waiting.get(uid, ())) + self.running[uid]
+        reason = "user" if mine >= self.user_pending else "full" if self.n_waiting >= self.max_queue and not self._free_for(uid) else None
+        if reason:
+            self.rejected += 1; metrics.inc("skazka_queue_rejected_total", reason=reason)
+            raise QueueFull(reason)
+        t = GenTicket(self, uid)
+        self.waiting.setdefault(uid, []).append(t); self.n_waiting += 1
+        self._dispatch()
+        return t
+
+    def _free_for(self, uid: int) -> bool:
+        # заявка стартует сразу, не занимая места в очереди
+        return self.n_running < self.cap and self.running[uid] < self.per_user and uid not in self.waiting
+
+    def _dispatch(self):
+        while self.n_running < self.cap:
+            uid = next((u for u in self.waiting if self.running[u] < self.per_user), None)
+            if uid is None: break
+            q = self.waiting.pop(uid); t = q.pop(0)
+            if q: self.waiting[uid] = q          # в конец круга
+            self.n_waiting -= 1; self.n_running += 1; self.running[uid] += 1; self.served += 1
+            t.started.set()
+        ev, self.changed = self.changed, asyncio.Event(); ev.set()
+
+    def release(self, t: GenTicket):
+        if t.done: return
+        t.done = True
+        if t.started.is_set():
+            self.n_running -= 1; self.running[t.uid] -= 1
+            if not self.running[t.uid]: del self.running[t.uid]
+        else:
+            q = self.waiting.get(t.uid, [])
+            if t in q:
+                q.remove(t); self.n_waiting -= 1
+                if not q: del self.waiting[t.uid]
+        self._dispatch()
+
+    def position(self, t: GenTicket) -> int:
+        # номер при обходе по кругу (1 — следующий); ограничение per_user не учитываем — это оценка
+        queues = [list(q) for q in self.waiting.values()]; n = 0
+        for depth in range(max(map(len, queues), default=0)):
+            for q in queues:
+                if depth < len(q):
+                    n += 1
+                    if q[depth] is t: return n
+        return 0
+
+    def stats(self) -> Dict[str, int]:
+        return {"waiting": self.n_waiting, "running": self.n_running, "users_waiting": len(self.waiting),
+                "served": self.served, "rejected": self.rejected}
+
+gen_scheduler = GenScheduler(GEN_CONCURRENCY, GEN_PER_USER, GEN_USER_PENDING, GEN_QUEUE_MAX)
+
+def _queue_full_text(reason: str) -> str:
+    return ("У вас уже пишутся сказки — дождитесь их 🙂" if reason == "user"
+            else "Сейчас очень много желающих послушать сказку. Попробуйте через пару минут 🙏")
+
+# ──────────────────────────────────────────────────────────────────────────────
+# ОЧЕРЕДЬ ЗАДАНИЙ ДЛЯ ВОРКЕРОВ (JOB_QUEUE=1)
+# ──────────────────────────────────────────────────────────────────────────────
+# Бот только кладёт задание и отвечает «вы №N в очереди». Процессы python bot_min.py worker [N] забирают
+# задания, пишут сказку и PDF и сами отправляют результат через Bot API. Задание берётся в аренду на
+# JOB_LEASE секунд: если воркер упал или перезапустился, по истечении аренды его задание заберёт другой.
+# Хранилище пользователей (JsonStore/кэш записей/индекс архива) живёт в одном процессе — поэтому готовые
+# и упавшие задания разбирает бот (счётчики, история, кэш сказок), а воркеры его не трогают.
+class JobQueue:
+    # queued → running → done / failed; done и failed бот забирает через collect() и удаляет.
+    def __init__(self, path: Path):
+        self.db = sqlite3.connect(str(path), check_same_thread=False, isolation_level=None, timeout=30)
+        self.lock = threading.Lock()
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute("CREATE TABLE IF NOT EXISTS jobs (id INTEGER PRIMARY KEY AUTOINCREMENT, uid INTEGER NOT NULL, "
+                        "chat_id INTEGER NOT NULL, msg_id INTEGER, payload TEXT NOT NULL, status TEXT NOT NULL DEFAULT 'queued', "
+                        "attempts INTEGER NOT NULL DEFAULT 0, worker TEXT, lease_until REAL, result TEXT, error TEXT, created REAL NOT NULL)")
+        self.db.execute("CREATE INDEX IF NOT EXISTS jobs_status ON jobs(status, id)")
+
+    @contextmanager
+    def _tx(self):
+        # BEGIN IMMEDIATE — сразу берём блокировку записи: проверка + изменение атомарны и между процессами
+        with self.lock:
+            self.db.execute("BEGIN IMMEDIATE")
+            try:
+                yield self.db
+            except BaseException:
+                self.db.execute("ROLLBACK"); raise
+            self.db.execute("COMMIT")
+
+    @staticmethod
+    def _row(cur, row) -> Dict[str, Any]:
+        job = dict(zip([c[0] for c in cur.description], row))
+        job["payload"] = json.loads(job["payload"])
+        job["result"] = json.loads(job["result"]) if job["result"] else None
+        return job
+
+    def enqueue(self, uid: int, chat_id: int, payload: Dict[str, Any], user_pending: int, max_queue: int) -> Tuple[int, int]:
+        # → (id, номер в очереди); лимиты проверяются в той же транзакции, что и вставка
+        with self._tx() as db:
+            mine = db.execute("SELECT COUNT(*) FROM jobs WHERE uid=? AND status IN ('queued','running')", (uid,)).fetchone()[0]
+            waiting = db.execute("SELECT COUNT(*) FROM jobs WHERE status='queued'").fetchone()[0]
+            reason = "user" if mine >= user_pending else "full" if waiting >= max_queue else None
+            if reason:
+                metrics.inc("skazka_queue_rejected_total", reason=reason); raise QueueFull(reason)
+            cur = db.execute("INSERT INTO jobs(uid, chat_id, payload, created) VALUES(?, ?, ?, ?)",
+                             (uid, chat_id, json.dumps(payload, ensure_ascii=False), time.time()))
+            return cur.lastrowid, waiting + 1
+
+    def set_message(self, job_id: int, msg_id: int):
+        # пока сообщения-заглушки нет, воркер задание не берёт: ему нечего править
+        with self.lock: self.db.execute("UPDATE jobs SET msg_id=? WHERE id=?", (msg_id, job_id))
+
+    def claim(self, worker: str, lease: float = JOB_LEASE, max_attempts: int = JOB_MAX_ATTEMPTS) -> Optional[Dict[str, Any]]:
+        # старейшее задание пользователя, у которого сейчас ничего не пишется; просроченная аренда — снова в работу
+        now = time.time()
+        with self._tx() as db:
+            db.execute("UPDATE jobs SET status='failed', error=COALESCE(error, 'аренда истекла') "
+                       "WHERE status='running' AND lease_until < ? AND attempts >= ?", (now, max_attempts))
+            cur = db.execute("SELECT * FROM jobs WHERE msg_id IS NOT NULL AND (status='queued' OR (status='running' AND lease_until < ?)) "
+                             "AND uid NOT IN (SELECT uid FROM jobs WHERE status='running' AND lease_until >= ?) ORDER BY id LIMIT 1",
+                             (now, now))
+            row = cur.fetchone()
+            if not row: return None
+            job = self._row(cur, row)
+            db.execute("UPDATE jobs SET status='running', worker=?, lease_until=?, attempts=attempts+1 WHERE id=?",
+                       (worker, now + lease, job["id"]))
+            job["attempts"] += 1
+            return job
+
+    def touch(self, job_id: int, lease: float = JOB_LEASE, result: Optional[Dict[str, Any]] = None):
+        # продлить аренду; result — промежуточный итог (готовая сказка), чтобы повтор не писал её заново
+        with self.lock:
+            self.db.execute("UPDATE jobs SET lease_until=?, result=COALESCE(?, result) WHERE id=? AND status='running'",
+                            (time.time() + lease, json.dumps(result, ensure_ascii=False) if result else None, job_id))
+
+    def finish(self, job_id: int, result: Dict[str, Any]):
+        with self.lock:
+            self.db.execute("UPDATE jobs SET status='done', result=?, lease_until=NULL WHERE id=?",
+                            (json.dumps(result, ensure_ascii=False), job_id))
+
+    def fail(self, job_id: int, error: str, retry: bool):
+        with self.lock:
+            self.db.execute("UPDATE jobs SET status=?, error=?, lease_until=NULL WHERE id=?",
+                            ("queued" if retry else "failed", error[-2000:], job_id))
+
+    def collect(self, limit: int = 100) -> List[Dict[str, Any]]:
+        with self.lock:
+            cur = self.db.execute("SELECT * FROM jobs WHERE status IN ('done','failed') ORDER BY id LIMIT ?", (limit,))
+            return [self._row(cur, r) for r in cur.fetchall()]
+
+    def remove(self, job_id: int):
+        with self.lock: self.db.execute("DELETE FROM jobs WHERE id=?", (job_id,))
+
+    def waiting(self, limit: int = 50) -> List[Tuple[int, int, int]]:
+        # (id, chat_id, msg_id) ждущих заданий в порядке очереди
+        with self.lock:
+            return self.db.execute("SELECT id, chat_id, msg_id FROM jobs WHERE status='queued' AND msg_id IS NOT NULL "
+                                   "ORDER BY id LIMIT ?", (limit,)).fetchall()
+
+    def status(self, job_id: int) -> Optional[str]:
+        with self.lock:
+            row = self.db.execute("SELECT status FROM jobs WHERE id=?", (job_id,)).fetchone()
+        return row[0] if row else None
+
+    def drop_orphans(self, older_than: float = 300) -> List[Dict[str, Any]]:
+        # бот упал между постановкой задания и ответом пользователю — такое задание некому показать
+        with self._tx() as db:
+            cur = db.execute("SELECT * FROM jobs WHERE msg_id IS NULL AND created < ?", (time.time() - older_than,))
+            rows = [self._row(cur, r) for r in cur.fetchall()]
+            db.execute("DELETE FROM jobs WHERE msg_id IS NULL AND created < ?", (time.time() - older_than,))
+        return rows
+
+    def stats(self) -> Dict[str, int]:
+        with self.lock:
+            counts = dict(self.db.execute("SELECT status, COUNT(*) FROM jobs GROUP BY status").fetchall())
+        return {k: counts.get(k, 0) for k in ("queued", "running", "done", "failed")}
+
+    def close(self):
+        with self.lock: self.db.close()
+
+jobs: Optional[JobQueue] = None
+
+def _jobs() -> JobQueue:
+    global jobs
+    if jobs is None: jobs = JobQueue(JOBS_DB_PATH)
+    return jobs
+
+async def _enqueue_story_job(update: Update, p: Dict[str, Any], moral: str, prof: Dict[str, Any], day: str):
+    uid = update.effective_user.id
+    params = {"age": p["age"], "hero": p["hero"], "moral": moral, "length": p["length"], "style": prof["style"], "avoid": prof["avoid"]}
+    payload: Dict[str, Any] = {"params": params, "day": day}
+    # подходящая сказка уже есть в кэше бота — воркеру остаётся только отправить её и PDF
+    cached = story_cache.get(story_cache_key(**params), _archive().digests(str(uid)))
+    metrics.inc("skazka_cache_requests_total", result="hit" if cached else "miss")
+    if cached:
+        payload["story"] = cached
+        # и PDF этой сказки, возможно, уже загружен — воркер пошлёт его по file_id
+        known = _archive().file_of(pdf_key(cached))
+        if known: payload["pdf_file"] = known
+    try:
+        job_id, pos = _jobs().enqueue(uid, update.effective_chat.id, payload, GEN_USER_PENDING, GEN_QUEUE_MAX)
+    except QueueFull as e:
+        release_daily_story(uid, day)
+        await update.effective_message.reply_text(_queue_full_text(e.reason)); return
+    placeholder = await update.effective_message.reply_text(_queue_text(pos))
+    _jobs().set_message(job_id, placeholder.message_id)
+
+def _record_job(job: Dict[str, Any]):
+    # учёт готового/упавшего задания — в процессе бота, единственном владельце хранилища
+    uid, pl = job["uid"], job["payload"]
+    if job["status"] == "done" and job["result"]:
+        data = dict(job["result"]); pdf_file = data.pop("pdf_file", None)
+        if pdf_file: remember_pdf(data, pdf_file)
+        inc_story_counters(uid, data["title"])
+        store_user_story(uid, data, params=pl["params"])
+        if data.get("source") == "ai" and "story" not in pl: story_cache.put(story_cache_key(**pl["params"]), data)
+    else:
+        print(f"[JOBS] задание {job['id']} не выполнено: {job.get('error')}")
+        release_daily_story(uid, pl["day"])
+
+async def job_results_loop(app: Application):
+    shown: Dict[int, int] = {}; last_pos = 0.0
+    while True:
+        try:
+            for job in _jobs().collect():
+                _record_job(job); _jobs().remove(job["id"]); shown.pop(job["id"], None)
+                if job["status"] != "done":
+                    try: await app.bot.send_message(job["chat_id"], FAILED_TEXT)
+                    except Exception as e: print("[JOBS notify]", e)
+            for job in _jobs().drop_orphans(): release_daily_story(job["uid"], job["payload"]["day"])
+            # «вы №N в очереди» — по мере продвижения, не чаще QUEUE_EDIT_INTERVAL
+            if time.monotonic() - last_pos >= QUEUE_EDIT_INTERVAL:
+                last_pos = time.monotonic()
+                for n, (job_id, chat_id, msg_id) in enumerate(_jobs().waiting(), 1):
+                    if shown.setdefault(job_id, n) == n or _jobs().status(job_id) != "queued": continue
+                    shown[job_id] = n
+                    try: await app.bot.edit_message_text(_queue_text(n), chat_id=chat_id, message_id=msg_id)
+                    except Exception as e: print("[JOBS position]", e)
+        except Exception as e:
+            print("[JOBS]", repr(e))
+        await asyncio.sleep(JOB_POLL)
+
+async def _run_job(bot, q: JobQueue, job: Dict[str, Any]) -> Dict[str, Any]:
+    from telegram import Message
+    p, chat_id = job["payload"]["params"], job["chat_id"]
+    first = Message.de_json({"message_id": job["msg_id"], "date": int(time.time()), "text": "",
+                             "chat": {"id": chat_id, "type": "private"}}, bot)
+    streamer = MessageStreamer(first)
+    data = job["result"] or job["payload"].get("story")
+    if not data:
+        await streamer.show(WRITING_TEXT)
+        with span("generate"):
+            data = await asyncio.to_thread(synthesize_story, p["age"], p["hero"], p["moral"], p["length"], p["avoid"], p["style"])
+        q.touch(job["id"], result=data)
+    with span("tg_text"):
+        await streamer.show(_story_message(data), parse_mode="HTML")
+    # file_id загруженного PDF возвращаем боту вместе со сказкой: в архив его пишет процесс бота
+    meta = await send_story_pdf(bot, chat_id, data, f"skazka_{job['uid']}.pdf", job["payload"].get("pdf_file"))
+    return dict(data, pdf_file=meta)
+
+async def worker_loop(name: str, bot=None, stop: Optional[asyncio.Event] = None):
+    # Один воркер — одно задание за раз; параллельность — числом процессов (и машин с общим JOBS_DB).
+    from telegram import Bot
+    q = JobQueue(JOBS_DB_PATH)
+    async with (bot or Bot(BOT_TOKEN)) as bot:
+        print(f"[WORKER {name}] жду задания в {JOBS_DB_PATH}")
+        while not (stop and stop.is_set()):
+            job = q.claim(name)
+            if not job:
+                await asyncio.sleep(JOB_POLL); continue
+            try:
+                q.finish(job["id"], await _run_job(bot, q, job))
+            except Exception as e:
+                retry = job["attempts"] < JOB_MAX_ATTEMPTS
+                print(f"[WORKER {name}] задание {job['id']} (попытка {job['attempts']}): {e!r}")
+                q.fail(job["id"], "".join(traceback.format_exception(None, e, e.__traceback__)), retry)
+    q.close()
+
+def _worker_main(i: int):
+    try:
+        asyncio.run(worker_loop(f"{os.uname().nodename}:{os.getpid()}"))
+    except KeyboardInterrupt:
+        pass
+
+def run_workers(n: int = JOB_WORKERS):
+    if BOT_TOKEN.startswith("ВСТАВЬ_"):
+        raise SystemExit("Сначала задайте BOT_TOKEN (переменная окружения).")
+    if n <= 1: return _worker_main(0)
+    import multiprocessing as mp
+    procs = [mp.Process(target=_worker_main, args=(i,), name=f"worker-{i}") for i in range(n)]
+    for pr in procs: pr.start()
+    try:
+        for pr in procs: pr.join()
+    except KeyboardInterrupt:
+        for pr in procs: pr.terminate()
+
+# ──────────────────────────────────────────────────────────────────────────────
+# ПАКЕТНЫЙ РЕЖИМ: python bot_min.py batch profiles.csv|.jsonl [каталог, по умолчанию <имя>_stories]
+# ──────────────────────────────────────────────────────────────────────────────
+# Сотни сказок для класса или праздника — без диалога /story. Вход — CSV с заголовком age,hero,moral,length,style,avoid
+# (и необязательным id) или JSONL с теми же полями; avoid — через «;» или «,». В каталоге результата: stories/<id>.json,
+# pdf/<id>.pdf и manifest.jsonl — по строке на готовую сказку. Повторный запуск после обрыва продолжает с того же места:
+# готовые по манифесту пропускаются, сказки без PDF только рендерятся. Файлы пишутся через .tmp + rename.
+# BATCH_API=async — synthesize_story, до GEN_CONCURRENCY сказок одновременно, PDF — в пуле процессов по мере готовности.
+# BATCH_API=files — как OpenAI Batch API: batch_input.jsonl (один запрос «single» на профиль) → batch_output.jsonl;
+# выполняет его LocalBatchAPI — локальная подмена сервиса пакетов (с ключом — те же запросы к модели, без ключа — _local_story).
+BATCH_API = os.getenv("BATCH_API", "async").lower()
+BATCH_PROGRESS_EVERY = 10.0   # с между строками прогресса
+
+def read_profiles(path: Path) -> List[Dict[str, Any]]:
+    import csv
+    with open(path, encoding="utf-8-sig", newline="") as f:
+        rows = [json.loads(l) for l in f if l.strip()] if path.suffix.lower() in (".jsonl", ".ndjson") else list(csv.DictReader(f))
+    profiles = []
+    for n, r in enumerate(rows, 1):
+        avoid = r.get("avoid") or []
+        if isinstance(avoid, str): avoid = [w.strip() for w in re.split(r"[;,]", avoid) if w.strip()]
+        avoid = [w for w in avoid if w.lower() not in {"нет", "no", "none"}]
+        length, style = str(r.get("length") or "").strip().lower(), str(r.get("style") or "").strip().lower()
+        profiles.append({"id": re.sub(r"[^\w.-]", "_", str(r.get("id") or f"{n:05d}")),
+                         "age": _safe_int(str(r.get("age") or ""), 6), "hero": str(r.get("hero") or "").strip() or "герой",
+                         "moral": str(r.get("moral") or "").strip() or "доброта",
+                         "length": length if length in LEN_BANDS else "средняя",
+                         "style": style if style in STORY_STYLES else "классика", "avoid": avoid})
+    dup = [k for k, v in Counter(p["id"] for p in profiles).items() if v > 1]
+    if dup: raise ValueError(f"повторяются id: {', '.join(dup[:5])}")
+    return profiles
+
+def _write_atomic(path: Path, data: bytes):
+    tmp = path.with_name(path.name + ".tmp"); tmp.write_bytes(data); os.replace(tmp, path)
+
+class BatchManifest:
+    # manifest.jsonl дописывается по строке; строка без ошибки — сказка и PDF на месте.
+    # Недописанная последняя строка (обрыв) при чтении пропускается и отделяется переводом строки.
+    def __init__(self, path: Path):
+        self.done: Dict[str, Dict[str, Any]] = {}
+        raw = path.read_bytes() if path.exists() else b""
+        for line in raw.splitlines():
+            try: rec = json.loads(line)
+            except ValueError: continue
+            if not rec.get("error"): self.done[rec["id"]] = rec
+        self.fh = open(path, "a", encoding="utf-8")
+        if raw and not raw.endswith(b"\n"): self.fh.write("\n")
+
+    def add(self, rec: Dict[str, Any]):
+        self.fh.write(json.dumps(rec, ensure_ascii=False) + "\n"); self.fh.flush()
+        if not rec.get("error"): self.done[rec["id"]] = rec
+
+    def close(self): self.fh.close()
+
+class LocalBatchAPI:
+    # Подмена сервиса пакетов OpenAI: читает входной файл в его формате ({custom_id, method, url, body}),
+    # выполняет запросы по concurrency штук и дописывает batch_output.jsonl ({custom_id, response{status_code, body}, error}).
+    # Уже выполненные custom_id при перезапуске не повторяются.
+    def __init__(self, concurrency: int = GEN_CONCURRENCY):
+        self.concurrency = concurrency
+
+    @staticmethod
+    def _execute(req: Dict[str, Any]) -> Dict[str, Any]:
+        body = req["body"]
+        if oa_client:
+            resp = oa_client.responses.create(**body); text = resp.output_text
+        else:
+            m = body["metadata"]
+            st = _local_story(int(m["age"]), m["hero"], m["moral"], LEN_BANDS[m["length"]], m["style"], json.loads(m["avoid"]))
+            text = json.dumps({k: st[k] for k in ("title", "text", "moral", "questions")}, ensure_ascii=False)
+        return {"object": "response", "status": "completed", "model": body["model"],
+                "output": [{"type": "message", "role": "assistant", "content": [{"type": "output_text", "text": text}]}]}
+
+    def run(self, input_path: Path, output_path: Path) -> Path:
+        done = set()
+        if output_path.exists():
+            for line in output_path.read_bytes().splitlines():
+                try: done.add(json.loads(line)["custom_id"])
+                except (ValueError, KeyError): pass
+        reqs = [r for r in map(json.loads, input_path.read_text("utf-8").splitlines()) if r["custom_id"] not in done]
+        lock = threading.Lock()
+        with open(output_path, "a", encoding="utf-8") as out:
+            def one(req):
+                try: res = {"response": {"status_code": 200, "body": self._execute(req)}, "error": None}
+                except Exception as e: res = {"response": {"status_code": 500, "body": {}}, "error": {"message": repr(e)}}
+                line = json.dumps({"id": f"batch_req_{req['custom_id']}", "custom_id": req["custom_id"], **res}, ensure_ascii=False)
+                with lock: out.write(line + "\n"); out.flush()
+            with ThreadPoolExecutor(max_workers=self.concurrency, thread_name_prefix="batch") as pool:
+                list(pool.map(one, reqs))
+        return output_path
+
+def _batch_request(p: Dict[str, Any]) -> Dict[str, Any]:
+    prompt = _single_prompt(p["age"], p["hero"], p["moral"], LEN_BANDS[p["length"]], STORY_STYLES[p["style"]], p["avoid"])
+    meta = {k: str(p[k]) for k in ("age", "hero", "moral", "length", "style")}
+    return {"custom_id": p["id"], "method": "POST", "url": "/v1/responses",
+            "body": {"model": OPENAI_MODEL_TEXT, "input": prompt, "text": STORY_FORMAT,
+                     "metadata": dict(meta, avoid=json.dumps(p["avoid"], ensure_ascii=False))}}
+
+def _batch_story(p: Dict[str, Any], res: Optional[Dict[str, Any]]) -> Dict[str, Any]:
+    # ответ пакета → сказка; правки вторым кругом нет — лишнюю длину и «избегать» выправляем локально, как после правки
+    band = LEN_BANDS[p["length"]]
+    try:
+        body = res["response"]["body"]
+        text = "".join(c.get("text", "") for o in body["output"] for c in o.get("content", []) if c.get("type") == "output_text")
+        story = _single_story(json.loads(text), p["hero"], p["moral"])
+    except Exception:
+        print(f"[BATCH] {p['id']}: ответа нет ({(res or {}).get('error')}), пишу локально")
+        return _local_story(p["age"], p["hero"], p["moral"], band, p["style"], p["avoid"])
+    text = _avoid_filter(clamp_to_band_locally(TextMetrics(story["text"]), band), p["avoid"])
+    return dict(story, text=text, questions=story["questions"][:4], source="ai" if oa_client else "local")
+
+async def run_batch(src: Path, out_dir: Path, api: str = BATCH_API, concurrency: int = GEN_CONCURRENCY) -> Dict[str, Any]:
+    profiles = read_profiles(src)
+    stories_dir, pdf_dir = out_dir / "stories", out_dir / "pdf"
+    stories_dir.mkdir(parents=True, exist_ok=True); pdf_dir.mkdir(exist_ok=True)
+    man = BatchManifest(out_dir / "manifest.jsonl")
+    todo = [p for p in profiles if p["id"] not in man.done or not (out_dir / man.done[p["id"]]["pdf"]).exists()]
+    stats = {"total": len(profiles), "skipped": len(profiles) - len(todo), "generated": 0, "rendered": 0, "failed": 0}
+    print(f"[BATCH] {src}: профилей {len(profiles)}, готово раньше {stats['skipped']}, осталось {len(todo)} (api={api})")
+    t0 = time.perf_counter(); last = [t0]
+
+    def story_path(p): return stories_dir / f"{p['id']}.json"
+    def save_story(p, story):
+        story = dict(story, ts=msk_now().isoformat(), params={k: p[k] for k in ("age", "hero", "moral", "length", "style", "avoid")})
+        _write_atomic(story_path(p), json.dumps(story, ensure_ascii=False, indent=1).encode()); stats["generated"] += 1
+        return story
+
+    def progress(force: bool = False):
+        now = time.perf_counter()
+        if not force and now - last[0] < BATCH_PROGRESS_EVERY: return
+        last[0] = now; mins = (now - t0) / 60
+        print(f"[BATCH] {stats['rendered']}/{len(todo)} готово, ошибок {stats['failed']}, "
+              f"{stats['rendered'] / mins if mins else 0:.1f} сказок/мин")
+
+    if api == "files":
+        # генерация одним пакетом: входной файл пересобирается только из профилей без сказки
+        need = [p for p in todo if not story_path(p).exists()]
+        if need:
+            inp, outp = out_dir / "batch_input.jsonl", out_dir / "batch_output.jsonl"
+            _write_atomic(inp, "".join(json.dumps(_batch_request(p), ensure_ascii=False) + "\n" for p in need).encode())
+            await asyncio.to_thread(LocalBatchAPI(concurrency).run, inp, outp)
+            results = {}
+            for line in outp.read_bytes().splitlines():
+                try: r = json.loads(line); results[r["custom_id"]] = r
+                except (ValueError, KeyError): pass
+            for p in need: save_story(p, _batch_story(p, results.get(p["id"])))
+
+    queue: asyncio.Queue = asyncio.Queue()
+    for p in todo: queue.put_nowait(p)
+
+    async def worker():
+        while not queue.empty():
+            p = queue.get_nowait(); t = time.perf_counter()
+            try:
+                if story_path(p).exists():
+                    story = json.loads(story_path(p).read_text("utf-8"))
+                else:
+                    story = save_story(p, await synthesize_story_async(p["age"], p["hero"], p["moral"], p["length"],
+                                                                       avoid=p["avoid"], style=p["style"]))
+                gen_s = time.perf_counter() - t
+                pdf = pdf_dir / f"{p['id']}.pdf"; tmp = pdf.with_name(pdf.name + ".tmp")
+                await _in_pdf_pool(render_story_pdf, tmp, story); os.replace(tmp, pdf)
+                man.add({"id": p["id"], "title": story["title"], "words": TextMetrics(story["text"]).words, "source": story.get("source"),
+                         "story": f"stories/{p['id']}.json", "pdf": f"pdf/{p['id']}.pdf", "pdf_bytes": pdf.stat().st_size,
+                         "gen_s": round(gen_s, 3), "pdf_s": round(time.perf_counter() - t - gen_s, 3)})
+                stats["rendered"] += 1
+            except Exception as e:
+                stats["failed"] += 1; print(f"[BATCH] {p['id']}: {e!r}")
+                man.add({"id": p["id"], "error": repr(e)})
+            progress()
 
-    pdf.output(str(Path(path)))
+    try:
+        await asyncio.gather(*(worker() for _ in range(max(1, concurrency))))
+    finally:
+        man.close()
+    wall = time.perf_counter() - t0
+    stats.update(seconds=round(wall, 2), stories_per_min=round(stats["rendered"] / wall * 60, 1) if wall else None)
+    progress(force=True)
+    print(f"[BATCH] итог: {stats} → {out_dir}")
+    return stats
+
+# ──────────────────────────────────────────────────────────────────────────────
+# МАТЕМАТИКА: листы примеров по возрасту (/math)
+# ──────────────────────────────────────────────────────────────────────────────
+# Уровень — по возрасту из профиля. Листы генерируются пачкой: с NumPy — векторно, тысячи листов за вызов
+# (numpy — в requirements.txt; если его нет, тот же алгоритм на random, лист за листом). На лист берём кандидатов с запасом,
+# повторы внутри листа (a + b и b + a — тоже повтор) отбрасываем, недобравшие листы тянем заново.
+# Один seed — те же листы (в пределах движка: у numpy и random разные ряды случайных чисел).
+MATH_OPS = ("+", "−", "×", ":")
+# уровень: (до какого возраста, веса + − × :, предел для + и −, множители × (a от, до, b от, до), деление (делитель от, до, частное от, до))
+# + — слагаемые от 1, сумма не больше предела; − — разность от 1; : — делимое = делитель × частное, всегда нацело
+MATH_LEVELS = {
+    1: (5,  (1, 1, 0, 0), 10,    None,            None),
+    2: (6,  (1, 1, 0, 0), 20,    None,            None),
+    3: (7,  (2, 2, 1, 0), 100,   (2, 5, 2, 10),   None),
+    4: (8,  (1, 1, 1, 1), 100,   (2, 9, 2, 10),   (2, 9, 2, 10)),
+    5: (10, (1, 1, 1, 1), 1000,  (2, 9, 11, 99),  (2, 9, 2, 20)),
+    6: (14, (1, 1, 2, 2), 10000, (11, 99, 2, 19), (2, 19, 2, 99)),
+}
+
+def math_level(age: int) -> int:
+    return next((lv for lv, spec in MATH_LEVELS.items() if age <= spec[0]), max(MATH_LEVELS))
+
+@functools.lru_cache(maxsize=None)
+def _numpy():
+    try:
+        import numpy
+        return numpy
+    except ImportError:
+        return None
+
+class MathSheets:
+    # пачка листов одного уровня: op, a, b, ans — n×k (массивы NumPy или списки списков)
+    __slots__ = ("level", "op", "a", "b", "ans")
+    def __init__(self, level: int, op, a, b, ans):
+        self.level, self.op, self.a, self.b, self.ans = level, op, a, b, ans
+
+    def __len__(self): return len(self.op)
+
+    def problems(self, i: int) -> List[Tuple[str, str]]:
+        row = [x[i].tolist() if hasattr(x[i], "tolist") else x[i] for x in (self.op, self.a, self.b, self.ans)]
+        return [(f"{a} {MATH_OPS[o]} {b} =", str(r)) for o, a, b, r in zip(*row)]
+
+def _math_draw_np(np, rng, level: int, n: int, m: int):
+    # n×m кандидатов: для каждой клетки считаем пару всех операций и берём свою — без циклов по задачам
+    _, w, lim, mul, div = MATH_LEVELS[level]
+    p = np.asarray(w, float); p /= p.sum()
+    op = rng.choice(4, size=(n, m), p=p).astype(np.int8)
+    u, v = rng.random((n, m)), rng.random((n, m))
+    def draw(lo, hi, x): return lo + (x * (hi - lo + 1)).astype(np.int64)   # равномерно на [lo, hi]
+    a = draw(1, lim - 1, u); b = draw(1, lim - a, v)
+    s = op == 1; a2 = draw(2, lim, u)
+    a, b = np.where(s, a2, a), np.where(s, draw(1, a2 - 1, v), b)
+    if mul:
+        s = op == 2; a, b = np.where(s, draw(mul[0], mul[1], u), a), np.where(s, draw(mul[2], mul[3], v), b)
+    if div:
+        s = op == 3; d = draw(div[0], div[1], u)
+        a, b = np.where(s, d * draw(div[2], div[3], v), a), np.where(s, d, b)
+    return op, a, b
+
+def _math_np(np, level: int, n: int, k: int, seed: Optional[int]) -> MathSheets:
+    rng = np.random.default_rng(seed)
+    op, a, b = np.empty((n, k), np.int8), np.empty((n, k), np.int64), np.empty((n, k), np.int64)
+    todo = np.arange(n)
+    while len(todo):
+        cop, ca, cb = _math_draw_np(np, rng, level, len(todo), 2 * k + 8)
+        comm = (cop == 0) | (cop == 2)
+        key = ((cop.astype(np.int64) << 40) | (np.where(comm, np.minimum(ca, cb), ca) << 20)
+               | np.where(comm, np.maximum(ca, cb), cb))
+        # первые вхождения ключей в строке: устойчивая сортировка, соседи в отсортированном — сравнить
+        order = np.argsort(key, axis=1, kind="stable")
+        sk = np.take_along_axis(key, order, 1)
+        new = np.ones(sk.shape, bool); new[:, 1:] = sk[:, 1:] != sk[:, :-1]
+        first = np.empty_like(new); np.put_along_axis(first, order, new, 1)
+        keep = first & (np.cumsum(first, 1) <= k)
+        ok = keep.sum(1) == k
+        pick = np.argsort(~keep, axis=1, kind="stable")[ok, :k]   # оставленные, в исходном порядке
+        rows = todo[ok]
+        op[rows], a[rows], b[rows] = (np.take_along_axis(x[ok], pick, 1) for x in (cop, ca, cb))
+        todo = todo[~ok]
+    ans = np.choose(op, [a + b, a - b, a * b, a // np.maximum(b, 1)])
+    return MathSheets(level, op, a, b, ans)
+
+def _math_py(level: int, n: int, k: int, seed: Optional[int]) -> MathSheets:
+    rng = random.Random(seed); _, w, lim, mul, div = MATH_LEVELS[level]
+    def draw(lo, hi, x): return lo + int(x * (hi - lo + 1))
+    out = ([], [], [], [])
+    for _ in range(n):
+        seen, rows = set(), ([], [], [], [])
+        while len(rows[0]) < k:
+            o = rng.choices(range(4), w)[0]; u, v = rng.random(), rng.random()
+            if o == 0:   a = draw(1, lim - 1, u); b = draw(1, lim - a, v); r = a + b
+            elif o == 1: a = draw(2, lim, u); b = draw(1, a - 1, v); r = a - b
+            elif o == 2: a = draw(mul[0], mul[1], u); b = draw(mul[2], mul[3], v); r = a * b
+            else:        b = draw(div[0], div[1], u); r = draw(div[2], div[3], v); a = b * r
+            key = (o, min(a, b), max(a, b)) if o in (0, 2) else (o, a, b)
+            if key in seen: continue
+            seen.add(key)
+            for lst, x in zip(rows, (o, a, b, r)): lst.append(x)
+        for lst, row in zip(out, rows): lst.append(row)
+    return MathSheets(level, *out)
+
+def make_math_sheets(level: int, n: int, k: int = MATH_PROBLEMS, seed: Optional[int] = None,
+                     engine: Optional[str] = None) -> MathSheets:
+    # engine: None — numpy, если установлен; "numpy" / "python" — явно (бенчмарк)
+    level = min(max(level, 1), max(MATH_LEVELS))
+    np = _numpy() if engine != "python" else None
+    if engine == "numpy" and np is None: raise RuntimeError("numpy не установлен")
+    return _math_np(np, level, n, k, seed) if np is not None else _math_py(level, n, k, seed)
+
+def make_math_sheet(age: int = 6, seed: Optional[int] = None) -> Tuple[List[str], List[str]]:
+    rows = make_math_sheets(math_level(age), 1, seed=seed).problems(0)
+    return [p for p, _ in rows], [r for _, r in rows]
+
+MATH_PDF_CHARS = "Математика · уровень Ответы Имя: Дата: _0123456789)=" + "".join(MATH_OPS)
+
+def _build_math_pdf(level: int, sheets: List[List[Tuple[str, str]]]) -> FPDF:
+    # на каждый лист две страницы: задания (с полями «Имя», «Дата») и ключ с ответами
+    pdf = _story_pdf_cls()(orientation="P", unit="mm", format="A4")
+    pdf.set_auto_page_break(False)
+    uni = _ensure_unicode_fonts(pdf, MATH_PDF_CHARS)
+    def font(bold: bool, size: int):
+        if uni: pdf.set_font(PDF_FONT_B if bold else PDF_FONT, size=size)
+        else:   pdf.set_font("Helvetica", style="B" if bold else "", size=size)
+    for rows in sheets:
+        per_col = (len(rows) + 1) // 2; step = min(18, 225 / per_col)
+        for key in (False, True):
+            pdf.add_page()
+            font(True, 20); pdf.set_xy(15, 18)
+            pdf.cell(0, 10, f"{'Ответы' if key else 'Математика'} · уровень {level}")
+            if not key:
+                font(False, 12); pdf.set_xy(15, 32)
+                pdf.cell(0, 8, "Имя: ________________________    Дата: ____________")
+            font(False, 16)
+            for i, (p, r) in enumerate(rows):
+                col, row = divmod(i, per_col)
+                pdf.set_xy(20 + col * 95, 50 + row * step)
+                pdf.cell(90, 10, f"{i + 1}) {p} {r if key else '______'}")
+    return pdf
+
+def render_math_pdf_bytes(level: int, sheets: List[List[Tuple[str, str]]]) -> bytes:
+    return bytes(_build_math_pdf(level, sheets).output())
+
+class MathSheetCache:
+    # Готовые листы (задания + PDF) на каждый уровень: /math берёт верхний и отвечает сразу, без генерации
+    # и вёрстки. Осталось меньше половины — пополняем в фоне: один вызов генератора на все недостающие листы,
+    # PDF — в пуле процессов.
+    def __init__(self, per_level: int):
+        self.per_level = per_level; self.lock = threading.Lock()
+        self.ready: Dict[int, deque] = {}; self.filling: set = set()
+        self.hits = self.misses = 0
+
+    def take(self, level: int) -> Optional[Tuple[List[Tuple[str, str]], bytes]]:
+        with self.lock:
+            q = self.ready.get(level)
+            if q: self.hits += 1; return q.popleft()
+            self.misses += 1; return None
+
+    def needs_fill(self, level: int) -> bool:
+        # True — вызывающий обязан позвать fill(level): уровень помечен, второго пополнения не будет
+        with self.lock:
+            if not self.per_level or level in self.filling or len(self.ready.get(level, ())) > self.per_level // 2:
+                return False
+            self.filling.add(level); return True
+
+    def fill(self, level: int):
+        # из потока (прогрев, asyncio.to_thread)
+        try:
+            with self.lock: need = self.per_level - len(self.ready.get(level, ()))
+            if need <= 0: return
+            batch = make_math_sheets(level, need)
+            rows = [batch.problems(i) for i in range(need)]
+            pdfs = None; pool = _pdf_executor()
+            if pool:
+                try: pdfs = list(pool.map(render_math_pdf_bytes, [level] * need, [[r] for r in rows]))
+                except BrokenProcessPool as e: print(f"[MATH] пул PDF недоступен ({e}), вёрстка в потоке")
+            if pdfs is None: pdfs = [render_math_pdf_bytes(level, [r]) for r in rows]
+            with self.lock: self.ready.setdefault(level, deque()).extend(zip(rows, pdfs))
+        finally:
+            with self.lock: self.filling.discard(level)
+
+    def fill_all(self):
+        for level in MATH_LEVELS:
+            if self.needs_fill(level): self.fill(level)
+
+math_cache = MathSheetCache(MATH_CACHE_PER_LEVEL)
 
 # ──────────────────────────────────────────────────────────────────────────────
 # КОМАНДЫ И ДИАЛОГ
@@ -398,12 +3169,14 @@ def _safe_int(text: str, default: int) -> int:
 
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     args = context.args or []
-    if args and args[0].lower() in {"story","math","parent","settings","delete"}:
+    if args and args[0].lower() in {"story","math","parent","settings","delete","mystories","book"}:
         return await globals()[args[0].lower()+"_cmd"](update, context)
     await update.effective_message.reply_html(
         "<b>Привет! Я — Читалкин&Циферкин 🦉➕🧮</b>\n\n"
         "• /story — сказка (текст → PDF)\n"
-        "• /math — 10 минут примеров\n"
+        "• /math — лист примеров по возрасту (+ PDF)\n"
+        "• /mystories — мои сказки: прислать PDF ещё раз\n"
+        "• /book — все мои сказки одной книгой (PDF)\n"
         "• /parent — отчёт родителю\n"
         "• /settings — профиль ребёнка (возраст, герой, длина, стиль, «избегать»)\n"
         "• /delete — удалить мои данные\n\n"
@@ -446,7 +3219,7 @@ async def parent_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     last_when = u.get("last_story_ts")
     if last_when:
         try:
-            last_when = datetime.fromisoformat(last_when).astimezone(TZ_MSK).strftime("%d.%m.%Y %H:%M")
+            last_when = datetime.fromisoformat(last_when).astimezone(msk_tz()).strftime("%d.%m.%Y %H:%M")
         except Exception:
             last_when = "—"
     else:
@@ -463,30 +3236,76 @@ async def parent_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 async def delete_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     uid = update.effective_user.id
-    stats_all.pop(str(uid), None); save_json(STATS_PATH, stats_all)
-    stories_all.pop(str(uid), None); save_json(STORIES_PATH, stories_all)
+    delete_user_data(uid)
     context.user_data.clear()
     await update.effective_message.reply_text("Ваши данные удалены. Можно начать заново 🙂")
 
-def make_math_sheet():
-    problems, answers = [], []
-    for _ in range(10):
-        a, b = random.randint(4, 15), random.randint(1, 9)
-        if random.random() < 0.5:
-            problems.append(f"{a} + {b} = "); answers.append(str(a + b))
-        else:
-            if b > a: a, b = b, a
-            problems.append(f"{a} − {b} = "); answers.append(str(a - b))
-    return problems, answers
+def _my_stories(uid: int) -> List[Tuple[str, str]]:
+    # (ts, название) — от новых к старым
+    return [(h["ts"], h.get("title") or "Сказка") for h in _archive().history(str(uid), MYSTORIES_LIMIT)][::-1]
 
-async def math_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+async def _resend_story(update: Update, context: ContextTypes.DEFAULT_TYPE, ts: str):
     uid = update.effective_user.id
-    pr, an = make_math_sheet()
-    await update.effective_message.reply_text("🧮 10 минут математики:\n" + "\n".join([f"{i+1}) {p}" for i,p in enumerate(pr)]))
-    await update.effective_message.reply_text("Ответы:\n" + "\n".join([f"{i+1}) {a}" for i,a in enumerate(an)]))
+    data = _archive().find(str(uid), ts)
+    if not data:
+        await update.effective_message.reply_text("Не нашёл эту сказку — возможно, данные были удалены."); return
+    # без генерации и без дневного лимита: PDF уже загружен — уходит по file_id
+    await deliver_story_pdf(context.bot, update.effective_chat.id, data, f"skazka_{uid}.pdf", caption=f"📖 {data['title']}")
+
+async def mystories_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    uid = update.effective_user.id
+    items = _my_stories(uid)
+    ud = context.user_data; ud.clear()
+    if not items:
+        await update.effective_message.reply_text("Сказок пока нет — попробуйте /story 🙂"); return
+    args = context.args or []
+    if args and args[0].isdigit():
+        n = int(args[0])
+        if 1 <= n <= len(items): return await _resend_story(update, context, items[n - 1][0])
+    ud["flow"] = "resend"; ud["items"] = [ts for ts, _ in items]
+    lines = []
+    for i, (ts, title) in enumerate(items, 1):
+        try: when = datetime.fromisoformat(ts).astimezone(msk_tz()).strftime("%d.%m.%Y")
+        except Exception: when = "—"
+        lines.append(f"{i}) {title} • {when}")
+    await update.effective_message.reply_text("📚 Ваши сказки:\n" + "\n".join(lines) + "\n\nПришлите номер — пришлю PDF ещё раз.")
+
+async def book_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    from telegram import InputFile
+    uid = update.effective_user.id
+    n = _archive().count(str(uid))
+    if not n:
+        await update.effective_message.reply_text("Сказок пока нет — попробуйте /story 🙂"); return
+    await update.effective_message.reply_text(f"📚 Собираю книгу: {n} {_plural(n, 'сказка', 'сказки', 'сказок')}…")
+    path = DATA_DIR / f".book_{uid}_{os.getpid()}_{time.monotonic_ns()}.pdf"
+    try:
+        # вёрстка потоковая, память не зависит от числа сказок; в потоке — чтобы не держать event loop
+        with span("book_render"):
+            info = await asyncio.to_thread(render_book, path, lambda: user_history(uid, None), n)
+        with span("tg_upload"), open(path, "rb") as f:
+            await _tg_call(context.bot.send_document, update.effective_chat.id, InputFile(f, filename="skazki.pdf"),
+                           caption=f"📚 Мои сказки: {info['stories']} шт., {info['pages']} стр.")
+    finally:
+        path.unlink(missing_ok=True)
+
+async def math_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    from telegram import InputFile
+    uid = update.effective_user.id; msg = update.effective_message
+    level = math_level(get_profile(uid)["age"])
+    got = math_cache.take(level)
+    metrics.inc("skazka_math_sheets_total", result="hit" if got else "miss")
+    rows, pdf = got or (make_math_sheets(level, 1).problems(0), None)
+    if math_cache.needs_fill(level): context.application.create_task(asyncio.to_thread(math_cache.fill, level))
+    await msg.reply_text(f"🧮 {len(rows)} {_plural(len(rows), 'пример', 'примера', 'примеров')} по математике (уровень {level}):\n" + "\n".join(f"{i}) {p}" for i, (p, _) in enumerate(rows, 1)))
+    await msg.reply_html("Ответы (нажми, чтобы открыть):\n" + "\n".join(f"{i}) <tg-spoiler>{r}</tg-spoiler>" for i, (_, r) in enumerate(rows, 1)))
+    if pdf is None:
+        with span("pdf_render"): pdf = await _in_pdf_pool(render_math_pdf_bytes, level, [rows])
+    with span("tg_upload"):
+        await _tg_call(context.bot.send_document, update.effective_chat.id, InputFile(io.BytesIO(pdf), filename=f"math_{level}.pdf"),
+                       caption="Лист для печати, ответы — на второй странице")
     inc_math_counter(uid)
 
-# текстовые шаги (settings/story)
+# текстовые шаги (settings/story/resend)
 async def on_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
     ud = context.user_data; flow = ud.get("flow"); step = ud.get("step")
     if not flow: return
@@ -513,6 +3332,14 @@ async def on_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
             save_profile(update.effective_user.id, prof); ud.clear()
             await update.effective_message.reply_text("Готово! Профиль сохранён ✅"); return
 
+    if flow == "resend":
+        items = ud.get("items") or []
+        n = int(text) if text.isdigit() else 0
+        if not 1 <= n <= len(items):
+            await update.effective_message.reply_text(f"Пришлите номер от 1 до {len(items)}."); return
+        ud.clear()
+        await _resend_story(update, context, items[n - 1]); return
+
     if flow == "story":
         p = ud["params"]
         if step == "age":
@@ -530,32 +3357,157 @@ async def on_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
             uid = update.effective_user.id
             prof = get_profile(uid)
-            ustat = get_user_stats(uid)
-            if not DISABLE_LIMIT and ustat["today_stories"] >= MAX_STORIES_PER_DAY:
+            # лимит и место в очереди — до ответа «пишу»: отказ приходит сразу, а не после генерации
+            day = reserve_daily_story(uid)
+            if day is None:
                 await update.effective_message.reply_text("На сегодня лимит исчерпан."); ud.clear(); return
+            if JOB_QUEUE:
+                # сказку напишет и пришлёт воркер — диалог свободен сразу
+                moral = ud["moral"]; ud.clear()
+                await _enqueue_story_job(update, p, moral, prof, day); return
+            try:
+                ticket = gen_scheduler.submit(uid)
+            except QueueFull as e:
+                release_daily_story(uid, day); ud.clear()
+                await update.effective_message.reply_text(_queue_full_text(e.reason)); return
+
+            ud["step"] = "busy"; ud["ticket"] = id(ticket)   # чья это «занятость» — см. конец _deliver_story
+            pos = ticket.position
+            placeholder = await update.effective_message.reply_text(_queue_text(pos) if pos else WRITING_TEXT)
+            # генерация — отдельной задачей, чтобы диспетчер сразу взял следующие апдейты
+            context.application.create_task(
+                _deliver_story(update, context, p, ud["moral"], prof, placeholder, ticket, day), update=update
+            )
+            return
+        if step == "busy":
+            await update.effective_message.reply_text("Сказка ещё пишется, подождите немного 🙂"); return
+
+def _story_message(data: Dict[str, Any]) -> str:
+    e = html.escape
+    qs = "\n".join(f"{i}) {e(q)}" for i, q in enumerate(data["questions"][:4], 1))
+    return (
+        f"📖 <b>{e(data['title'])}</b>\n\n{e(data['text'])}\n\n"
+        f"<b>Мораль:</b> {e(data['moral'])}\n\n"
+        f"Вопросы:\n{qs}"
+    )
+
+def _split_message(text: str, limit: int = TG_MSG_LIMIT) -> List[str]:
+    # режем по абзацам (теги <b> внутри абзаца не рвутся), слишком длинный абзац — по limit
+    chunks: List[str] = []; cur = ""
+    for para in text.split("\n\n"):
+        while len(para) > limit:
+            if cur: chunks.append(cur); cur = ""
+            chunks.append(para[:limit]); para = para[limit:]
+        if cur and len(cur) + 2 + len(para) > limit: chunks.append(cur); cur = para
+        else: cur = f"{cur}\n\n{para}" if cur else para
+    if cur: chunks.append(cur)
+    return chunks or ["…"]
+
+async def _tg_call(fn, *args, **kwargs):
+    from telegram.error import RetryAfter
+    try:
+        return await fn(*args, **kwargs)
+    except RetryAfter as e:
+        ra = e.retry_after
+        await asyncio.sleep(ra.total_seconds() if hasattr(ra, "total_seconds") else float(ra))
+        return await fn(*args, **kwargs)
+
+class MessageStreamer:
+    # «Живое» сообщение: правим по мере готовности текста; что не влезает в 4096 — перетекает в новые.
+    def __init__(self, first: Message):
+        self.msgs: List[Message] = [first]; self.shown: List[str] = [first.text or ""]
+
+    async def show(self, text: str, parse_mode: Optional[str] = None):
+        from telegram.error import BadRequest
+        chunks = _split_message(text)
+        for i, chunk in enumerate(chunks):
+            if i < len(self.msgs):
+                if self.shown[i] == chunk and not parse_mode: continue
+                try:
+                    await _tg_call(self.msgs[i].edit_text, chunk, parse_mode=parse_mode)
+                except BadRequest as e:
+                    if "not modified" not in str(e).lower(): raise
+                self.shown[i] = chunk
+            else:
+                first = self.msgs[0]
+                self.msgs.append(await _tg_call(first.get_bot().send_message, first.chat_id, chunk, parse_mode=parse_mode))
+                self.shown.append(chunk)
+        for m in self.msgs[len(chunks):]:
+            try: await m.delete()
+            except Exception: pass
+        del self.msgs[len(chunks):], self.shown[len(chunks):]
+
+async def _generate_streaming(streamer: MessageStreamer, uid: int, p: Dict[str, Any], moral: str, prof: Dict[str, Any]) -> Dict[str, Any]:
+    # Поток генерации дописывает куски в parts (list.append атомарен), event loop раз в интервал их показывает.
+    # Новые куски проходят через AvoidStream: слова «избегать» заменяются сразу, а хвост, который может
+    # оказаться началом такого слова (или маркера морали), придерживается до следующего куска.
+    parts: List[str] = []
+    avoid = prof["avoid"]
+    live = AvoidStream(avoid_matcher(avoid), stop=MORAL_MARK)
+    task = asyncio.ensure_future(get_story_for_user(uid, p["age"], p["hero"], moral, p["length"], avoid=avoid,
+                                                    style=prof["style"], on_draft=parts.append))
+    visible, taken, shown = "", 0, 0
+    while not task.done():
+        await asyncio.wait({task}, timeout=STREAM_EDIT_INTERVAL)
+        if task.done(): break
+        n = len(parts); visible += live.feed("".join(parts[taken:n])); taken = n
+        if len(visible) - shown < STREAM_MIN_CHARS: continue
+        try:
+            await streamer.show(f"📖 Пишу сказку…\n\n{visible} ▌"); shown = len(visible)
+        except Exception as e:
+            print("[STREAM edit]", e)
+    return task.result()
 
-            data = synthesize_story(p["age"], p["hero"], ud["moral"], p["length"], avoid=prof["avoid"], style=prof["style"])
+WRITING_TEXT = "✍️ Пишу сказку… это может занять до минуты."
+FAILED_TEXT = "Не получилось написать сказку 😔 Попробуйте /story ещё раз."
+
+def _queue_text(pos: int) -> str:
+    return f"⏳ Вы №{pos} в очереди за сказкой. Как только подойдёт очередь — начну писать."
+
+async def _deliver_story(update: Update, context: ContextTypes.DEFAULT_TYPE, p: Dict[str, Any], moral: str, prof: Dict[str, Any],
+                         placeholder: Message, ticket: GenTicket, day: str):
+    uid = update.effective_user.id
+    t0 = time.perf_counter(); ok = shown = False
+    streamer = MessageStreamer(placeholder)
+    try:
+        queued = ticket.position > 0
+        with span("queue_wait"):
+            await ticket.wait(on_position=lambda n: streamer.show(_queue_text(n)))
+        async with ticket:
+            if queued: await streamer.show(WRITING_TEXT)
+            with span("generate"):
+                if STREAM_STORIES and oa_client:
+                    data = await _generate_streaming(streamer, uid, p, moral, prof)
+                else:
+                    data = await get_story_for_user(uid, p["age"], p["hero"], moral, p["length"], avoid=prof["avoid"], style=prof["style"])
+        ok = True
+        with span("save"):
             inc_story_counters(uid, data["title"])
-            store_user_story(uid, data)
-
-            # текст в чат
-            msg = (
-                f"📖 <b>{data['title']}</b>\n\n{data['text']}\n\n"
-                f"<b>Мораль:</b> {data['moral']}\n\n"
-                "Вопросы:\n"
-                f"1) {data['questions'][0]}\n"
-                f"2) {data['questions'][1]}\n"
-                f"3) {data['questions'][2]}\n"
-                f"4) {data['questions'][3]}"
-            )
-            await update.effective_message.reply_html(msg)
+            ref = store_user_story(uid, data, params={"age": p["age"], "hero": p["hero"], "moral": moral, "length": p["length"],
+                                                      "style": prof["style"], "avoid": prof["avoid"]})
 
-            # pdf
-            pdf_path = Path(f"skazka_{uid}.pdf").resolve()
-            render_story_pdf(pdf_path, data)
-            await update.effective_message.reply_document(InputFile(str(pdf_path), filename=pdf_path.name))
+        # текст в чат — заглушка превращается в готовую сказку
+        with span("tg_text"):
+            await streamer.show(_story_message(data), parse_mode="HTML")
+        shown = True
 
-            ud.clear(); return
+        # pdf — в памяти, без временного файла; сказка из кэша могла уже уйти в Telegram — тогда по file_id
+        await deliver_story_pdf(context.bot, update.effective_chat.id, dict(data, ts=ref["ts"]), f"skazka_{uid}.pdf")
+    except Exception:
+        # заглушка («Пишу сказку…», «Вы №N в очереди») не должна висеть без ответа; сама ошибка — в error_handler
+        try:
+            if not shown: await streamer.show(FAILED_TEXT)
+            else: await _tg_call(context.bot.send_message, update.effective_chat.id, "Не получилось отправить PDF 😔 Сказка — выше.")
+        except Exception as e:
+            print("[DELIVER] не смог сообщить об ошибке:", repr(e))
+        raise
+    finally:
+        gen_scheduler.release(ticket)   # если до генерации не дошли (отмена, ошибка) — освобождаем заявку
+        if not ok: release_daily_story(uid, day)
+        metrics.observe("skazka_stage_seconds", time.perf_counter() - t0, stage="deliver")
+        # пока писали, пользователь мог начать новый диалог или уже ждать следующую сказку — их не трогаем
+        ud = context.user_data
+        if ud.get("step") == "busy" and ud.get("ticket") == id(ticket): ud.clear()
 
 # ошибки → алёрт (если указан чат)
 async def error_handler(update: object, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -570,24 +3522,126 @@ async def error_handler(update: object, context: ContextTypes.DEFAULT_TYPE) -> N
         print("[ERR alert send]", e)
 
 # ──────────────────────────────────────────────────────────────────────────────
-# RUN
+# ЭКСПОРТ МЕТРИК
 # ──────────────────────────────────────────────────────────────────────────────
-async def post_init(app: Application):
-    await app.bot.set_my_commands([
-        BotCommand("start","меню"),
-        BotCommand("story","сказка (текст → PDF)"),
-        BotCommand("math","10 минут математики"),
-        BotCommand("parent","отчёт родителю"),
-        BotCommand("settings","настройки профиля"),
-        BotCommand("delete","удалить мои данные"),
-        BotCommand("help","помощь"),
-    ])
+def metrics_text() -> str:
+    # счётчики и гистограммы этапов + снимок уже имеющейся статистики (кэши, конвейеры, предгенерация)
+    g: List[Tuple[str, str, Dict[str, Any], float]] = []
+    for k, v in story_cache.stats().items():
+        g.append(("skazka_story_cache", "Кэш готовых сказок (StoryCache.stats)", {"stat": k}, v))
+    for k, v in user_cache_stats().items():
+        g.append(("skazka_user_cache", "Кэш записей пользователей (CachedStore.stats)", {"stat": k}, v))
+    for name, st in pipeline_stats().items():
+        for k in ("stories", "revised", "fallback", "seconds", "tokens"):
+            g.append(("skazka_pipeline", "Итоги конвейеров генерации (pipeline_stats)", {"pipeline": name, "stat": k}, st[k]))
+    g.append(("skazka_breaker_open", "Предохранитель OpenAI открыт (1) — сказки пишет локальный генератор", {}, int(not breaker.allow())))
+    for k, v in gen_scheduler.stats().items():
+        g.append(("skazka_gen_queue", "Очередь генераций (GenScheduler.stats)", {"stat": k}, v))
+    if JOB_QUEUE:
+        for k, v in _jobs().stats().items():
+            g.append(("skazka_jobs", "Задания для воркеров по статусам (JobQueue.stats)", {"status": k}, v))
+    g.append(("skazka_pregen_spent_tokens", "Токены, потраченные предгенерацией за ночь", {}, _pregen["spent"]))
+    for k, v in startup.items():
+        if v is not None:
+            g.append(("skazka_startup_seconds", "Старт: import — импорт модуля, ready — от запуска процесса до приёма апдейтов, prewarm — фоновый прогрев", {"phase": k}, v))
+    return metrics.render(g)
+
+def start_metrics_server(port: int):
+    # отдельный маленький HTTP-сервер в потоке. В режиме вебхука — тоже он: встраиваться в сервер PTB
+    # можно только через закрытые поля (updater._httpd), а они меняются между версиями PTB.
+    from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split("?", 1)[0] != METRICS_PATH: self.send_error(404); return
+            body = metrics_text().encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+            self.send_header("Content-Length", str(len(body))); self.end_headers()
+            self.wfile.write(body)
+        def log_message(self, *args): pass
 
-def main():
-    if BOT_TOKEN.startswith("ВСТАВЬ_"):
-        raise SystemExit("Сначала задайте BOT_TOKEN (переменная окружения).")
+    try:
+        srv = ThreadingHTTPServer(("0.0.0.0", port), Handler)
+    except OSError as e:
+        print(f"[METRICS] порт {port} недоступен: {e}"); return None
+    threading.Thread(target=srv.serve_forever, name="metrics", daemon=True).start()
+    print(f"[METRICS] http://0.0.0.0:{port}{METRICS_PATH}")
+    return srv
+
+_metrics_servers: List[Any] = []
 
-    app = Application.builder().token(BOT_TOKEN).post_init(post_init).build()
+# ──────────────────────────────────────────────────────────────────────────────
+# RUN
+# ──────────────────────────────────────────────────────────────────────────────
+@functools.lru_cache(maxsize=None)
+def _chat_ordered_processor_cls():
+    from telegram import Update
+    from telegram.ext import BaseUpdateProcessor
+
+    class ChatOrderedUpdateProcessor(BaseUpdateProcessor):
+        # Апдейты разных пользователей обрабатываются параллельно (до max_concurrent_updates), одного — строго
+        # по очереди: машина состояний on_text (flow/step в user_data) видит их в порядке прихода, как раньше.
+        # asyncio.Lock отдаёт блокировку ждущим по порядку, а PTB запускает обработку апдейтов в порядке очереди.
+        # Ждущий своей очереди апдейт держит место в семафоре PTB (process_update берёт его до нас и final),
+        # поэтому ждущих ограничиваем: у одного пользователя — max_pending, у всех вместе — max_waiting
+        # (половина мест). Остальные места всегда свободны для первых апдейтов других пользователей,
+        # сколько бы флуда ни пришло; лишнее отбрасывается.
+        def __init__(self, max_concurrent_updates: int, max_pending: int = CHAT_MAX_PENDING, max_waiting: Optional[int] = None):
+            super().__init__(max_concurrent_updates)
+            self.max_pending = max_pending
+            self.max_waiting = max(1, max_concurrent_updates // 2) if max_waiting is None else max_waiting
+            self.slots: Dict[Any, List[Any]] = {}   # ключ → [Lock, сколько апдейтов ждут или обрабатываются]
+            self.waiting = 0
+            self.dropped = 0
+
+        @staticmethod
+        def key(update: object) -> Any:
+            if not isinstance(update, Update): return None
+            if update.effective_user: return ("u", update.effective_user.id)    # user_data — состояние диалога
+            if update.effective_chat: return ("c", update.effective_chat.id)
+            return None
+
+        async def do_process_update(self, update: object, coroutine) -> None:
+            key = self.key(update)
+            if key is None:
+                await coroutine; return
+            slot = self.slots.get(key) or self.slots.setdefault(key, [asyncio.Lock(), 0])
+            waits = slot[1] > 0   # у пользователя уже есть апдейт — этот будет ждать, держа место семафора
+            if slot[1] >= self.max_pending or (waits and self.waiting >= self.max_waiting):
+                coroutine.close(); self.dropped += 1
+                metrics.inc("skazka_updates_dropped_total"); return
+            slot[1] += 1; self.waiting += waits
+            try:
+                async with slot[0]:
+                    self.waiting -= waits; waits = False
+                    with span("update"): await coroutine
+            finally:
+                self.waiting -= waits
+                slot[1] -= 1
+                if not slot[1]: self.slots.pop(key, None)
+
+        async def initialize(self) -> None: pass
+        async def shutdown(self) -> None: pass
+
+    return ChatOrderedUpdateProcessor
+
+def build_application(token: str = BOT_TOKEN, concurrency: int = UPDATE_CONCURRENCY,
+                      request=None, get_updates_request=None) -> Application:
+    # request / get_updates_request — свой транспорт к Bot API (нагрузочный тест в bench_min.py)
+    from telegram.ext import Application, CommandHandler, MessageHandler, filters
+    b = Application.builder().token(token).post_init(post_init).post_shutdown(post_shutdown)
+    if request is not None:
+        b = b.request(request).get_updates_request(get_updates_request or request)
+    else:
+        b = (b.connection_pool_size(TG_POOL_SIZE).pool_timeout(TG_POOL_TIMEOUT).read_timeout(TG_READ_TIMEOUT)
+              .media_write_timeout(TG_MEDIA_WRITE_TIMEOUT).http_version(TG_HTTP_VERSION))
+    if TG_API_URL:
+        api = TG_API_URL.rstrip("/")
+        b = b.base_url(f"{api}/bot").base_file_url(f"{api}/file/bot")
+    if concurrency > 1:
+        b = b.concurrent_updates(_chat_ordered_processor_cls()(concurrency))
+    app = b.build()
     app.add_handler(CommandHandler("start", start))
     app.add_handler(CommandHandler("help", help_cmd))
     app.add_handler(CommandHandler("story", story_cmd))
@@ -595,8 +3649,96 @@ def main():
     app.add_handler(CommandHandler("parent", parent_cmd))
     app.add_handler(CommandHandler("settings", settings_cmd))
     app.add_handler(CommandHandler("delete", delete_cmd))
+    app.add_handler(CommandHandler("mystories", mystories_cmd))
+    app.add_handler(CommandHandler("book", book_cmd))
     app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, on_text))
     app.add_error_handler(error_handler)
+    return app
+
+async def set_commands(app: Application):
+    from telegram import BotCommand
+    try:
+        await app.bot.set_my_commands([
+            BotCommand("start","меню"),
+            BotCommand("story","сказка (текст → PDF)"),
+            BotCommand("math","Примеры по математике"),
+            BotCommand("mystories","мои сказки (PDF ещё раз)"),
+            BotCommand("book","все сказки одной книгой"),
+            BotCommand("parent","отчёт родителю"),
+            BotCommand("settings","настройки профиля"),
+            BotCommand("delete","удалить мои данные"),
+            BotCommand("help","помощь"),
+        ])
+    except Exception as e:
+        print("[START] set_my_commands:", repr(e))
+
+# ──────────────────────────────────────────────────────────────────────────────
+# СТАРТ: время до готовности и прогрев
+# ──────────────────────────────────────────────────────────────────────────────
+startup: Dict[str, Optional[float]] = {"import": None, "ready": None, "prewarm": None}
+
+def process_uptime() -> float:
+    # секунды с запуска процесса: на Linux — по /proc (учитывает и старт интерпретатора), иначе — с импорта модуля
+    try:
+        start = int(Path("/proc/self/stat").read_text().rsplit(")", 1)[1].split()[19]) / os.sysconf("SC_CLK_TCK")
+        return float(Path("/proc/uptime").read_text().split()[0]) - start
+    except Exception:
+        return time.monotonic() - _T_IMPORT
+
+async def mark_ready(app: Application):
+    # run_webhook/run_polling начинают принимать апдейты уже после post_init — ждём app.running
+    while not app.running: await asyncio.sleep(0.02)
+    startup["ready"] = round(process_uptime(), 3)
+    print(f"[START] принимаю апдейты через {startup['ready']:.2f} с после запуска процесса")
+
+def _warm_pdf():
+    _story_pdf_cls()
+    if FONT_REG.exists() and FONT_BOLD.exists(): _subset_font(FONT_REG); _subset_font(FONT_BOLD)
+
+def prewarm():
+    # Всё, что раньше делалось при импорте (и чего ждал первый пользователь), — в фоновом потоке.
+    # Порядок важен: fpdf и шрифты — до пула PDF, тогда процессы-рендереры стартуют уже с ними.
+    t0 = time.perf_counter(); took = []
+    steps = (("openai", lambda: oa_client.get() if oa_client else None), ("tz", msk_tz), ("fpdf", _warm_pdf),
+             ("store", _store), ("archive", lambda: _archive().load()), ("pdf_pool", lambda: _pdf_executor() and _pdf_executor().submit(_warm_pdf)),
+             ("math", math_cache.fill_all))
+    for name, fn in steps:
+        t = time.perf_counter()
+        try: fn()
+        except Exception as e: print(f"[START] прогрев {name}:", repr(e))
+        took.append(f"{name} {time.perf_counter() - t:.2f}")
+    startup["prewarm"] = round(time.perf_counter() - t0, 3)
+    print(f"[START] прогрев за {startup['prewarm']:.2f} с ({', '.join(took)})")
+
+async def post_init(app: Application):
+    # здесь — только то, что не ждёт сети: команды меню, прогрев и фоновые циклы уходят в фон
+    _bg_tasks.append(asyncio.create_task(set_commands(app)))
+    _bg_tasks.append(asyncio.create_task(mark_ready(app)))
+    if PREWARM: threading.Thread(target=prewarm, name="prewarm", daemon=True).start()
+    if oa_client and PREGEN_TOKEN_BUDGET > 0:
+        _bg_tasks.append(asyncio.create_task(pregen_loop()))
+    if JOB_QUEUE:
+        _bg_tasks.append(asyncio.create_task(job_results_loop(app)))
+    if ARCHIVE_COMPACT_INTERVAL > 0:
+        _bg_tasks.append(asyncio.create_task(archive_compact_loop()))
+    if METRICS_PORT:
+        _metrics_servers.append(start_metrics_server(METRICS_PORT))
+
+_bg_tasks: List[asyncio.Task] = []
+
+async def post_shutdown(app: Application):
+    for t in _bg_tasks: t.cancel()
+    _bg_tasks.clear()
+    for srv in _metrics_servers:
+        if srv: srv.shutdown(); srv.server_close()
+    _metrics_servers.clear()
+    shutdown_pools()
+
+def main():
+    if BOT_TOKEN.startswith("ВСТАВЬ_"):
+        raise SystemExit("Сначала задайте BOT_TOKEN (переменная окружения).")
+
+    app = build_application()
 
     if PUBLIC_URL:
         path = (WEBHOOK_PATH or BOT_TOKEN).lstrip("/")
@@ -608,5 +3750,30 @@ def main():
         print("[POLLING] starting…")
         app.run_polling(drop_pending_updates=True)
 
+def __getattr__(name: str):
+    # классы-наследники fpdf/telegram создаются при первом обращении: bm.StoryPDF, bm.ChatOrderedUpdateProcessor
+    lazy = {"StoryPDF": _story_pdf_cls, "ChatOrderedUpdateProcessor": _chat_ordered_processor_cls}
+    if name in lazy: return lazy[name]()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+startup["import"] = round(time.monotonic() - _T_IMPORT, 3)
+
 if __name__ == "__main__":
-    main()
+    if sys.argv[1:2] == ["migrate"]:
+        # python bot_min.py migrate — перенести stats.json/stories.json в SQLite (DB_PATH)
+        print("[MIGRATE]", migrate_json_to_sqlite(), "→", DB_PATH)
+    elif sys.argv[1:2] == ["worker"]:
+        # python bot_min.py worker [N] — N процессов, которые пишут сказки из очереди JOBS_DB (бот — с JOB_QUEUE=1)
+        run_workers(int(sys.argv[2]) if len(sys.argv) > 2 else JOB_WORKERS)
+    elif sys.argv[1:2] == ["batch"] and len(sys.argv) > 2:
+        # python bot_min.py batch profiles.csv [каталог] — пакет сказок с PDF (BATCH_API=async|files)
+        src = Path(sys.argv[2])
+        try: asyncio.run(run_batch(src, Path(sys.argv[3]) if len(sys.argv) > 3 else src.parent / f"{src.stem}_stories"))
+        finally: shutdown_pools(wait=True)
+    elif sys.argv[1:2] == ["compact"]:
+        # python bot_min.py compact — физически убрать из архива удалённых через /delete (только при остановленном боте;
+        # работающий бот сжимает архив сам, раз в ARCHIVE_COMPACT_INTERVAL)
+        try: print("[ARCHIVE] размер после сжатия:", _archive().compact(wait=0), "байт")
+        except ArchiveBusy as e: raise SystemExit(f"[ARCHIVE] {e}: бот запущен и сожмёт архив сам")
+    else:
+        main()
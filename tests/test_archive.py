@@ -0,0 +1,64 @@
+# Архив сказок: дописывание с дедупликацией (кадры R), «забыть пользователя», сжатие и повторное открытие.
+import sys
+import threading
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+from bot_min import StoryArchive
+
+def _story(n):
+    return {"title": f"Сказка {n}", "text": f"Жил-был котёнок номер {n}. " * 20}
+
+def test_append_forget_compact_reopen(tmp_path):
+    path = tmp_path / "stories.arc"
+    arc = StoryArchive(path)
+    arc.append("1", "2026-01-01T10:00", _story(1))
+    arc.append("2", "2026-01-01T11:00", _story(1))          # та же сказка у другого — кадр R
+    arc.append("2", "2026-01-02T11:00", _story(2))
+    arc.append("3", "2026-01-03T12:00", _story(3))
+    key = b"k" * 16
+    arc.attach_file(key, StoryArchive.digest_of(_story(3)), {"file_id": "F3", "size": 10})
+    assert arc.find("2", "2026-01-01T11:00")["title"] == "Сказка 1"
+    assert [s["title"] for s in arc.history("2")] == ["Сказка 1", "Сказка 2"]
+    before = path.stat().st_size
+
+    arc.forget("1"); arc.forget("3")
+    assert arc.find("1", "2026-01-01T10:00") is None and arc.forgotten == 2
+    size = arc.compact()
+    assert size < before and arc.forgotten == 0
+    assert arc.file_of(key) is None                         # PDF забытой сказки уходит вместе с ней
+    # после сжатия дописывание продолжается в новый файл
+    arc.append("4", "2026-01-04T09:00", _story(2))
+    arc.close()
+
+    again = StoryArchive(path)
+    assert again.count("1") == 0 and again.count("3") == 0
+    assert [s["title"] for s in again.history("2")] == ["Сказка 1", "Сказка 2"]
+    assert again.find("2", "2026-01-01T11:00")["text"] == _story(1)["text"]
+    assert again.find("4", "2026-01-04T09:00")["title"] == "Сказка 2"
+    assert len(again.digests("2")) == 2
+    again.close()
+
+def test_writes_during_compact_survive(tmp_path, monkeypatch):
+    # новый файл пишется без self.lock: запись посреди сжатия не ждёт его и попадает в новый файл
+    import os
+    path = tmp_path / "stories.arc"
+    arc = StoryArchive(path)
+    for n in range(50): arc.append(str(n % 5), f"2026-02-01T{n:02d}", _story(n))
+    arc.forget("0")
+    started, go_on, real_pread = threading.Event(), threading.Event(), os.pread
+    def slow_pread(*a):
+        started.set(); go_on.wait(5); return real_pread(*a)
+    monkeypatch.setattr(os, "pread", slow_pread)
+    t = threading.Thread(target=arc.compact); t.start()
+    assert started.wait(5)
+    monkeypatch.setattr(os, "pread", real_pread)
+    arc.append("9", "2026-02-02T00:00", _story(99))
+    arc.forget("1")
+    assert t.is_alive()                                     # сжатие ещё идёт, а запись уже прошла
+    go_on.set(); t.join(5)
+    arc.close()
+    again = StoryArchive(path)
+    assert again.find("9", "2026-02-02T00:00")["title"] == "Сказка 99"
+    assert again.count("0") == 0 and again.count("1") == 0 and again.count("2") == 10
+    again.close()
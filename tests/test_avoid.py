@@ -0,0 +1,27 @@
+# Поток с фильтром «избегать»: при любом разбиении на куски результат — как у sub() по всему тексту.
+import sys
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+from bot_min import AvoidStream, avoid_matcher
+
+TEXT = ("Жила-была девочка. Однажды к ней пришла Баба-Яга, а за ней — T-Rex из музея. "
+        "Бабе-яге и t-rex'у было скучно, и девочка позвала их пить чай с тёмным лесом.")
+
+def _streamed(m, text, cuts):
+    st = AvoidStream(m); out = []; prev = 0
+    for c in list(cuts) + [len(text)]:
+        out.append(st.feed(text[prev:c])); prev = c
+    return "".join(out) + st.flush()
+
+@pytest.mark.parametrize("avoid", [["баба-яга"], ["T-Rex"], ["тёмный лес"], ["девочка", "баба-яга", "t-rex"]])
+def test_stream_matches_full_sub_at_every_split(avoid):
+    m = avoid_matcher(avoid)
+    want = m.sub(TEXT)
+    assert want != TEXT
+    for i in range(1, len(TEXT)):
+        assert _streamed(m, TEXT, [i]) == want, (avoid, TEXT[:i])
+    # и по одному символу
+    assert _streamed(m, TEXT, range(1, len(TEXT))) == want
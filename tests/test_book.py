@@ -0,0 +1,65 @@
+# Книга (/book): PDF пишется вручную, поэтому проверяем сам файл — xref, страницы, оглавление и закладки.
+import re
+import sys
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+import bot_min
+
+ROOT = Path(__file__).resolve().parents[1]
+
+def _stories(n):
+    return [{"ts": f"2026-03-{1 + i % 28:02d}T20:00:00+03:00", "title": f"Сказка про ёжика {i + 1}",
+             "text": "Жил-был ёжик. " * 30 + "\n\n" + "Он нашёл друга в лесу. " * 20,
+             "moral": "Дружба важнее всего.", "questions": ["Кто ёжик?", "Кого он нашёл?"]} for i in range(n)]
+
+@pytest.fixture
+def book_fonts(tmp_path, monkeypatch):
+    pytest.importorskip("fontTools")
+    monkeypatch.setattr(bot_min, "FONT_REG", ROOT / "DejaVuSans.ttf")
+    monkeypatch.setattr(bot_min, "FONT_BOLD", ROOT / "DejaVuSans-Bold.ttf")
+    monkeypatch.setattr(bot_min, "FONT_CACHE_DIR", tmp_path / "fonts")
+    bot_min._book_fonts.cache_clear(); bot_min._subset_fonts.clear()
+    yield
+    bot_min._book_fonts.cache_clear(); bot_min._subset_fonts.clear()
+
+def _titles(data: bytes):
+    return [bytes.fromhex(h.decode()).decode("utf-16-be") for h in re.findall(rb"/Title <FEFF([0-9A-F]*)>", data)]
+
+def test_render_book_parses(tmp_path, book_fonts):
+    n = 40                                          # оглавление не помещается на одну страницу
+    stories = _stories(n)
+    path = tmp_path / "book.pdf"
+    res = bot_min.render_book(path, lambda: iter(stories), n, title="Мои сказки")
+    data = path.read_bytes()
+    assert res["stories"] == n and res["bytes"] == len(data)
+    assert data.startswith(b"%PDF-1.7") and data.rstrip().endswith(b"%%EOF")
+
+    # xref: startxref указывает на таблицу, каждая запись — на начало своего объекта
+    start = int(re.search(rb"startxref\n(\d+)\n%%EOF\s*$", data).group(1))
+    assert data[start:start + 5] == b"xref\n"
+    size = int(re.match(rb"xref\n0 (\d+)\n", data[start:]).group(1))
+    rows = data[start:].split(b"\n")[2:2 + size]
+    assert rows[0].startswith(b"0000000000 65535 f")
+    for oid, row in enumerate(rows[1:], 1):
+        off = int(row[:10])
+        assert data[off:off + len(b"%d 0 obj" % oid)] == b"%d 0 obj" % oid, oid
+    assert re.search(rb"trailer\n<< /Size %d " % size, data)
+
+    # страницы: сколько объектов /Page, столько и в /Count дерева; глав не меньше, чем сказок
+    pages = len(re.findall(rb"/Type /Page /Parent", data))
+    assert pages == res["pages"] == int(re.search(rb"/Type /Pages /Kids \[[^\]]*\] /Count (\d+)", data).group(1))
+    assert pages >= 1 + bot_min._toc_pages(n) + n and bot_min._toc_pages(n) == 2
+
+    # оглавление: ссылка на каждую главу, закладки — в порядке сказок, последний /Title — из /Info
+    assert len(re.findall(rb"/Subtype /Link", data)) == n
+    titles = _titles(data)
+    assert titles[:-1] == [f"{i + 1}. {s['title']}" for i, s in enumerate(stories)] and titles[-1] == "Мои сказки"
+    assert re.search(rb"/Type /Outlines /First \d+ 0 R /Last \d+ 0 R /Count %d" % n, data)
+
+def test_render_empty_book(tmp_path, book_fonts):
+    # только титул: оглавления без глав нет
+    res = bot_min.render_book(tmp_path / "empty.pdf", lambda: iter(()), 0)
+    assert res == {"stories": 0, "pages": 1, "bytes": (tmp_path / "empty.pdf").stat().st_size}
@@ -0,0 +1,40 @@
+# Параллельная обработка апдейтов: флуд одного пользователя не занимает все места и не задерживает других,
+# а апдейты одного пользователя идут строго по порядку.
+import asyncio
+import sys
+from datetime import datetime
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+import bot_min
+
+telegram = pytest.importorskip("telegram")
+
+def _update(n: int, uid: int):
+    chat, user = telegram.Chat(uid, "private"), telegram.User(uid, "u", False)
+    return telegram.Update(n, message=telegram.Message(n, datetime.now(), chat, from_user=user, text=str(n)))
+
+def test_flooding_user_does_not_block_others():
+    async def run():
+        proc = bot_min._chat_ordered_processor_cls()(4, max_pending=100)
+        gate, done, order = asyncio.Event(), [], []
+
+        async def slow(n):
+            order.append(n); await gate.wait()
+
+        async def fast():
+            done.append("other")
+
+        # как Application: каждый апдейт — своя задача через process_update (с семафором PTB)
+        flood = [asyncio.create_task(proc.process_update(_update(n, 1), slow(n))) for n in range(50)]
+        await asyncio.sleep(0.05)
+        assert proc.waiting == proc.max_waiting == 2 and proc.dropped == 47
+        other = asyncio.create_task(proc.process_update(_update(100, 2), fast()))
+        await asyncio.wait_for(other, 1)                 # не ждёт, пока флуд разойдётся
+        assert done == ["other"]
+        gate.set(); await asyncio.gather(*flood)
+        assert order == [0, 1, 2] and proc.waiting == 0 and not proc.slots
+
+    asyncio.run(run())
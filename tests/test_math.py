@@ -0,0 +1,19 @@
+# Листы /math на обоих движках: без повторов, ответы верны, числа в пределах уровня, один seed — те же листы.
+import sys
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+import bot_min
+from bench_min import _check_math
+
+@pytest.mark.parametrize("engine", ["python", "numpy"])
+def test_math_sheets_invariants(engine):
+    if engine == "numpy": pytest.importorskip("numpy")
+    res = _check_math(bot_min, engine, n=50)
+    assert res == {"sheets": 50 * len(bot_min.MATH_LEVELS), "duplicate": 0, "answer": 0, "level": 0, "seed": 0}
+
+def test_math_sheets_default_engine_shape():
+    sheets = bot_min.make_math_sheets(4, 3, seed=1)
+    assert len(sheets) == 3 and all(len(sheets.problems(i)) == bot_min.MATH_PROBLEMS for i in range(3))
@@ -0,0 +1,14 @@
+# Холодный старт: import bot_min не должен тянуть тяжёлые модули (openai, fpdf, telegram…) —
+# они подгружаются при первом использовании и в прогреве после старта. Проверка — в свежем процессе.
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+from bench_min import HEAVY_MODULES, import_profile
+
+IMPORT_BUDGET_MS = 2000   # с большим запасом: на машине разработчика ~0,25 с
+
+def test_import_is_light(tmp_path):
+    prof = import_profile(tmp_path)
+    assert prof["heavy_loaded"] == [], f"при import bot_min загружены {prof['heavy_loaded']} (из {HEAVY_MODULES})"
+    assert prof["bot_min_ms"] < IMPORT_BUDGET_MS, prof["top_direct_ms"]